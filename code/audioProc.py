@@ -0,0 +1,349 @@
+import os
+import time
+import threading
+import logging
+import multiprocessing
+import collections
+from multiprocessing import shared_memory
+import numpy
+import sampleStream
+import fxBus
+import seqVoices
+import seqRealtime
+
+"""
+Optional separate audio process (--audioProc) - takes the mixing out of the GIL the clock, midi & keypad share
+
+The control process decodes every kit once into a shared memory block - and nowhere else: its own sample sets only
+hold SampleRefs.  The audio process maps that same block (zero-copy), owns the output device, and mixes its own fixed
+size blocks with numpy.  Samples bigger than --streamSize aren't decoded at all: the audio process memory-maps the wav
+and converts each block as it is mixed (sampleStream.MappedPcm).
+
+Notes travel as timestamped trigger events through a single-producer/single-consumer ring buffer, also in shared
+memory: the producer writes the event then bumps the write index; the consumer reads up to it then bumps the read
+index - no locks between the processes.  (Threads within the control process take a local lock to act as one producer.)
+
+Sequenced notes are stamped with their tick's *scheduled* time + LOOKAHEAD, so however late the clock thread runs
+(up to LOOKAHEAD) the audio process still starts them on the exact frame.  Live notes are stamped "now" - they aren't
+held back, so a pad hit lands up to LOOKAHEAD ahead of the sequence & metronome it is played along with (and a note
+recorded in time with what is heard lands that much later in the sequence).  Delaying them too would keep everything
+aligned, at the cost of LOOKAHEAD more latency on every pad hit.
+
+An optional effects bus (fxBus, --fx) processes each block between the mixing and the output; its cost per block is
+logged by the audio process every REPORT_SECS.
+
+Every REPORT_SECS the control process logs both jitter figures side by side:
+  clock lateness - how late the tick timer fired; in the single-process model notes are late by this much
+                   (plus up to one mixer buffer, as Sound.play only starts on a buffer boundary)
+  placement error - how late the audio process started notes vs their timestamp (0 = frame accurate)
+"""
+
+MIX_RATE = 22050
+MIX_CHANS = 2
+BLOCK_FRAMES = 256      #~11.6ms blocks
+LOOKAHEAD = 0.05        #secs sequenced notes are scheduled ahead - must cover the clock's worst lateness
+RING_SLOTS = 4096
+POLL_SECS = 0.001
+REPORT_SECS = 30
+MAX_VOICES = 32
+ERROR_WINDOW = 1000     #placement errors are reported over the last this many notes
+
+EVENT_DTYPE = numpy.dtype([('when', 'f8'), ('kit', 'i4'), ('samp', 'i4'), ('vol', 'f4'), ('group', 'i4'), ('note', 'i4')])
+NOTE_OFF = -1   #samp of a note off event
+FADE_FRAMES = seqVoices.CHOKE_FADE_MS * MIX_RATE // 1000
+#ring shm layout: int64 write idx, int64 read idx, int64 stop flag, float64 stats[NUM_STATS], events[RING_SLOTS]
+STATS = ['p50', 'p99', 'max', 'late', 'underruns', 'events', 'peakVoices', 'peakNatural']
+HEADER_BYTES = 24 + 8 * len(STATS)
+
+def ringViews(buf):
+    idx = numpy.ndarray((3,), dtype=numpy.int64, buffer=buf, offset=0)
+    stats = numpy.ndarray((len(STATS),), dtype=numpy.float64, buffer=buf, offset=24)
+    events = numpy.ndarray((RING_SLOTS,), dtype=EVENT_DTYPE, buffer=buf, offset=HEADER_BYTES)
+    return idx, stats, events
+
+def percentiles(values):
+    """ (p50, p99, max) in ms """
+    if len(values) == 0:
+        return (0.0, 0.0, 0.0)
+    values = numpy.asarray(values) * 1000
+    return (float(numpy.percentile(values, 50)), float(numpy.percentile(values, 99)), float(values.max()))
+
+def loadOrSilence(path, mixRate, mixChans):
+    try:
+        return sampleStream.loadPcm(path, mixRate, mixChans)
+    except (sampleStream.WavFormatError, OSError, ValueError) as ex:
+        logging.warning("Can't decode %s - it will be silent: %s", path, ex)
+        return numpy.zeros((0, mixChans), dtype=numpy.int16)
+
+def loadOrStream(path, mixRate, mixChans, streamSize):
+    """ the decoded frames - or just the path of a sample bigger than streamSize (bytes), to stream """
+    try:
+        if streamSize is not None and os.path.getsize(path) > streamSize:
+            sampleStream.readWavHeader(path)    #streamable?
+            return path
+    except (sampleStream.WavFormatError, OSError) as ex:
+        logging.warning("Can't stream (%s), loading it whole", ex)
+    return loadOrSilence(path, mixRate, mixChans)
+
+def shareKits(kits, mixRate, mixChans, streamSize=None):
+    """
+    decode kits (lists of wav paths) into one new shared memory block of int16 frames
+    returns (SharedMemory, total frames, table) - table[kit][sample] is (first frame, num frames), for mapKits, or the
+    wav's path for a sample bigger than streamSize (bytes) - those are streamed from the file, not decoded
+    """
+    decoded = [[loadOrStream(path, mixRate, mixChans, streamSize) for path in paths] for paths in kits]
+    totalFrames = max(1, sum(len(pcm) for kit in decoded for pcm in kit if not isinstance(pcm, str)))
+    sampleShm = shared_memory.SharedMemory(create=True, size=totalFrames * mixChans * 2)
+    frames = numpy.ndarray((totalFrames, mixChans), dtype=numpy.int16, buffer=sampleShm.buf)
+    table = list()
+    pos = 0
+    for kit in decoded:
+        table.append(list())
+        for pcm in kit:
+            if isinstance(pcm, str):
+                table[-1].append(pcm)
+                continue
+            frames[pos:pos + len(pcm)] = pcm
+            table[-1].append((pos, len(pcm)))
+            pos += len(pcm)
+    return sampleShm, totalFrames, table
+
+def mapKits(name, totalFrames, mixChans, table, mixRate=MIX_RATE):
+    """
+    map kits shared by shareKits (in another process).  Returns (SharedMemory, samples[kit][sample] frame arrays) -
+    views of the block, no copies; or MappedPcm for the streamed ones
+    """
+    sampleShm = shared_memory.SharedMemory(name=name)
+    frames = numpy.ndarray((totalFrames, mixChans), dtype=numpy.int16, buffer=sampleShm.buf)
+    return sampleShm, [[sampleStream.MappedPcm(entry, mixRate, mixChans) if isinstance(entry, str)
+                        else frames[entry[0]:entry[0] + entry[1]] for entry in kit] for kit in table]
+
+class SampleRef():
+    """ stands in for a kit sample's Sound in the control process - the audio process has the sample itself """
+    def __init__(self, path):
+        self.path = path
+
+class AudioProcess():
+    """ control process side - owns the shared memory, starts the audio process, sends triggers """
+    def __init__(self, kits, driver=None, fxConfig=None, kitNames=None, realtime=None, streamSize=None):
+        """
+        kits: list of lists of wav paths, indexed [kit][sample].  Kits are fixed once started - a hot reloaded
+        kit only reaches the audio process on restart
+        fxConfig: fxBus config (None for no effects), with kitNames naming the kits it refers to
+        realtime: seqRealtime.Realtime settings for the audio process (None: normal scheduling)
+        streamSize: samples bigger than this (bytes) are streamed from their file (None: decode them all)
+        """
+        startTime = time.time()
+        self.sampleShm, totalFrames, table = shareKits(kits, MIX_RATE, MIX_CHANS, streamSize)
+        self.metroKit = len(kits) - 1   #the metronome is the last kit (see SampleMgr.audioKits)
+        logging.info("Audio process samples: %.1fMB shared, %d streamed, decoded in %.0fms", self.sampleShm.size / 1e6,
+                     sum(isinstance(entry, str) for kit in table for entry in kit), (time.time() - startTime) * 1000)
+
+        self.ringShm = shared_memory.SharedMemory(create=True, size=HEADER_BYTES + RING_SLOTS * EVENT_DTYPE.itemsize)
+        self.idx, self.stats, self.events = ringViews(self.ringShm.buf)
+        self.idx[:] = 0
+        self.stats[:] = 0
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.lateness = list()  #clock lateness of the ticks since the last report
+
+        ctx = multiprocessing.get_context('spawn')  #not fork - don't drag our threads & SDL state along
+        self.proc = ctx.Process(target=audioMain, name="audioProc", daemon=True,
+                                args=(self.ringShm.name, self.sampleShm.name, totalFrames, table, driver, fxConfig, kitNames, realtime))
+        self.proc.start()
+        self._reporter = threading.Thread(target=self._report, name="audioReport", daemon=True)
+        self._reporter.start()
+
+    def trigger(self, kit, samp, when, vol=1.0, group=0, note=-1):
+        """ queue a note to start at time.time() == when; it chokes any voices of the same kit & (non zero) group """
+        with self.lock:
+            write = self.idx[0]
+            if write - self.idx[1] >= RING_SLOTS:
+                self.dropped += 1   #audio process not keeping up (or dead)
+                return
+            self.events[write % RING_SLOTS] = (when, kit, samp, vol, group, note)
+            self.idx[0] = write + 1     #publish after the event is written
+
+    def noteOff(self, note, when):
+        """ fade out the voices started with this (live) note """
+        self.trigger(-1, NOTE_OFF, when, note=note)
+
+    def peakVoices(self):
+        return (int(self.stats[6]), int(self.stats[7]))
+
+    def clockLateness(self, lateness):
+        self.lateness.append(lateness)
+
+    def _report(self):
+        while True:
+            time.sleep(REPORT_SECS)
+            lateness, self.lateness = self.lateness, list()
+            (p50, p99, maxErr, late, underruns, numEvents, peakVoices, peakNatural) = self.stats
+            logging.info("Jitter (ms p50/p99/max) - clock lateness: %.2f/%.2f/%.2f;  audio process placement error: "
+                         "%.2f/%.2f/%.2f (%d of last %d notes late; %d notes total, %d underruns, %d dropped; "
+                         "peak voices %d, %d without choke groups & gate)",
+                         *percentiles(lateness), p50, p99, maxErr, late, ERROR_WINDOW, numEvents, underruns, self.dropped,
+                         peakVoices, peakNatural)
+
+    def close(self):
+        self.idx[2] = 1     #ask it to stop - SDL in there swallows a SIGTERM
+        self.proc.join(1)
+        if self.proc.is_alive():
+            self.proc.kill()
+            self.proc.join(1)
+        for shm in (self.ringShm, self.sampleShm):
+            shm.unlink()    #just the name - other threads may still touch the mapping until we exit
+
+def audioMain(ringName, sampleName, totalFrames, table, driver, fxConfig=None, kitNames=None, realtime=None):
+    """ audio process entry point """
+    logging.basicConfig(format='%(asctime)s:%(levelname)s:audioProc:%(message)s', datefmt='%I:%M:%S %p', level=logging.INFO)
+    if realtime is not None:    #before the mixer starts, so SDL's audio thread inherits it too
+        seqRealtime.Realtime(**realtime).promoteAudio('audio')
+    if driver is None:
+        os.environ.pop("SDL_AUDIODRIVER", None)
+    else:
+        os.environ["SDL_AUDIODRIVER"] = driver
+    import pygame
+    pygame.mixer.init(frequency=MIX_RATE, size=-16, channels=MIX_CHANS, buffer=BLOCK_FRAMES, allowedchanges=0)
+    ringShm = shared_memory.SharedMemory(name=ringName)
+    idx, stats, events = ringViews(ringShm.buf)
+    sampleShm, samples = mapKits(sampleName, totalFrames, MIX_CHANS, table)
+    fx = None
+    if fxConfig is not None:
+        fx = fxBus.FxBus(fxConfig, kitNames, MIX_RATE, BLOCK_FRAMES, MIX_CHANS)
+    AudioEngine(idx, stats, events, samples, pygame.mixer.Channel(0), pygame.mixer.Sound, fx).run()
+
+class AudioEngine():
+    """ audio process side - drains the ring & mixes blocks onto one output channel """
+    def __init__(self, idx, stats, events, samples, channel, makeSound, fx=None):
+        self.idx, self.stats, self.events = idx, stats, events
+        self.samples = samples
+        self.channel = channel
+        self.makeSound = makeSound
+        self.fx = fx            #fxBus.FxBus or None
+        self.voices = list()    #[start frame, sample frames, vol, position, kit, choke group, note, fade start frame, id]
+        self.counter = seqVoices.VoiceCounter()     #(in stream frames)
+        self.numVoices = 0
+        self.rampFrames = numpy.arange(BLOCK_FRAMES, dtype=numpy.float32)
+        self.blockFrame = 0     #stream frame of the next block to render
+        self.t0 = None          #time.time() of stream frame 0
+        self.mix = numpy.zeros((BLOCK_FRAMES, MIX_CHANS), dtype=numpy.float32)
+        self.errors = collections.deque(maxlen=ERROR_WINDOW)
+        self.lastReport = time.time()
+        self.lastFxReport = time.time()
+        self.parentPid = os.getppid()
+
+    def run(self):
+        while not self.idx[2]:
+            self.drain()
+            if not self.channel.get_busy():     #(re)start the stream - first time, or we ran dry
+                if self.t0 is not None:
+                    self.stats[4] += 1
+                self.t0 = time.time() - self.blockFrame / MIX_RATE
+                self.channel.play(self.render())
+            if self.channel.get_queue() is None:
+                self.channel.queue(self.render())
+            if time.time() - self.lastReport > 1:
+                self.report()
+                if os.getppid() != self.parentPid:
+                    return  #control process is gone
+            time.sleep(POLL_SECS)
+
+    def drain(self):
+        read, write = self.idx[1], self.idx[0]
+        while read < write:
+            (when, kit, samp, vol, group, note) = self.events[read % RING_SLOTS]
+            read += 1
+            startFrame = int(round((when - self.t0) * MIX_RATE)) if self.t0 is not None else 0
+            if samp == NOTE_OFF:
+                for voice in self.voices:
+                    if voice[6] == note:
+                        self.fade(voice, startFrame)
+                continue
+            try:
+                data = self.samples[kit][samp]
+            except IndexError:
+                continue
+            if group:
+                for voice in self.voices:
+                    if voice[4] == kit and voice[5] == group:
+                        self.fade(voice, startFrame)
+            if len(self.voices) >= MAX_VOICES:
+                del self.voices[0]  #steal the oldest
+            self.numVoices += 1
+            self.voices.append([startFrame, data, float(vol), 0, kit, int(group), int(note), None, self.numVoices])
+            self.counter.started(self.numVoices, startFrame, startFrame + len(data))
+            self.stats[5] += 1
+        self.idx[1] = read
+        self.stats[6] = self.counter.peak
+        self.stats[7] = self.counter.peakNatural
+
+    def fade(self, voice, fromFrame):
+        """ start fading a voice out (choked or note off) """
+        voice[7] = max(fromFrame, voice[0])
+        voice[5] = 0    #done with - don't fade it again
+        voice[6] = -1
+        self.counter.cut(voice[8], voice[7] + FADE_FRAMES)
+
+    def render(self):
+        """ mix the next block; returns it as a Sound """
+        if self.fx is not None:
+            self.fx.begin()
+        else:
+            mix = self.mix
+            mix.fill(0)
+        blockStart = self.blockFrame
+        #keep the stream clock locked to wall time - the device clock drifts (& the dummy driver is way off)
+        ahead = self.t0 + blockStart / MIX_RATE - time.time()
+        if ahead < 0 or ahead > 3 * BLOCK_FRAMES / MIX_RATE:
+            self.t0 -= ahead - BLOCK_FRAMES / MIX_RATE
+            self.reanchor(ahead)
+        for voice in self.voices:
+            startFrame, data, vol, pos, kit, group, note, fadeStart, voiceId = voice
+            if pos == 0:
+                if startFrame >= blockStart + BLOCK_FRAMES:
+                    continue    #not yet
+                offset = startFrame - blockStart
+                if offset < 0:  #arrived too late for its frame - start it now
+                    self.errors.append(-offset / MIX_RATE)
+                    offset = 0
+                else:
+                    self.errors.append(0.0)
+            else:
+                offset = 0
+            num = min(BLOCK_FRAMES - offset, len(data) - pos)
+            if self.fx is not None:
+                mix = self.fx.kitBuffer(kit)
+            if fadeStart is None:
+                mix[offset:offset + num] += data[pos:pos + num] * vol
+            else:   #linear fade to silence from fadeStart
+                ramp = 1 - (self.rampFrames[offset:offset + num] + (blockStart - fadeStart)) / FADE_FRAMES
+                numpy.clip(ramp, 0, 1, out=ramp)
+                mix[offset:offset + num] += data[pos:pos + num] * (ramp * vol)[:, numpy.newaxis]
+            voice[3] = pos + num
+            if voice[3] == 0:
+                voice[3] = -1   #zero length sample - mark as done
+            elif fadeStart is not None and blockStart + offset + num >= fadeStart + FADE_FRAMES:
+                voice[3] = -1   #faded out - done
+        self.voices = [voice for voice in self.voices if voice[3] == 0 or 0 < voice[3] < len(voice[1])]
+        if self.fx is not None:
+            mix = self.fx.process()
+        self.blockFrame += BLOCK_FRAMES
+        return self.makeSound(buffer=numpy.clip(mix, -32768, 32767).astype(numpy.int16).tobytes())
+
+    def reanchor(self, ahead):
+        """ voices waiting to start keep their wall time when the stream clock moves """
+        shift = int(round((ahead - BLOCK_FRAMES / MIX_RATE) * MIX_RATE))
+        for voice in self.voices:
+            if voice[3] == 0:
+                voice[0] += shift
+
+    def report(self):
+        """ publish placement error stats for the control process to log """
+        self.lastReport = time.time()
+        if self.errors:
+            self.stats[0:3] = percentiles(self.errors)
+            self.stats[3] = sum(1 for err in self.errors if err > 0)
+        if self.fx is not None and self.lastReport - self.lastFxReport > REPORT_SECS:
+            self.lastFxReport = self.lastReport
+            logging.info(self.fx.costReport())
@@ -0,0 +1,420 @@
+import os
+import sys
+import time
+import json
+import math
+import wave
+import shutil
+import tempfile
+import argparse
+import datetime
+import platform
+import subprocess
+import statistics
+import threading
+import tracemalloc
+import gc
+import logging
+
+"""
+Microbenchmarks of the sequencer hot paths, with saved baselines & regression gating
+
+    python3 code/benchSeq.py run [--save NAME]          run everything (or --only a,b) & optionally save as a baseline
+    python3 code/benchSeq.py compare BASE [NEW]          compare two saved baselines (or BASE against a fresh run)
+    python3 code/benchSeq.py allocs [--ticks N]          check the clock's tick leaves no allocations behind
+
+Run from the top of the repo (like sampleSeq.py) - baselines are saved to benchmarks/<NAME>.json along with the
+git revision, python & platform, so a baseline is only compared against runs from the same kind of machine.
+Each benchmark is timed REPEATS times; compare flags a regression when the median is more than --threshold slower
+AND a Mann-Whitney U test says the difference is significant (p < --alpha).  compare exits 1 on any regression.
+
+allocs plays the rock sequence (with metronome) on the real clock for a while, then runs more ticks under tracemalloc
+and lists any allocations that pile up with the number of ticks - in steady state there should be none; exits 1 if
+there are.
+
+Runs headless - SDL is pointed at its dummy video & audio drivers, and notes go to a null sound.
+"""
+
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+os.environ["SDL_AUDIODRIVER"] = "dummy"
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pygame
+import sampleSeq
+import seqLog
+import seqRealtime
+import keyInput
+
+benchDir = 'benchmarks/'
+REPEATS = 20
+MIN_RUN_SECS = 0.02     #each repeat loops the benchmark enough times to take at least this long
+DEFAULT_THRESHOLD = 0.10     #busy machines easily wobble 5%
+DEFAULT_ALPHA = 0.01
+
+class NullSound():
+    """ audio sink that does nothing - keeps the mixer out of the numbers """
+    def __init__(self, length=0.1):
+        self.length = length
+    def play(self):
+        return None
+    def get_length(self):
+        return self.length
+
+class NullChannel():
+    def set_volume(self, volume):
+        pass
+    def play(self, sound):
+        pass
+
+class NullDisplay():
+    def updateTime(self, meas, beat):
+        pass
+    def updateSettings(self, bpm, sampSet, seqNum, rcd):
+        pass
+
+class NullSampleSet():
+    def __init__(self, numSamples=16, length=0.1):
+        self.sampleDir = 'null'
+        self.sampleNames = [str(x) for x in range(numSamples)]
+        self.sampleSounds = [NullSound(length) for x in range(numSamples)]
+        self.padTune = dict()
+        self.noteMap = dict()
+        self.chokes = dict()
+        self.resolved = dict()
+
+class NullSampleMgr():
+    def __init__(self):
+        self.currSampleDir = 0
+        self.sampleSets = [NullSampleSet()]
+        self.sampleDirs = ['null']
+        self.metro = pygame.mixer.Sound(buffer=bytes(256))    #channel.play() needs a real Sound - a silent one
+        self.chime = self.metro
+        self.sceneTune = []
+    resolve = sampleSeq.SampleMgr.resolve
+    resolveRef = sampleSeq.SampleMgr.resolveRef
+    def index(self, name):
+        return 0
+
+def timeSigArgs(bpm=120, numMeasures=4, numBeats=4, numSubBeats=4):
+    return {'bpm': bpm, 'numMeasures': numMeasures, 'numBeats': numBeats, 'numSubBeats': numSubBeats}
+
+def makeSeqMgr():
+    seqMgr = sampleSeq.SequenceMgr(timeSigArgs())
+    seqMgr.currSeq = sampleSeq.Sequence('savedSequences/rock.json')
+    return seqMgr
+
+"""
+Benchmarks - each setup function returns the function to be timed (one "op")
+"""
+def benchAdvanceTime():
+    seqTime = makeSeqMgr().seqTime
+    def op():
+        seqTime.advanceTime()
+        seqTime.tick
+    return op
+
+def benchInterval():
+    seqMgr = makeSeqMgr()
+    def op():
+        seqMgr.interval
+    return op
+
+def benchAdvanceSequence():
+    seqMgr = makeSeqMgr()
+    seqTime = seqMgr.seqTime
+    def op():
+        seqTime.advanceTime()
+        seqMgr.advanceSequence()
+    return op
+
+def benchAddDelNote():
+    seq = sampleSeq.Sequence(timeSigArgs())
+    def op():
+        seq.addNote(5, 37)
+        seq.delNote()
+    return op
+
+def benchStoreLoadSeq():
+    seqMgr = makeSeqMgr()
+    def op():
+        seqMgr.storeSeq(1)
+        seqMgr.loadSeq(1)
+    return op
+
+def benchParseKey():
+    keyHandler = sampleSeq.KeyEventHandler()
+    events = [pygame.event.Event(pygame.KEYDOWN, key=pygame.K_KP_MULTIPLY),
+              pygame.event.Event(pygame.KEYDOWN, key=pygame.K_KP5),
+              pygame.event.Event(pygame.KEYUP, key=pygame.K_KP_MULTIPLY),
+              pygame.event.Event(pygame.KEYDOWN, key=pygame.K_KP_PLUS)]
+    def op():
+        for event in events:
+            keyHandler.parseKey(event)
+    return op
+
+def benchKeyToAction():
+    """ a (fake) key press until its action is done - through the key loop thread, as a keypad press would go """
+    seqMgr = makeSeqMgr()
+    keys = keyInput.FakeKeys()
+    done = threading.Event()
+    def handleCtl(keyEvent):
+        seqMgr.handleCtl(keyEvent)  #(metronome on/off)
+        done.set()
+    threading.Thread(target=keyInput.keyLoop, args=(keys, sampleSeq.KeyEventHandler(), handleCtl),
+                     name="keys", daemon=True).start()
+    def op():
+        done.clear()
+        keys.tap(pygame.K_KP_PERIOD)
+        done.wait()
+    return op
+
+def benchLoadSeqFile():
+    def op():
+        sampleSeq.Sequence('savedSequences/rock.json')
+    return op
+
+def benchFindSamples():
+    """ synthetic kit tree - 8 kits of 16 short wavs, plus the metronome """
+    topDir = tempfile.mkdtemp(prefix='benchSeq') + '/'
+    frames = b'\x00\x00' * 2205     #0.1s mono 22050Hz
+    for kit in ['kit{0}'.format(x) for x in range(8)] + ['ZZ_Metronome']:
+        os.makedirs(topDir + kit)
+        names = ['{0:03d}'.format(x) for x in range(16)] + ['metronome', 'triangle10']
+        for name in names:
+            with wave.open(topDir + kit + '/' + name + '.wav', 'wb') as wavFile:
+                wavFile.setnchannels(1)
+                wavFile.setsampwidth(2)
+                wavFile.setframerate(22050)
+                wavFile.writeframes(frames)
+    def op():
+        (topSampleDir, metroDir) = (sampleSeq.topSampleDir, sampleSeq.metroDir)
+        sampleSeq.topSampleDir = topDir
+        sampleSeq.metroDir = topDir + 'ZZ_Metronome/'
+        try:
+            sampleSeq.SampleMgr().findSamples()
+        finally:    #later benchmarks (& anything else in this process) see the real sample dirs
+            (sampleSeq.topSampleDir, sampleSeq.metroDir) = (topSampleDir, metroDir)
+    op.cleanup = lambda: shutil.rmtree(topDir)
+    return op
+
+BENCHMARKS = {
+    'advanceTime': benchAdvanceTime,
+    'interval': benchInterval,
+    'advanceSequence': benchAdvanceSequence,
+    'addDelNote': benchAddDelNote,
+    'storeLoadSeq': benchStoreLoadSeq,
+    'parseKey': benchParseKey,
+    'keyToAction': benchKeyToAction,
+    'loadSeqFile': benchLoadSeqFile,
+    'findSamples': benchFindSamples,
+}
+
+def timeOp(op):
+    """ returns REPEATS samples of ns per op """
+    loops = 1
+    while True:     #calibrate the loop count, like timeit.autorange
+        start = time.perf_counter()
+        for x in range(loops):
+            op()
+        if time.perf_counter() - start >= MIN_RUN_SECS:
+            break
+        loops *= 2
+    samples = list()
+    for rep in range(REPEATS):
+        start = time.perf_counter()
+        for x in range(loops):
+            op()
+        samples.append((time.perf_counter() - start) / loops * 1e9)
+    return samples
+
+def runBenchmarks(only=None):
+    pygame.mixer.init()
+    sampleSeq.display = NullDisplay()
+    sampleSeq.sampMgr = NullSampleMgr()
+    results = dict()
+    for name, setup in BENCHMARKS.items():
+        if only and name not in only:
+            continue
+        op = setup()
+        results[name] = timeOp(op)
+        if hasattr(op, 'cleanup'):
+            op.cleanup()
+        print("{0:<16} median {1:>12.0f}ns  (stdev {2:.0f})".format(name, statistics.median(results[name]),
+                                                                     statistics.stdev(results[name])))
+    return results
+
+ALLOC_BPM = 1500     #10ms half ticks with the rock sequence - quick, but still leaves the clock slack to collect in
+DEFAULT_ALLOC_TICKS = 512
+MIN_ALLOC_CYCLES = 8    #times round the sequence per window
+ALLOC_WARMUP_CYCLES = 4    #times round the sequence before checking - the rings (one time round) are full by then
+ALLOC_WINDOWS = 3       #growth must show in every one of these windows - the snapshots' own noise doesn't
+
+def allocTicker(numTicks):
+    """
+    the clock, set up to play the rock sequence (with metronome) for allocation checks.  Returns (runTicks, numTicks):
+    runTicks(num) plays num half ticks - the real thing, the clock's own timer chain through SequenceMgr._run with the
+    flight recorder, tick stats & real-time gc scheduling - then pauses it (from the clock thread, once a tick is done)
+    and collects, so the process is quiet until the next call.  numTicks is rounded to whole times round the sequence.
+    Already warmed up when it returns
+    """
+    pygame.mixer.init()
+    sampleSeq.display = NullDisplay()
+    sampleSeq.sampMgr = NullSampleMgr()
+    sampleSeq.sampMgr.sampleSets = [NullSampleSet(length=0.0)]   #voices end at once, so the voice list stays put
+    seqMgr = makeSeqMgr()
+    seqMgr.beatsPerMinute = ALLOC_BPM
+    seqMgr.metroChan = NullChannel()    #no mixer thread running alongside tracemalloc
+    cycle = 2 * seqMgr.seqTime.numTicks    #half ticks round the sequence
+    numTicks = max(MIN_ALLOC_CYCLES * cycle, numTicks // cycle * cycle)    #whole times round, so we end where we started
+    #rings sized to fill within the warm up - steady state from then on
+    seqLog.flight = seqLog.FlightRecorder(cycle)
+    seqMgr.realtime = seqRealtime.Realtime()
+    seqRealtime.REPORT_SECS = 1e6   #no report (numpy & logging) in the middle of a check
+    seqMgr.tickStats = seqRealtime.TickStats(seqMgr.realtime, window=cycle)
+
+    ticks = [0, numTicks]   #ticks done, pause after
+    paused = threading.Event()
+    idle = seqMgr.realtime.idle
+    def pausingIdle(nextCall):  #last thing in _run - the next tick's timer is already running
+        idle(nextCall)
+        ticks[0] += 1
+        if ticks[0] == ticks[1]:
+            seqMgr._timer.cancel()
+            paused.set()
+    seqMgr.realtime.idle = pausingIdle
+    def runTicks(num):
+        ticks[:] = [0, num]
+        paused.clear()
+        seqMgr.is_running = False   #(paused, not stopped - keeps the real-time gc state)
+        seqMgr.start()
+        paused.wait()
+        time.sleep(0.1)     #let the cancelled timer's thread finish
+        gc.collect()        #a full collection empties the free lists too - their high water mark isn't a leak
+    runTicks(ALLOC_WARMUP_CYCLES * cycle)
+    return runTicks, numTicks
+
+def checkAllocs(numTicks):
+    """
+    returns [(file:line, blocks per tick)] of allocations left behind by steady-state ticks (empty if none)
+    The snapshots themselves shuffle the interpreter's free lists, so every window shows a few blocks either way; any
+    line whose blocks grow in every window is left behind by the ticks.  (tstAllocs.py is the strict check - net blocks)
+    """
+    runTicks, numTicks = allocTicker(numTicks)
+    tracemalloc.start(8)
+    runTicks(numTicks)      #traced once first - objects from untraced ticks that are still about aren't counted
+    snapshots = [tracemalloc.take_snapshot()]
+    for window in range(ALLOC_WINDOWS):
+        runTicks(numTicks)
+        snapshots.append(tracemalloc.take_snapshot())
+    tracemalloc.stop()
+    notOurs = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    snapshots = [snapshot.filter_traces(notOurs) for snapshot in snapshots]
+    windows = [{str(stat.traceback[0]): stat.count_diff for stat in after.compare_to(before, 'lineno')}
+               for before, after in zip(snapshots, snapshots[1:])]
+    grown = [(where, sum(window[where] for window in windows) / (ALLOC_WINDOWS * numTicks)) for where in windows[0]
+             if all(window.get(where, 0) > 0 for window in windows)]
+    print("{0} windows of {1} ticks: {2} blocks left allocated".format(
+        ALLOC_WINDOWS, numTicks, ', '.join("{0:+d}".format(sum(window.values())) for window in windows)))
+    for where, perTick in sorted(grown, key=lambda item: -item[1]):
+        print("  {0:+.3f} blocks per tick  {1}".format(perTick, where))
+    return grown
+
+def gitRevision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+def saveBaseline(name, results):
+    os.makedirs(benchDir, exist_ok=True)
+    baseline = {'name': name, 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                'revision': gitRevision(), 'python': platform.python_version(), 'machine': platform.platform(),
+                'results': results}
+    with open(benchDir + name + '.json', mode='w') as outFile:
+        json.dump(baseline, outFile, indent=4)
+    print("Saved baseline:", benchDir + name + '.json')
+
+def loadBaseline(name):
+    with open(benchDir + name + '.json') as inFile:
+        return json.load(inFile)
+
+def mannWhitneyP(a, b):
+    """ two sided p-value of the Mann-Whitney U test (normal approximation with tie correction) """
+    ranked = sorted([(x, 0) for x in a] + [(x, 1) for x in b])
+    ranks = [0.0] * len(ranked)
+    ties = 0.0
+    i = 0
+    while i < len(ranked):  #average rank for runs of equal values
+        j = i
+        while j + 1 < len(ranked) and ranked[j + 1][0] == ranked[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2 + 1
+        ties += (j - i + 1) ** 3 - (j - i + 1)
+        i = j + 1
+    n1, n2 = len(a), len(b)
+    n = n1 + n2
+    u = sum(rank for rank, (x, group) in zip(ranks, ranked) if group == 0) - n1 * (n1 + 1) / 2
+    sigma = math.sqrt(n1 * n2 / 12 * ((n + 1) - ties / (n * (n - 1))))
+    if sigma == 0:
+        return 1.0
+    z = (u - n1 * n2 / 2) / sigma
+    return math.erfc(abs(z) / math.sqrt(2))
+
+def compare(base, new, threshold, alpha):
+    """ print a comparison table, returns the names of regressed benchmarks """
+    print("{0:<16} {1:>12} {2:>12} {3:>8} {4:>8}".format('benchmark', base['name'], new['name'], 'change', 'p'))
+    regressions = list()
+    for name, baseSamples in base['results'].items():
+        if name not in new['results']:
+            continue
+        newSamples = new['results'][name]
+        baseMedian = statistics.median(baseSamples)
+        newMedian = statistics.median(newSamples)
+        change = newMedian / baseMedian - 1
+        p = mannWhitneyP(baseSamples, newSamples)
+        flag = ''
+        if p < alpha and change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        elif p < alpha and change < -threshold:
+            flag = '  faster'
+        print("{0:<16} {1:>10.0f}ns {2:>10.0f}ns {3:>+7.1%} {4:>8.4f}{5}".format(name, baseMedian, newMedian,
+                                                                                change, p, flag))
+    if base.get('machine') != new.get('machine'):
+        print("WARNING: baselines are from different machines:", base.get('machine'), "vs", new.get('machine'))
+    return regressions
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)  #keep the sequencer's info logging out of the numbers
+    parser = argparse.ArgumentParser(description="Sequencer microbenchmarks")
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    runParser = sub.add_parser('run', help="run the benchmarks")
+    runParser.add_argument("--save", metavar="NAME", help="save the results as baseline NAME")
+    runParser.add_argument("--only", help="comma separated list of benchmarks to run: " + ','.join(BENCHMARKS))
+    cmpParser = sub.add_parser('compare', help="compare baselines; exits 1 on regression")
+    cmpParser.add_argument("base", help="baseline name")
+    cmpParser.add_argument("new", nargs='?', help="baseline name (default: run the benchmarks now)")
+    cmpParser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="min slowdown that counts (fraction)")
+    cmpParser.add_argument("--alpha", type=float, default=DEFAULT_ALPHA, help="significance level")
+    allocParser = sub.add_parser('allocs', help="check steady-state ticks leave nothing allocated; exits 1 if they do")
+    allocParser.add_argument("--ticks", type=int, default=DEFAULT_ALLOC_TICKS, help="half ticks to check")
+    args = parser.parse_args()
+
+    if args.cmd == 'run':
+        results = runBenchmarks(args.only.split(',') if args.only else None)
+        if args.save:
+            saveBaseline(args.save, results)
+    elif args.cmd == 'allocs':
+        if checkAllocs(args.ticks):
+            sys.exit(1)
+    else:
+        base = loadBaseline(args.base)
+        if args.new:
+            new = loadBaseline(args.new)
+        else:
+            new = {'name': 'current', 'machine': platform.platform(), 'results': runBenchmarks(list(base['results']))}
+        regressions = compare(base, new, args.threshold, args.alpha)
+        if regressions:
+            print("Regressed:", ', '.join(regressions))
+            sys.exit(1)
@@ -0,0 +1,105 @@
+import asyncio
+import threading
+import json
+import logging
+import os
+
+"""
+Local control server - bulk pattern/bank upload & remote control without going through files
+
+Listens on localhost TCP (--ctlPort=<port>) or a Unix socket (--ctlSocket=<path>).
+The protocol is one JSON document per line; each line is a batch - either a single cmd object or a list of them:
+    {"cmd": "storeSeq", "slot": 3, "seq": {"timeSig": {...}, "noteList": [...]}}   upload a sequence into bank 0-9
+    {"cmd": "loadSeq", "slot": 3}           make bank 3 the current sequence
+    {"cmd": "bpm", "value": 128}
+    {"cmd": "swing", "value": true}
+    {"cmd": "sample", "value": "808"}       sample set by name or index
+    {"cmd": "scene", "value": 1}
+    {"cmd": "state"}                        query the sequencer state
+Each line gets one reply line, in order: {"ok": true, "results": [...]} or {"ok": false, "error": "..."}
+
+All cmds in a batch are validated (and sequences built) in the server thread first; if any is bad nothing is applied.
+The clock thread then applies the whole batch between two ticks - after a tick's notes have played, and only while
+there's time before the next one (batches that don't fit wait for the next tick - for up to a bar, then they're applied
+anyway).  Clients may pipeline - lines keep being read while
+earlier batches wait for their tick, so throughput isn't limited by the tick rate.
+Preparing & applying batches holds seqMgr.ctlLock, as keypad & midi scene changes do - so they never interleave.
+"""
+
+class CtlServer(threading.Thread):
+    """ asyncio control server, run in its own (daemon) thread with its own event loop """
+    def __init__(self, seqMgr, port=None, path=None):
+        threading.Thread.__init__(self, name="ctlServer", daemon=True)
+        self.seqMgr = seqMgr
+        self.port = port
+        self.path = path
+        self.start()
+
+    def run(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        if self.path is not None:
+            if os.path.exists(self.path):
+                os.unlink(self.path)    #stale socket from a previous run
+            server = await asyncio.start_unix_server(self._handleClient, path=self.path)
+            logging.info("Control server listening on %s", self.path)
+        else:
+            server = await asyncio.start_server(self._handleClient, host='127.0.0.1', port=self.port)
+            logging.info("Control server listening on 127.0.0.1:%s", self.port)
+        async with server:
+            await server.serve_forever()
+
+    async def _handleClient(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        replies = asyncio.Queue()   #futures, in request order
+        replyTask = asyncio.create_task(self._writeReplies(replies, writer))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    replies.put_nowait(self._submit(line, loop))
+        except ConnectionError:
+            pass
+        finally:
+            replies.put_nowait(None)
+            await replyTask
+            writer.close()
+
+    def _submit(self, line, loop):
+        """ parse & prepare a batch, queue it for the clock.  Returns a future of the reply """
+        fut = loop.create_future()
+        try:
+            cmds = json.loads(line)
+            if isinstance(cmds, dict):
+                cmds = [cmds]
+            batch = [self.seqMgr.prepareCmd(cmd) for cmd in cmds]
+        except (ValueError, TypeError) as ex:
+            fut.set_result({'ok': False, 'error': str(ex)})
+            return fut
+
+        def done(results):  #called on the clock thread
+            loop.call_soon_threadsafe(fut.set_result, results)
+        self.seqMgr.queueBatch(batch, done)
+        return fut
+
+    async def _writeReplies(self, replies, writer):
+        while True:
+            fut = await replies.get()
+            if fut is None:
+                break
+            results = await fut
+            if isinstance(results, Exception):
+                reply = {'ok': False, 'error': str(results)}
+            elif isinstance(results, dict):
+                reply = results
+            else:
+                reply = {'ok': True, 'results': results}
+            writer.write(json.dumps(reply, separators=(',', ':')).encode() + b'\n')
+            if replies.empty():
+                try:
+                    await writer.drain()    #only wait on the socket once caught up
+                except ConnectionError:
+                    break
@@ -0,0 +1,333 @@
+import json
+import math
+import time
+import logging
+import numpy
+
+"""
+Block based effects bus - biquad filters, compressor/limiter & a reverb send, per kit and on the master
+
+Everything works on whole blocks (frames x chans float32) with vectorized numpy; nothing loops per sample in python:
+  Biquad     the filter's response to a block is exactly (impulse response Toeplitz matrix) @ block + (state matrix) @
+             last block's 2 in/out frames, so a block is one matrix multiply
+  Compressor gain is computed per SUB_FRAMES sub-block from its peak, smoothed (attack/release) over the sub-blocks and
+             interpolated across the frames.  A Limiter is a fast infinite ratio compressor with a hard ceiling
+  Reverb     Schroeder style - parallel feedback combs into series allpasses.  All the delays are at least a block long,
+             so each block only depends on earlier ones
+Bypassed effects are taken out of their chain's active list, and a bus with nothing active hands back the dry mix
+untouched, so bypass costs nothing.  The time each effect takes per block is kept for costReport().
+
+The config (--fx FILE) is json:
+    {"kits": {"<kit name>": {"chain": [<effect>, ...], "send": <reverb send level>}, ...},
+     "master": [<effect>, ...],
+     "reverb": {"decay": <secs>, "wet": <level>}}
+    <effect> is {"type": "biquad"|"compressor"|"limiter", <its __init__ args>..., "bypass": true|false}
+"""
+
+SUB_FRAMES = 16     #compressor gain resolution
+
+def loadConfig(path):
+    with open(path) as configFile:
+        return json.load(configFile)
+
+def dbToGain(db):
+    return 10 ** (db / 20)
+
+class Effect():
+    """ base for effects - process() transforms a (frames x chans) float32 block in place, or returns a new one """
+    def __init__(self, name, bypass=False):
+        self.name = name
+        self.bypass = bypass
+        self.totalSecs = 0.0
+        self.maxSecs = 0.0
+        self.numBlocks = 0
+
+    def process(self, block):
+        raise NotImplementedError
+
+class Biquad(Effect):
+    """ RBJ cookbook biquad: lowpass, highpass, bandpass, peaking, lowshelf or highshelf """
+    def __init__(self, rate, blockFrames, chans, kind='lowpass', freq=1000.0, q=0.707, gainDb=0.0, bypass=False):
+        Effect.__init__(self, '{0} {1:g}Hz'.format(kind, freq), bypass)
+        b, a = self.coefficients(kind, freq / rate, q, gainDb)
+        #unit impulse response & the response to each of the 4 state values (x[-1], x[-2], y[-1], y[-2]) with no input
+        h = self.run(b, a, numpy.eye(1, blockFrames)[0], (0, 0, 0, 0))
+        toeplitz = numpy.zeros((blockFrames, blockFrames))
+        for lag in range(blockFrames):
+            toeplitz[numpy.arange(lag, blockFrames), numpy.arange(blockFrames - lag)] = h[lag]
+        zeros = numpy.zeros(blockFrames)
+        stateResp = [self.run(b, a, zeros, unit) for unit in numpy.eye(4)]
+        self.matrix = numpy.hstack([toeplitz, numpy.array(stateResp).T]).astype(numpy.float32)
+        self.state = numpy.zeros((4, chans), dtype=numpy.float32)
+        self.stacked = numpy.zeros((blockFrames + 4, chans), dtype=numpy.float32)
+
+    @staticmethod
+    def coefficients(kind, normFreq, q, gainDb):
+        w0 = 2 * math.pi * normFreq
+        cosW, alpha = math.cos(w0), math.sin(w0) / (2 * q)
+        A = 10 ** (gainDb / 40)
+        sqA = 2 * math.sqrt(A) * alpha
+        if kind == 'lowpass':
+            b, a = [(1 - cosW) / 2, 1 - cosW, (1 - cosW) / 2], [1 + alpha, -2 * cosW, 1 - alpha]
+        elif kind == 'highpass':
+            b, a = [(1 + cosW) / 2, -(1 + cosW), (1 + cosW) / 2], [1 + alpha, -2 * cosW, 1 - alpha]
+        elif kind == 'bandpass':
+            b, a = [alpha, 0, -alpha], [1 + alpha, -2 * cosW, 1 - alpha]
+        elif kind == 'peaking':
+            b, a = [1 + alpha * A, -2 * cosW, 1 - alpha * A], [1 + alpha / A, -2 * cosW, 1 - alpha / A]
+        elif kind == 'lowshelf':
+            b = [A * ((A + 1) - (A - 1) * cosW + sqA), 2 * A * ((A - 1) - (A + 1) * cosW), A * ((A + 1) - (A - 1) * cosW - sqA)]
+            a = [(A + 1) + (A - 1) * cosW + sqA, -2 * ((A - 1) + (A + 1) * cosW), (A + 1) + (A - 1) * cosW - sqA]
+        elif kind == 'highshelf':
+            b = [A * ((A + 1) + (A - 1) * cosW + sqA), -2 * A * ((A - 1) + (A + 1) * cosW), A * ((A + 1) + (A - 1) * cosW - sqA)]
+            a = [(A + 1) - (A - 1) * cosW + sqA, 2 * ((A - 1) - (A + 1) * cosW), (A + 1) - (A - 1) * cosW - sqA]
+        else:
+            raise ValueError("Unknown biquad type: " + kind)
+        return [x / a[0] for x in b], [x / a[0] for x in a]
+
+    @staticmethod
+    def run(b, a, x, state):
+        """ the plain per sample difference equation - only used to build the matrices """
+        x1, x2, y1, y2 = state
+        y = numpy.zeros(len(x))
+        for n in range(len(x)):
+            y[n] = b[0] * x[n] + b[1] * x1 + b[2] * x2 - a[1] * y1 - a[2] * y2
+            x1, x2, y1, y2 = x[n], x1, y[n], y1
+        return y
+
+    def process(self, block):
+        frames = len(block)
+        self.stacked[:frames] = block
+        self.stacked[frames:] = self.state
+        out = self.matrix @ self.stacked
+        self.state[0], self.state[1] = block[-1], block[-2]
+        self.state[2], self.state[3] = out[-1], out[-2]
+        return out
+
+class Compressor(Effect):
+    """ feed forward peak compressor """
+    def __init__(self, rate, blockFrames, chans, thresholdDb=-12.0, ratio=4.0, attackMs=5.0, releaseMs=100.0,
+                 makeupDb=0.0, bypass=False, name=None):
+        Effect.__init__(self, name or 'compressor {0:g}dB {1:g}:1'.format(thresholdDb, ratio), bypass)
+        if blockFrames % SUB_FRAMES:
+            raise ValueError("block size must be a multiple of {0}".format(SUB_FRAMES))
+        self.thresholdDb = thresholdDb
+        self.slope = 1 - 1 / ratio if ratio else 1.0    #ratio None/0: infinite (limiting)
+        subSecs = SUB_FRAMES / rate
+        self.attack = math.exp(-subSecs / (attackMs / 1000)) if attackMs > 0 else 0.0
+        self.release = math.exp(-subSecs / (releaseMs / 1000))
+        self.makeup = dbToGain(makeupDb)
+        self.gainDb = 0.0   #smoothed gain reduction at the end of the last block
+        self.numSubs = blockFrames // SUB_FRAMES
+        #interpolate from each sub-block's gain to the next's, across the frames
+        self.frameX = numpy.arange(blockFrames, dtype=numpy.float32)
+        self.subX = numpy.arange(-1, self.numSubs, dtype=numpy.float32) * SUB_FRAMES + SUB_FRAMES - 1
+        self.gainReduction = 0.0    #deepest reduction (dB) since last read, for reporting
+
+    def process(self, block):
+        peaks = numpy.abs(block).reshape(self.numSubs, -1).max(axis=1)
+        levelDb = 20 * numpy.log10(numpy.maximum(peaks, 1e-3) / 32768)
+        targetDb = numpy.minimum(0.0, (self.thresholdDb - levelDb) * self.slope)
+        gainsDb = [self.gainDb]
+        gainDb = self.gainDb
+        for target in targetDb.tolist():    #one step per sub-block, not per sample
+            coef = self.attack if target < gainDb else self.release
+            gainDb = target + coef * (gainDb - target)
+            gainsDb.append(gainDb)
+        self.gainDb = gainDb
+        self.gainReduction = min(self.gainReduction, gainDb)
+        gains = numpy.power(10, numpy.interp(self.frameX, self.subX, gainsDb) / 20, dtype=numpy.float32) * self.makeup
+        block *= gains[:, numpy.newaxis]
+        return block
+
+class Limiter(Compressor):
+    """ infinite ratio, fast attack compressor with a hard ceiling behind it for anything that still gets past """
+    def __init__(self, rate, blockFrames, chans, ceilingDb=-0.3, releaseMs=50.0, bypass=False):
+        Compressor.__init__(self, rate, blockFrames, chans, thresholdDb=ceilingDb, ratio=None, attackMs=0.0,
+                            releaseMs=releaseMs, bypass=bypass, name='limiter {0:g}dB'.format(ceilingDb))
+        self.ceiling = 32768 * dbToGain(ceilingDb)
+
+    def process(self, block):
+        block = Compressor.process(self, block)
+        return numpy.clip(block, -self.ceiling, self.ceiling, out=block)
+
+class DelayLine():
+    """ circular buffer of at least a block, read & written a whole block at a time """
+    def __init__(self, frames, blockFrames, chans):
+        self.buf = numpy.zeros((max(frames, blockFrames), chans), dtype=numpy.float32)
+        self.pos = 0
+        self.blockIdx = numpy.arange(blockFrames)
+
+    def indices(self, frames):
+        idx = (self.pos + self.blockIdx[:frames]) % len(self.buf)
+        self.pos = (self.pos + frames) % len(self.buf)
+        return idx
+
+class Reverb(Effect):
+    """ Schroeder reverb - 4 feedback combs in parallel, then 2 allpasses; the right channel's delays are a bit longer """
+    COMB_SECS = (0.0253, 0.0269, 0.0290, 0.0307)
+    ALLPASS_SECS = (0.0126, 0.0100)
+    ALLPASS_GAIN = 0.5
+    STEREO_SPREAD = 0.0005
+
+    def __init__(self, rate, blockFrames, chans, decay=1.2, wet=0.3, bypass=False):
+        Effect.__init__(self, 'reverb {0:g}s'.format(decay), bypass)
+        self.wet = wet / len(self.COMB_SECS)
+        self.combs = list()     #[(delay line, feedback)] per channel
+        self.allpasses = list()
+        for chan in range(chans):
+            spread = chan * self.STEREO_SPREAD
+            combs = list()
+            for secs in self.COMB_SECS:
+                line = DelayLine(int((secs + spread) * rate), blockFrames, 1)
+                feedback = 10 ** (-3 * len(line.buf) / rate / decay)    #-60dB after decay secs
+                combs.append((line, feedback))
+            self.combs.append(combs)
+            self.allpasses.append([DelayLine(int((secs + spread) * rate), blockFrames, 1) for secs in self.ALLPASS_SECS])
+
+    def process(self, block):
+        out = numpy.empty_like(block)
+        for chan in range(block.shape[1]):
+            x = block[:, chan:chan + 1]
+            y = numpy.zeros_like(x)
+            for line, feedback in self.combs[chan]:     #y[n] = x[n] + g.y[n-D]
+                idx = line.indices(len(x))
+                comb = x + feedback * line.buf[idx]
+                line.buf[idx] = comb
+                y += comb
+            for line in self.allpasses[chan]:   #v[n] = x[n] + g.v[n-D];  y[n] = v[n-D] - g.v[n]
+                idx = line.indices(len(y))
+                old = line.buf[idx]
+                v = y + self.ALLPASS_GAIN * old
+                line.buf[idx] = v
+                y = old - self.ALLPASS_GAIN * v
+            out[:, chan:chan + 1] = y * self.wet
+        return out
+
+EFFECT_TYPES = {'biquad': Biquad, 'compressor': Compressor, 'limiter': Limiter}
+
+class Chain():
+    """ effects run in series - only the ones not bypassed """
+    def __init__(self, name, effects):
+        self.name = name
+        self.effects = effects
+        self.updateActive()
+
+    @classmethod
+    def fromConfig(cls, name, config, rate, blockFrames, chans):
+        effects = list()
+        for effectArgs in config:
+            effectArgs = dict(effectArgs)
+            effectType = effectArgs.pop('type')
+            if effectType not in EFFECT_TYPES:
+                raise ValueError("Unknown effect type: {0}".format(effectType))
+            effects.append(EFFECT_TYPES[effectType](rate, blockFrames, chans, **effectArgs))
+        return cls(name, effects)
+
+    def updateActive(self):
+        self.active = [effect for effect in self.effects if not effect.bypass]
+
+    def setBypass(self, index, bypass):
+        self.effects[index].bypass = bypass
+        self.updateActive()
+
+    def process(self, block):
+        for effect in self.active:
+            startTime = time.perf_counter()
+            block = effect.process(block)
+            took = time.perf_counter() - startTime
+            effect.totalSecs += took
+            effect.maxSecs = max(effect.maxSecs, took)
+            effect.numBlocks += 1
+        return block
+
+class FxBus():
+    """
+    Kits with an active chain or a reverb send get a buffer of their own (kitBuffer); the rest mix straight into the
+    master.  Per block: begin(), mix each kit's voices into kitBuffer(kit), then process() returns the master block
+    """
+    def __init__(self, config, kitNames, rate, blockFrames, chans):
+        self.blockFrames = blockFrames
+        self.blockSecs = blockFrames / rate
+        self.master = numpy.zeros((blockFrames, chans), dtype=numpy.float32)
+        self.masterChain = Chain.fromConfig('master', config.get('master', []), rate, blockFrames, chans)
+        reverbArgs = dict(config.get('reverb', dict()))
+        self.reverb = Chain('reverb', [Reverb(rate, blockFrames, chans, **reverbArgs)])
+        self.kitChains = dict()     #kit index -> (chain, reverb send level, buffer)
+        kitConfigs = config.get('kits', dict())
+        for kit, name in enumerate(kitNames):
+            if name in kitConfigs:
+                kitConfig = kitConfigs[name]
+                chain = Chain.fromConfig(name, kitConfig.get('chain', []), rate, blockFrames, chans)
+                self.kitChains[kit] = (chain, float(kitConfig.get('send', 0.0)),
+                                       numpy.zeros((blockFrames, chans), dtype=numpy.float32))
+        unknown = set(kitConfigs) - set(kitNames)
+        if unknown:
+            logging.warning("Effects config for unknown kits: %s", sorted(unknown))
+        self.sendBuf = numpy.zeros((blockFrames, chans), dtype=numpy.float32)
+        self.updateActive()
+        self.totalSecs = 0.0
+        self.numBlocks = 0
+
+    def updateActive(self):
+        """ call after changing bypass/send settings """
+        self.activeKits = {kit: entry for kit, entry in self.kitChains.items() if entry[0].active or entry[1]}
+        self.useReverb = bool(self.reverb.active) and any(entry[1] for entry in self.activeKits.values())
+        self.active = bool(self.activeKits or self.masterChain.active)
+
+    def chains(self):
+        return [entry[0] for entry in self.kitChains.values()] + [self.reverb, self.masterChain]
+
+    def begin(self):
+        self.master.fill(0)
+        for chain, send, buf in self.activeKits.values():
+            buf.fill(0)
+
+    def kitBuffer(self, kit):
+        entry = self.activeKits.get(kit)
+        return entry[2] if entry is not None else self.master
+
+    def process(self):
+        if not self.active:
+            return self.master  #all bypassed - untouched
+        startTime = time.perf_counter()
+        master = self.master
+        if self.useReverb:
+            self.sendBuf.fill(0)
+        for chain, send, buf in self.activeKits.values():
+            out = chain.process(buf)
+            master += out
+            if send and self.useReverb:
+                self.sendBuf += out * send
+        if self.useReverb:
+            master += self.reverb.process(self.sendBuf)
+        master = self.masterChain.process(master)
+        self.totalSecs += time.perf_counter() - startTime
+        self.numBlocks += 1
+        return master
+
+    def processOffline(self, kit, mix):
+        """ run a whole (frames x chans) mix of one kit through the bus, a block at a time, in place """
+        if not self.active:
+            return mix
+        for first in range(0, len(mix), self.blockFrames):
+            num = min(self.blockFrames, len(mix) - first)
+            self.begin()
+            self.kitBuffer(kit)[:num] = mix[first:first + num]
+            mix[first:first + num] = self.process()[:num]
+        return mix
+
+    def costUs(self):
+        """ mean microseconds per block for the whole bus """
+        return self.totalSecs / self.numBlocks * 1e6 if self.numBlocks else 0.0
+
+    def costReport(self):
+        """ per effect & total cost per block, and the total as a share of the block's duration """
+        parts = list()
+        for chain in self.chains():
+            for effect in chain.active:
+                if effect.numBlocks:
+                    parts.append("{0}/{1}: {2:.0f}us (max {3:.0f})".format(chain.name, effect.name,
+                                 effect.totalSecs / effect.numBlocks * 1e6, effect.maxSecs * 1e6))
+        return "Effects: {0:.0f}us per block ({1:.1f}% of the block time){2}".format(
+               self.costUs(), self.costUs() / 1e6 / self.blockSecs * 100, ';  ' + ', '.join(parts) if parts else '')
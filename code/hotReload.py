@@ -0,0 +1,51 @@
+import os
+import glob
+import time
+import threading
+import logging
+
+"""
+Watch files for changes by polling their mtimes (--hotReload)
+
+No inotify needed - a stat of a few hundred files a second is nothing, and works the same on any filesystem.
+The callbacks run on the watcher thread, so any reloading they do stays off the clock/audio path.
+"""
+
+POLL_SECS = 1.0
+
+class MtimeWatcher(threading.Thread):
+    """ calls callback(changedPaths) whenever files matching a glob pattern are added, changed or removed """
+    def __init__(self, interval=POLL_SECS):
+        threading.Thread.__init__(self, name="hotReload", daemon=True)
+        self.interval = interval
+        self.watches = list()   #[pattern, callback, {path: mtime}]
+
+    def watch(self, pattern, callback):
+        self.watches.append([pattern, callback, self.scan(pattern)])
+
+    @staticmethod
+    def scan(pattern):
+        mtimes = dict()
+        for path in glob.glob(pattern):
+            try:
+                mtimes[os.path.normpath(path)] = os.stat(path).st_mtime
+            except OSError:     #removed between the glob & the stat
+                pass
+        return mtimes
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            for watch in self.watches:
+                pattern, callback, oldMtimes = watch
+                newMtimes = self.scan(pattern)
+                if newMtimes == oldMtimes:
+                    continue
+                changed = {path for path in newMtimes.keys() | oldMtimes.keys()
+                           if newMtimes.get(path) != oldMtimes.get(path)}
+                watch[2] = newMtimes
+                logging.debug("Changed files: %s", changed)
+                try:
+                    callback(changed)
+                except Exception:
+                    logging.exception("Reload of %s failed", changed)
@@ -0,0 +1,192 @@
+import os
+import glob
+import time
+import queue
+import fcntl
+import struct
+import selectors
+import collections
+import logging
+import numpy
+import pygame
+
+"""
+Numeric keypad input backends (--keyInput)
+
+  evdev   reads the keypad straight from its Linux input device(s), /dev/input/event*, blocked on a selector - no
+          SDL video/event stack, no polling.  Needs read access to the devices (root, or the 'input' group).
+          Each device is grabbed (EVIOCGRAB), so its keys no longer reach the console's tty or anything else reading
+          it - otherwise every pad press is typed at the login prompt too.  That includes a whole keyboard that has a
+          keypad; a device someone else has grabbed is read anyway (with a warning) but won't see any events
+  pygame  the original way: keyboard events from pygame's (dummy) display, blocked on pygame.event.wait()
+  auto    evdev if a keypad can be opened, else pygame (the default)
+
+Every backend hands out (pygame key code, down, timestamp) - linux key codes are translated to their pygame K_KP*
+equivalents - so KeyEventHandler parses them all the same.  The timestamp is when the key was pressed as far as we can
+tell (the kernel's, for evdev), so the time until its action is done is the key-to-action latency.
+
+FakeKeys is a source fed from code (press/tap) instead of a device, for measuring that latency (see benchSeq.py).
+"""
+
+RESCAN_SECS = 2.0   #look for a keypad this often while there is none (eg: unplugged)
+LATENCY_WINDOW = 1000   #key-to-action latency percentiles are over the last this many keys
+
+#linux/input-event-codes.h
+EV_KEY = 0x01
+KEY_MAX = 0x2ff
+KEY_UP, KEY_DOWN = 0, 1     #values of an EV_KEY event (2 is autorepeat - pygame doesn't repeat either)
+LINUX_TO_PYGAME = {
+    82: pygame.K_KP0, 79: pygame.K_KP1, 80: pygame.K_KP2, 81: pygame.K_KP3, 75: pygame.K_KP4,
+    76: pygame.K_KP5, 77: pygame.K_KP6, 71: pygame.K_KP7, 72: pygame.K_KP8, 73: pygame.K_KP9,
+    55: pygame.K_KP_MULTIPLY, 98: pygame.K_KP_DIVIDE, 78: pygame.K_KP_PLUS, 74: pygame.K_KP_MINUS,
+    83: pygame.K_KP_PERIOD, 96: pygame.K_KP_ENTER, 14: pygame.K_BACKSPACE, 69: pygame.K_NUMLOCK,
+}
+KEY_KP0 = 82
+EVENT_FORMAT = 'llHHi'      #struct input_event: struct timeval, __u16 type, __u16 code, __s32 value
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+
+def EVIOCGBIT(evType, length):
+    return (2 << 30) | (length << 16) | (ord('E') << 8) | (0x20 + evType)     #_IOC(_IOC_READ, 'E', 0x20 + ev, len)
+EVIOCGRAB = (1 << 30) | (4 << 16) | (ord('E') << 8) | 0x90    #_IOW('E', 0x90, int)
+
+def hasKeypad(fd):
+    """ does the input device have keypad keys (not just any keyboard - mice & power buttons have EV_KEY too) """
+    bits = bytearray(KEY_MAX // 8 + 1)
+    try:
+        fcntl.ioctl(fd, EVIOCGBIT(EV_KEY, len(bits)), bits)
+    except OSError:
+        return False
+    return bool(bits[KEY_KP0 // 8] & (1 << (KEY_KP0 % 8)))
+
+class KeyLatency():
+    """ key-to-action latency percentiles """
+    def __init__(self):
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def add(self, latency):
+        self.latencies.append(latency)
+
+    def percentiles(self):
+        """ in ms: {p50, p90, p99, max} """
+        if not self.latencies:
+            return dict()
+        values = numpy.array(self.latencies) * 1000
+        result = {'p' + format(pct, 'g'): round(float(numpy.percentile(values, pct)), 3) for pct in (50, 90, 99)}
+        result['max'] = round(float(values.max()), 3)
+        return result
+
+class EvdevKeypad():
+    """ the keypad(s) from /dev/input - paths, or every device with keypad keys """
+    def __init__(self, paths=None):
+        self.paths = paths
+        self.selector = selectors.DefaultSelector()
+        self.devices = dict()   #fd -> path
+        self.open()
+
+    def open(self):
+        for path in self.paths or sorted(glob.glob('/dev/input/event*')):
+            if path in self.devices.values():
+                continue
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            except OSError as ex:
+                if self.paths:
+                    logging.warning("Can't open keypad %s: %s", path, ex)
+                continue
+            if self.paths or hasKeypad(fd):
+                try:
+                    fcntl.ioctl(fd, EVIOCGRAB, 1)   #ours alone (released when it's closed)
+                except OSError as ex:
+                    logging.warning("Can't grab keypad %s - its keys reach other programs too: %s", path, ex)
+                self.devices[fd] = path
+                self.selector.register(fd, selectors.EVENT_READ)
+                logging.info("Keypad: %s", path)
+            else:
+                os.close(fd)
+
+    def close(self, fd):
+        logging.warning("Keypad %s gone", self.devices.pop(fd))
+        self.selector.unregister(fd)
+        os.close(fd)
+
+    def read(self):
+        """ blocks until there are key events, returns [(pygame key, down, timestamp)] """
+        while True:
+            if not self.devices:
+                time.sleep(RESCAN_SECS)
+                self.open()
+                continue
+            keys = list()
+            for selKey, mask in self.selector.select():
+                try:
+                    data = os.read(selKey.fd, EVENT_SIZE * 64)
+                except BlockingIOError:
+                    continue
+                except OSError:     #unplugged (ENODEV)
+                    self.close(selKey.fd)
+                    continue
+                for (sec, usec, evType, code, value) in struct.iter_unpack(EVENT_FORMAT, data):
+                    if evType == EV_KEY and value in (KEY_UP, KEY_DOWN) and code in LINUX_TO_PYGAME:
+                        keys.append((LINUX_TO_PYGAME[code], value == KEY_DOWN, sec + usec / 1e6))
+            if keys:
+                return keys
+
+class PygameKeys():
+    """ keyboard events from pygame - needs a display, even a dummy one.  pygame docs say use it from the main thread """
+    def __init__(self):
+        pygame.display.set_mode()
+        pygame.event.set_allowed(None)
+        pygame.event.set_allowed(pygame.KEYDOWN)
+        pygame.event.set_allowed(pygame.KEYUP)
+
+    def read(self):
+        """ blocks until there are key events, returns [(pygame key, down, timestamp)] """
+        while True:
+            keys = list()
+            for event in [pygame.event.wait()] + pygame.event.get():  #sleep until there's one, then take the rest
+                #logging.debug("raw event:%s", event)
+                if event.type == pygame.QUIT:
+                    logging.debug("Quit cmd")
+                    pygame.quit(); #sys.exit() if sys is imported
+                elif event.type in (pygame.KEYDOWN, pygame.KEYUP):
+                    keys.append((event.key, event.type == pygame.KEYDOWN, time.time()))
+            if keys:
+                return keys
+
+class FakeKeys():
+    """ keys pressed from code - each stamped with when it was pressed, so key-to-action latency can be measured """
+    def __init__(self):
+        self.keys = queue.SimpleQueue()
+
+    def press(self, key, down=True):
+        self.keys.put((key, down, time.time()))
+
+    def tap(self, key):
+        self.press(key, True)
+        self.press(key, False)
+
+    def read(self):
+        keys = [self.keys.get()]
+        while not self.keys.empty():
+            keys.append(self.keys.get())
+        return keys
+
+def openSource(kind='auto', paths=None):
+    """ the key source for --keyInput """
+    if kind in ('auto', 'evdev'):
+        evdev = EvdevKeypad(paths)
+        if evdev.devices or kind == 'evdev':
+            return evdev
+        evdev.selector.close()
+        logging.info("No keypad in /dev/input (or no permission) - using pygame keyboard events")
+    return PygameKeys()
+
+def keyLoop(source, keyHandler, handleCtl, latency=None):
+    """ parse the source's keys & act on them - forever """
+    while True:
+        for (key, down, stamp) in source.read():
+            keyEv = keyHandler.keyEvent(key, down)
+            if keyEv is not None:
+                handleCtl(keyEv)
+                if latency is not None:
+                    latency.add(time.time() - stamp)
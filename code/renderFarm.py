@@ -0,0 +1,250 @@
+import os
+import sys
+import time
+import glob
+import json
+import math
+import wave
+import argparse
+import multiprocessing
+import logging
+import numpy
+
+"""
+Batch render farm - every saved sequence against every kit, at several bpm & swing settings, to wavs
+
+    python3 code/renderFarm.py [--seqs GLOB] [--kits a,b] [--bpm 90,120] [--swing off,on] [--loops N] [--jobs N] [--fx FILE]
+
+Run from the top of the repo (like sampleSeq.py).  Each output is renders/<seq>__<kit>__<bpm>bpm[_swing].wav, and
+renders/manifest.json records the settings, peak & loudness of each one.
+A job is skipped when its output is newer than all its inputs (sequence file, kit wavs & tuning map) and the manifest
+has it with the same settings - so re-running after editing a kit only renders that kit.  --force renders everything.
+--fx runs each render through an effects bus (fxBus) - the same config the live --audioProc takes.
+
+Each kit that needs rendering is decoded once, into shared memory (audioProc.shareKits); the worker processes (one per
+core by default) map it zero-copy.  Notes are resolved (incl. tuning maps) & timed the way the sequencer plays them -
+minus the clock's jitter.
+"""
+
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+os.environ["SDL_AUDIODRIVER"] = "dummy"
+os.environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "1"     #or every worker says hello
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import sampleSeq
+import sampleTune
+import audioProc
+import fxBus
+
+renderDir = 'renders/'
+manifestName = 'manifest.json'
+MIX_CHANS = 2
+DEFAULT_RATE = 44100
+DEFAULT_BPMS = '120'
+DEFAULT_LOOPS = 2
+TAIL_SECS = 1.0     #ring out after the last loop
+FX_BLOCK_FRAMES = 256
+
+def tickTimes(timeSig, bpm, swing):
+    """ start time (secs) of every tick in the sequence, and the sequence length - timing as SequenceMgr.interval """
+    subBeatSecs = 60 / bpm / timeSig['numSubBeats']
+    times = list()
+    secs = 0.0
+    numTicks = timeSig['numMeasures'] * timeSig['numBeats'] * timeSig['numSubBeats']
+    for tick in range(numTicks):
+        times.append(secs)
+        if not swing:
+            secs += subBeatSecs
+        elif tick % timeSig['numSubBeats'] % 2 == 0:
+            secs += subBeatSecs * 2/3 / 0.5
+        else:
+            secs += subBeatSecs * 1/3 / 0.5
+    return times, secs
+
+def kitSamples(kit):
+    """ a kit's wav paths & names, in the order SampleSet numbers them """
+    paths = sorted(glob.glob(sampleSeq.topSampleDir + kit + sampleSeq.sampleExtension))
+    return paths, [sampleSeq.SampleSet.sampleName(path) for path in paths]
+
+def findKits():
+    metro = os.path.basename(sampleSeq.metroDir.rstrip('/'))
+    return sorted(kit for kit in os.listdir(sampleSeq.topSampleDir)
+                  if os.path.isdir(sampleSeq.topSampleDir + kit) and kit != metro)
+
+def outName(seqFile, kit, bpm, swing):
+    seqName = os.path.splitext(os.path.basename(seqFile))[0]
+    return '{0}__{1}__{2}bpm{3}.wav'.format(seqName, kit, bpm, '_swing' if swing else '')
+
+def planJobs(seqFiles, kits, bpms, swings, loops, rate, fxFile, manifest, force):
+    """ the cross product as a list of job dicts - with 'todo' False for outputs that are up to date """
+    sequences = dict()
+    for seqFile in seqFiles:
+        try:
+            sequences[seqFile] = sampleSeq.Sequence(seqFile).sequence
+        except (OSError, ValueError, KeyError, TypeError) as ex:
+            logging.warning("Skipping sequence %s: %s", seqFile, ex)
+    kitInfo = dict()
+    for kit in kits:
+        paths, names = kitSamples(kit)
+        padTune, noteMap = sampleTune.loadTuning(sampleSeq.topSampleDir + kit, names)
+        tuningPath = os.path.join(sampleSeq.topSampleDir + kit, sampleTune.tuningFile)
+        inputs = paths + ([tuningPath] if os.path.exists(tuningPath) else [])
+        kitInfo[kit] = (paths, padTune, noteMap, max([os.path.getmtime(path) for path in inputs], default=0))
+
+    jobs = list()
+    for seqFile, sequence in sequences.items():
+        for kit in kits:
+            paths, padTune, noteMap, kitMtime = kitInfo[kit]
+            for bpm in bpms:
+                for swing in swings:
+                    name = outName(seqFile, kit, bpm, swing)
+                    settings = {'seq': seqFile, 'kit': kit, 'bpm': bpm, 'swing': swing, 'loops': loops, 'rate': rate,
+                                'fx': fxFile}
+                    inputMtime = max(os.path.getmtime(seqFile), kitMtime, os.path.getmtime(fxFile) if fxFile else 0)
+                    try:
+                        upToDate = (not force and os.path.getmtime(renderDir + name) >= inputMtime
+                                    and manifest.get(name, dict()).get('settings') == settings)
+                    except OSError:
+                        upToDate = False
+                    times, loopSecs = tickTimes(sequence['timeSig'], bpm, swing)
+                    events = list()     #(secs, sample index, semitones)
+                    for loop in range(loops):
+                        for tickTime, tickNotes in zip(times, sequence['noteList']):
+                            for note in tickNotes:
+                                sampIndx, semitones = sampleTune.resolveNote(note, sampleSeq.MIDI_FIRST_NOTE,
+                                                                             padTune, noteMap, [])
+                                if sampIndx < len(paths):
+                                    events.append((loop * loopSecs + tickTime, sampIndx, semitones))
+                    jobs.append({'name': name, 'settings': settings, 'events': events, 'todo': not upToDate,
+                                 'secs': loops * loopSecs + TAIL_SECS})
+    return jobs, kitInfo
+
+"""
+Worker process side
+"""
+workerKits = dict()     #kit -> list of sample frame arrays (views of the shared memory)
+pitched = dict()        #(kit, sample index, semitones) -> frames
+workerFx = None         #fxBus config
+
+def workerInit(shmName, totalFrames, kitNames, table, fxConfig):
+    global workerShm, workerFx
+    workerFx = fxConfig
+    workerShm, samples = audioProc.mapKits(shmName, totalFrames, MIX_CHANS, table)   #kept referenced, or it's unmapped
+    workerKits.update(zip(kitNames, samples))
+
+def renderJob(job):
+    """ mix a job's notes & write its wav.  Returns (name, stats, secs of audio, secs taken, fx us per block) """
+    startTime = time.time()
+    settings = job['settings']
+    rate = settings['rate']
+    samples = workerKits[settings['kit']]
+    mix = numpy.zeros((int(job['secs'] * rate), MIX_CHANS), dtype=numpy.float32)
+    for (secs, sampIndx, semitones) in job['events']:
+        data = samples[sampIndx]
+        if semitones:
+            key = (settings['kit'], sampIndx, semitones)
+            if key not in pitched:
+                pitched[key] = sampleTune.resample(data, semitones, MIX_CHANS)
+            data = pitched[key]
+        first = int(round(secs * rate))
+        num = min(len(data), len(mix) - first)
+        if num > 0:
+            mix[first:first + num] += data[:num]
+    fxCost = 0.0
+    if workerFx is not None:    #a fresh bus per job - no filter states or reverb tail carried over
+        bus = fxBus.FxBus(workerFx, [settings['kit']], rate, FX_BLOCK_FRAMES, MIX_CHANS)
+        bus.processOffline(0, mix)
+        fxCost = bus.costUs()
+    stats = mixStats(mix)
+    tmpName = renderDir + job['name'] + '.tmp'
+    with wave.open(tmpName, 'wb') as wavFile:
+        wavFile.setnchannels(MIX_CHANS)
+        wavFile.setsampwidth(2)
+        wavFile.setframerate(rate)
+        wavFile.writeframes(numpy.clip(mix, -32768, 32767).astype(numpy.int16).tobytes())
+    os.replace(tmpName, renderDir + job['name'])    #never leave a half written wav looking up to date
+    return job['name'], stats, job['secs'], time.time() - startTime, fxCost
+
+def dbfs(value):
+    return round(20 * math.log10(value / 32768), 2) if value > 0 else None
+
+def mixStats(mix):
+    """ peak & loudness (unweighted RMS) in dBFS, crest factor & number of clipped samples """
+    peak = float(numpy.abs(mix).max()) if mix.size else 0.0
+    rms = float(numpy.sqrt(numpy.mean(numpy.square(mix, dtype=numpy.float64)))) if mix.size else 0.0
+    return {'peakDb': dbfs(peak), 'rmsDb': dbfs(rms), 'crestDb': round(20 * math.log10(peak / rms), 2) if rms > 0 else None,
+            'clipped': int(numpy.count_nonzero(numpy.abs(mix) > 32767))}
+
+"""
+Control side
+"""
+def loadManifest():
+    try:
+        with open(renderDir + manifestName) as inFile:
+            return json.load(inFile)
+    except (OSError, ValueError):
+        return dict()
+
+def saveManifest(manifest):
+    tmpName = renderDir + manifestName + '.tmp'
+    with open(tmpName, mode='w') as outFile:
+        json.dump(manifest, outFile, indent=4, sort_keys=True)
+    os.replace(tmpName, renderDir + manifestName)
+
+def renderAll(jobs, kitInfo, numWorkers, manifest, fxConfig):
+    todo = [job for job in jobs if job['todo']]
+    print("{0} renders planned, {1} up to date, {2} to do".format(len(jobs), len(jobs) - len(todo), len(todo)))
+    if not todo:
+        return
+    startTime = time.time()
+    kitNames = sorted({job['settings']['kit'] for job in todo})
+    rate = todo[0]['settings']['rate']
+    kitShm, totalFrames, table = audioProc.shareKits([kitInfo[kit][0] for kit in kitNames], rate, MIX_CHANS)
+    print("Decoded {0} kits ({1:.1f}MB) in {2:.1f}s".format(len(kitNames), kitShm.size / 1e6, time.time() - startTime))
+
+    startTime = time.time()
+    audioSecs = 0.0
+    fxCosts = list()
+    ctx = multiprocessing.get_context('spawn')
+    try:
+        with ctx.Pool(numWorkers, initializer=workerInit, initargs=(kitShm.name, totalFrames, kitNames, table, fxConfig)) as pool:
+            settings = {job['name']: job['settings'] for job in todo}
+            for done, (name, stats, secs, took, fxCost) in enumerate(pool.imap_unordered(renderJob, todo), start=1):
+                manifest[name] = {'settings': settings[name], 'secs': round(secs, 3), **stats}
+                audioSecs += secs
+                fxCosts.append(fxCost)
+                print("[{0}/{1}] {2}  peak {3} rms {4} dBFS{5}  ({6:.0f}x realtime)".format(
+                      done, len(todo), name, stats['peakDb'], stats['rmsDb'],
+                      '  CLIPPED' if stats['clipped'] else '', secs / took if took > 0 else 0))
+    finally:
+        saveManifest(manifest)  #keep whatever finished
+        kitShm.close()
+        kitShm.unlink()
+    elapsed = time.time() - startTime
+    print("Rendered {0} in {1:.1f}s with {2} workers: {3:.1f} renders/s, {4:.0f}x realtime".format(
+          len(todo), elapsed, numWorkers, len(todo) / elapsed, audioSecs / elapsed))
+    if fxConfig is not None:
+        print("Effects: {0:.0f}us per {1} frame block on average".format(sum(fxCosts) / len(fxCosts), FX_BLOCK_FRAMES))
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)  #keep the sequencer's info logging quiet
+    parser = argparse.ArgumentParser(description="Render saved sequences against kits to wavs")
+    parser.add_argument("--seqs", default=sampleSeq.savedSequenceDir + '*.json', help="sequence files (glob)")
+    parser.add_argument("--kits", help="comma separated kit (sample dir) names.  Default: all but the metronome")
+    parser.add_argument("--bpm", default=DEFAULT_BPMS, help="comma separated bpms.  Default " + DEFAULT_BPMS)
+    parser.add_argument("--swing", default='off', help="comma separated swing settings (off,on).  Default off")
+    parser.add_argument("--loops", type=int, default=DEFAULT_LOOPS, help="times through each sequence")
+    parser.add_argument("--rate", type=int, default=DEFAULT_RATE, help="output sample rate")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="worker processes.  Default: one per core")
+    parser.add_argument("--fx", metavar="FILE", help="effects bus config (json, see fxBus.py)")
+    parser.add_argument("--force", action='store_true', help="render even if up to date")
+    args = parser.parse_args()
+
+    seqFiles = sorted(glob.glob(args.seqs))
+    kits = args.kits.split(',') if args.kits else findKits()
+    bpms = [int(bpm) for bpm in args.bpm.split(',')]
+    swings = [swing.strip().lower() in ('on', 'true', '1', 'yes') for swing in args.swing.split(',')]
+    os.makedirs(renderDir, exist_ok=True)
+    manifest = loadManifest()
+    jobs, kitInfo = planJobs(seqFiles, kits, bpms, swings, args.loops, args.rate, args.fx, manifest, args.force)
+    renderAll(jobs, kitInfo, max(1, args.jobs), manifest, fxBus.loadConfig(args.fx) if args.fx else None)
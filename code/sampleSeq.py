@@ -13,7 +13,22 @@ import signal
 import argparse
 import json
 import copy  #deep object copy
+import atexit
+import collections
 import lcdDisplay  #dmg - display module control
+import seqSync  #multi-node tempo/phase sync
+import ctlServer  #local control socket
+import seqLog  #queued logging & flight recorder
+import seqJournal  #edit journal & crash recovery
+import sampleStream  #streamed playback of big samples
+import seqProfile  #sampling profiler
+import hotReload  #sample/sequence file watching
+import audioProc  #optional separate audio process
+import sampleTune  #pitched samples
+import fxBus  #effects for the block based output paths
+import seqVoices  #choke groups, gate & voice counts
+import seqRealtime  #real-time scheduling, gc control & tick lateness stats
+import keyInput  #keypad input backends
 #from collections import namedtuple
 from enum import Enum, auto
 from functools import reduce
@@ -108,11 +123,7 @@ class PygameSetup():
         pygame.mixer.set_num_channels(NUM_MIXER_CHANNELS) #even though we asked for 16 chans in the pre-init, seems to only have 8, so increase them now
         res = pygame.mixer.set_reserved(1) #first channel reserved for metronome
         logging.info("reserved channels: %s", res)  #doesn't seem to reserve...
-        #keyboard event handling - only looking for keyboard up/down (not mouse)
-        pygame.display.set_mode()
-        pygame.event.set_allowed(None)
-        pygame.event.set_allowed(pygame.KEYDOWN)
-        pygame.event.set_allowed(pygame.KEYUP)
+        #keyboard event handling (if pygame is the key source) is set up by keyInput.PygameKeys
 
 #needs to be set for the specific Midi input device
 #midiNoteList = [36,37,38,39, 40,41,42,43, 44,45,46,47, 48,49,50,51] #this is set of 16 notes for scene 0.  Other scenes continue notes from here (modulus 16).  eg: 52-67
@@ -124,7 +135,7 @@ class ThreadedMidi(threading.Thread):
     Handle Midi messages - using "mido" library
     """
     def __init__(self, *args, **kwargs):
-        threading.Thread.__init__(self, *args, **kwargs)
+        threading.Thread.__init__(self, *args, name="midi", **kwargs)
         self.daemon = True  #die if parant process dies
         self.start()
     def run(self):
@@ -139,10 +150,13 @@ class ThreadedMidi(threading.Thread):
             logging.debug("Midi msg==> %s", msg)
             if msg.type == "sysex":
                 try:
-                    logging.debug(f"sysex msg: {msg.data}")
+                    logging.debug("sysex msg: %s", msg.data)
                     seqMgr.handleSceneChange(msg.data[-1])
                 except AttributeError:
                     pass #catch condition where the scene change button is hit while still starting up
+            elif msg.type == "note_off" or (msg.type == "note_on" and msg.velocity == 0):  #(velocity 0 is a note off too)
+                logging.debug("Midi note_off ==> %s", msg.note)
+                seqMgr.handleNoteOff(msg.note)
             elif msg.type == "note_on":
                 logging.debug("Midi note_on ==> %s", msg.note)
                 seqMgr.handleNoteIn(msg.note)
@@ -158,23 +172,33 @@ class SeqTime():
     def __init__(self, seq):
         self.timeSig = seq.sequence['timeSig']
         self.numTicks = seq.numTicks
+        #(a new SeqTime comes with every new sequence, so these can't go stale - saves dict lookups every tick)
+        self.numMeasures = self.timeSig['numMeasures']
+        self.numBeats = self.timeSig['numBeats']
+        self.numSubBeats = self.timeSig['numSubBeats']
         self.clearTime()
 
     def clearTime(self):  #set all values to just b4 zero so that first advance will cleanly start at zero
         """ reset time clock """
-        self.measure = self.timeSig['numMeasures']-1
-        self.beat = self.timeSig['numBeats']-1
-        self.subBeat = self.timeSig['numSubBeats']-1
+        self.measure = self.numMeasures-1
+        self.beat = self.numBeats-1
+        self.subBeat = self.numSubBeats-1
         self.isTock = True #isTock is true for the second half of the interval
 
     def advanceTime(self):
         self.isTock = not self.isTock
         if not self.isTock:
-            self.subBeat = (self.subBeat + 1) % self.timeSig['numSubBeats']
+            self.subBeat = (self.subBeat + 1) % self.numSubBeats
             if self.subBeat == 0:
-                self.beat = (self.beat + 1) % self.timeSig['numBeats']
+                self.beat = (self.beat + 1) % self.numBeats
                 if self.beat == 0:
-                    self.measure = (self.measure + 1) % self.timeSig['numMeasures']
+                    self.measure = (self.measure + 1) % self.numMeasures
+
+    @property
+    def atBarEnd(self):
+        #true on the last half-tick of a measure, ie: the next advance is a downbeat
+        return (self.isTock and self.subBeat == self.numSubBeats-1
+                and self.beat == self.numBeats-1)
 
     def printTime(self):
         print(self.measure+1, "-", self.beat+1, ":", self.subBeat+1, "  T:", self.tick)
@@ -182,8 +206,8 @@ class SeqTime():
 
     @property
     def tick(self):
-       return (  self.measure*self.timeSig['numBeats']*self.timeSig['numSubBeats']
-                + self.beat*self.timeSig['numSubBeats']
+       return (  self.measure*self.numBeats*self.numSubBeats
+                + self.beat*self.numSubBeats
                 + self.subBeat)
 
     @property
@@ -206,6 +230,8 @@ liveChanStart = 10   #for "live" note input
 numLiveChan = 4
 """
 numSeqChan = 8  #how many simultaneous voices are allowed (per tick)
+BATCH_SLACK = 0.002     #secs before the next tick that control cmd batches must stop being applied
+BATCH_MAX_WAIT = 1      #bars a control cmd batch waits for slack before it's applied anyway
 chanMetro = 0   #which mixer channel to use for metronome.  This is a reserved channel
 
 class Sequence():
@@ -217,20 +243,32 @@ class Sequence():
     """
 
     def __init__(self, arg=None):
-        if isinstance(arg, dict):   #dictionary of time signature elements
+        if isinstance(arg, dict) and 'noteList' in arg:  #full sequence, as saved to json
+            self.loadDict(arg)
+        elif isinstance(arg, dict):   #dictionary of time signature elements
             timeSig = self.createTimeSig(arg)
             self.initSequence(timeSig)
         elif isinstance(arg, str):  #must be a filename to load
             with open (arg, mode="r") as jsonFile:
                 loadedSeq=json.load(jsonFile)
-            timeSig = self.createTimeSig(loadedSeq['timeSig'])
-            logging.info(f"timeSig: {timeSig}")
-            self.initSequence(timeSig)
-            self.sequence['noteList']=loadedSeq['noteList']
+            self.loadDict(loadedSeq)
             logging.info("loaded sequence from: {0}\n {1} {2}".format(arg, loadedSeq['timeSig'], loadedSeq['noteList']) )
         else:
             raise TypeError('Type: {0} not supported'.format(type(arg)))
 
+    def loadDict(self, loadedSeq):
+        timeSig = self.createTimeSig(loadedSeq['timeSig'])
+        logging.debug("timeSig: %s", timeSig)
+        self.initSequence(timeSig)
+        self.sequence['noteList'] = loadedSeq['noteList']
+
+    def checkNotes(self):
+        """ strict check of a sequence from outside (control cmds) - every tick there, & only midi note numbers """
+        noteList = self.sequence['noteList']
+        if not isinstance(noteList, list) or len(noteList) != self.numTicks:
+            raise ValueError('noteList needs {0} ticks'.format(self.numTicks))
+        self.sequence['noteList'] = [[int(note) for note in tickNotes] for tickNotes in noteList]
+
     def createTimeSig(self, timeSigArgs):
         timeSig = dict()
         if timeSigArgs['numMeasures'] is not None:
@@ -302,6 +340,7 @@ class SequenceMgr():
     """
     #This class is effectively a singleton, so not sure the "self._myvar" usage is needed.  Good hygene?
     def __init__(self, timeArgDict, swingTime=True):
+        self.journal = None     #seqJournal.Journal - records every edit (set once startup loading is done)
         if timeArgDict['bpm'] is not None:
             self.beatsPerMinute=int(timeArgDict['bpm'])
         else:
@@ -314,27 +353,60 @@ class SequenceMgr():
         self.recording = False
         #self.seqList = [Sequence(timeArgDict)] * 10   #pre-init list of sequences in mem
         self.seqList = [None] * 10   #pre-init list of sequences in mem
+        self.seqFiles = dict()  #file name -> seqbank slots loaded from it (reloaded on change with --hotReload)
+        self.sync = None    #seqSync leader/follower (if syncing with other instances)
+        self.audio = None   #audioProc.AudioProcess - if mixing in a separate process
+        self.tickTime = None    #when the current tick was scheduled for (set by _run)
+        self.voices = seqVoices.VoiceMgr()  #voices on the pygame mixer - choke groups & gate
+        self.gate = False   #live notes end on note off
+        self.realtime = None    #seqRealtime.Realtime - if in real-time mode
+        self.tickStats = None   #seqRealtime.TickStats - tick lateness diagnostics
+        self.pendingBatches = collections.deque()   #control cmd batches waiting for the next tick (see ctlServer)
+        self.ctlLock = threading.RLock()    #one control change at a time: control server cmds, keypad & midi scene changes
+        self.metroChan = None   #the metronome's (reserved) mixer channel - made once the mixer is up
+        self._metroClicks = None    #per tick: (sound, volume, audio process sample) or None - see metroClicks()
+        self._metroFor = (None, None, None)     #the (seqTime, metro, chime) _metroClicks was made for
 
     def start(self):
         """ sequence start/stop & callback handling """
         if not self.is_running:
             self.is_running = True
             self.next_call = time.time()
+            if self.realtime is not None:
+                self.realtime.playing(True)
         else:
             self.next_call += self.interval
             #print(f"beat:{self.seqTime.beat}; subBeat:{self.seqTime.subBeat}; timeInterval:{self.interval}")
         self._timer = threading.Timer(self.next_call - time.time(), self._run)
+        self._timer.name = "clock"  #so the profiler can tell the ticks apart from other threads
         self._timer.start()
 
     def stop(self):
         self._timer.cancel()
         self.is_running = False
+        if self.realtime is not None:
+            self.realtime.playing(False)
 
     def _run(self):
+        self.tickTime = self.next_call  #when this tick was scheduled for
+        lateness = time.time() - self.tickTime
+        seqLog.flight.record('tick', self.seqTime.tick, lateness)  #tick & how late it fired
+        if self.audio is not None:
+            self.audio.clockLateness(lateness)
+        if self.tickStats is not None:
+            self.tickStats.add(lateness)
+        if self.realtime is not None:
+            self.realtime.checkClock()  #first tick of a run - timers started from other threads aren't real-time
         #bump the time - do this first so that everything is lined up to the new tick
         self.seqTime.advanceTime()
+        if self.sync is not None and self.seqTime.atBarEnd:
+            self.sync.onBarEnd(self)    #may nudge next_call or switch scene on the coming downbeat
         self.start() #set next timer trigger
         self.advanceSequence() #run the sequencer - play all notes in this tick
+        if self.pendingBatches:
+            self.runPendingBatches(self.next_call - BATCH_SLACK)   #control cmds land between ticks, once this one has played
+        if self.realtime is not None:
+            self.realtime.idle(self.next_call)  #collect garbage now, if there's time before the next tick
 
     @property 
     def currSeq(self):
@@ -343,6 +415,12 @@ class SequenceMgr():
     def currSeq(self, value):
         self._currSeq = value
         self.seqTime = SeqTime(value)
+        if self.journal is not None:
+            self.journalEdit('seq', copy.deepcopy(value.sequence))  #copy - the live one keeps being edited
+
+    def journalEdit(self, *entry):
+        if self.journal is not None:
+            self.journal.append(entry)
 
     @property
     def beatsPerMinute(self):
@@ -351,8 +429,19 @@ class SequenceMgr():
     def beatsPerMinute(self, value):
         if value < 10:
             value = 10
+        if value != getattr(self, '_beatsPerMinute', None):
+            self.journalEdit('bpm', value)
         self._beatsPerMinute = value
 
+    @property
+    def swingTime(self):
+        return self._swingTime
+    @swingTime.setter
+    def swingTime(self, value):
+        if value != getattr(self, '_swingTime', None):
+            self.journalEdit('swing', value)
+        self._swingTime = value
+
     @property
     def interval(self):
         """ time interval """
@@ -360,51 +449,95 @@ class SequenceMgr():
             In "swing" the subbeats are 2/3 (and 1/3) of the beats (or more/less)
             So to make swing we change the interval size by (2/3 / 0.5) and (1/3 / 0.5) 
         """
-        straightTimeInterval =  60 / self.beatsPerMinute / self.seqTime.timeSig['numSubBeats'] / 2  #the 2 is because of "isTock"
+        return self.subBeatInterval(self.seqTime.subBeat)
+
+    def subBeatInterval(self, subBeat):
+        """ the time interval of either half tick of the sub-beat """
+        straightTimeInterval =  60 / self.beatsPerMinute / self.seqTime.numSubBeats / 2  #the 2 is because of "isTock"
         if not self.swingTime:
             timeInterval = straightTimeInterval
         else: #swing
-            if self.seqTime.subBeat % 2 == 0:
+            if subBeat % 2 == 0:
                 timeInterval = straightTimeInterval * 2/3 / 0.5
             else:
                 timeInterval = straightTimeInterval * 1/3 / 0.5
         return timeInterval
 
+    def nextBarTime(self):
+        #time of the coming downbeat - only valid when seqTime.atBarEnd
+        return self.next_call + self.interval
+
+    def nextDownbeatTime(self):
+        """
+        time of the first downbeat whose bar end is still to come - from any thread, anywhere in the bar (next_call is
+        when the next half tick fires).  At the bar end itself that's the downbeat after next: the clock has already
+        done this bar end's work (sync.onBarEnd)
+        """
+        seqTime = self.seqTime
+        halfTicks = seqTime.numBeats * seqTime.numSubBeats * 2
+        pos = (seqTime.beat * seqTime.numSubBeats + seqTime.subBeat) * 2 + seqTime.isTock    #half ticks into the bar
+        downbeat = self.next_call
+        for halfTick in range(pos + 1, halfTicks if pos < halfTicks - 1 else 2 * halfTicks):
+            downbeat += self.subBeatInterval(halfTick // 2 % seqTime.numSubBeats)
+        return downbeat
+
     def updateDisplay(self):
         display.updateSettings(self.beatsPerMinute, sampMgr.currSampleDir, self.currSeqNum, self.recording)
 
+    def metroClicks(self):
+        """
+        the metronome click of every tick (None off the beat) - remade only when the sequence or metronome samples
+        change, so the clock doesn't pick the sample & volume every beat
+        """
+        seqTime = self.seqTime
+        if (self._metroFor[0] is not seqTime or self._metroFor[1] is not sampMgr.metro
+                or self._metroFor[2] is not sampMgr.chime):
+            clicks = [None] * seqTime.numTicks
+            for measure in range(seqTime.numMeasures):
+                for beat in range(seqTime.numBeats):
+                    if beat == 0:
+                        if measure == 0:
+                            click = (sampMgr.chime, 1.0, 1)    #ideally use a chime sound here
+                        else:
+                            click = (sampMgr.metro, 0.6, 0)
+                    else:
+                        click = (sampMgr.metro, 0.3, 0)
+                    clicks[(measure*seqTime.numBeats + beat) * seqTime.numSubBeats] = click
+            self._metroClicks = clicks
+            self._metroFor = (seqTime, sampMgr.metro, sampMgr.chime)
+        return self._metroClicks
+
     def advanceSequence(self):
+        #the clock runs this every half tick - it shouldn't leave anything behind (see benchSeq.py allocs)
+        seqTime = self.seqTime
         #update the display
-        display.updateTime(self.seqTime.measure+1, self.seqTime.beat+1) #I think the +1's are to shift from zero-based numbering
+        display.updateTime(seqTime.measure+1, seqTime.beat+1) #I think the +1's are to shift from zero-based numbering
 
         #play note(s) in sequence
-        if self.seqTime.isTock == False:  #only play on the front half of the interval
+        if seqTime.isTock == False:  #only play on the front half of the interval
+            tick = seqTime.tick
             #handle metronome
-            if self.seqTime.subBeat == 0: 
+            if seqTime.subBeat == 0: 
                 if PRINT_TIME:
-                    self.seqTime.printTime()  #note that we are only printing beats (not sub-beats)
+                    seqTime.printTime()  #note that we are only printing beats (not sub-beats)
                 if self.metroOn:
-                    if self.seqTime.beat == 0:
-                        if self.seqTime.measure == 0: 
-                            metroSamp = sampMgr.chime
-                            metroVol = 1.0   #ideally use a chime sound here
-                        else: 
-                            metroSamp = sampMgr.metro
-                            metroVol = 0.6
+                    clicks = self.metroClicks()
+                    (metroSamp, metroVol, audioSamp) = clicks[tick]
+                    if self.audio is not None:
+                        self.audio.trigger(self.audio.metroKit, audioSamp, self.tickTime + audioProc.LOOKAHEAD, metroVol)
                     else:
-                        metroSamp = sampMgr.metro
-                        metroVol = 0.3
-                    metroChan = pygame.mixer.Channel(chanMetro)
-                    metroChan.set_volume(metroVol)
-                    metroChan.play(metroSamp);
+                        if self.metroChan is None:
+                            self.metroChan = pygame.mixer.Channel(chanMetro)
+                        self.metroChan.set_volume(metroVol)
+                        self.metroChan.play(metroSamp);
 
             #Now play all the notes in this tick
             seqNoteList = self.currSeq.sequence['noteList']
             try:
-                seqTickNotes = seqNoteList[self.seqTime.tick]
+                seqTickNotes = seqNoteList[tick]
                 if len(seqTickNotes) != 0:
                     for note in seqTickNotes:
-                        self.playMidiNote(note) 
+                        self.playMidiNote(note, self.tickTime) 
             except IndexError:
                 logging.warning('Tick count is longer than sequence note list')
 
@@ -417,32 +550,47 @@ class SequenceMgr():
 
 
     def handleSceneChange(self, scene):
-        logging.info(f'Scene: {scene}')
+        logging.info('Scene: %s', scene)
+        seqLog.flight.record('scene', scene)
+        seq = self.loadScene(scene)     #here, not on the clock
+        if seq is None:
+            return
+        with self.ctlLock:
+            if self.sync is not None and self.sync.quantizeScene(self, scene, seq):
+                return  #will be switched on the next bar boundary
 
-        if scene == 0:
             self.stop()
-            self.currSeq=Sequence(SequenceMgr.SEQ_SCENE0)  #means the last one specified will be played
+            self.applyScene(scene, seq)
+            self.start()
+
+    SCENE_FILES = {0: SEQ_SCENE0, 1: SEQ_SCENE1, 2: SEQ_SCENE2}
+
+    def loadScene(self, scene):
+        """ the scene's sequence, read from its file (None if no such scene) - load it before getting on the clock """
+        if scene not in SequenceMgr.SCENE_FILES:
+            return None
+        return Sequence(SequenceMgr.SCENE_FILES[scene])
+
+    def applyScene(self, scene, seq=None):
+        """ switch sequence, samples & timing to those of the scene (seq: the scene's sequence, if already loaded) """
+        if scene not in SequenceMgr.SCENE_FILES:
+            return
+        if seq is None:
+            seq = self.loadScene(scene)
+        self.currSeq = seq  #means the last one specified will be played
+        if scene == 0:
             currSampleDir = sampMgr.index("PearlKitMapped")
             self.beatsPerMinute = 180
             self.swingTime = False
-            self.updateDisplay()
-            self.start()
         elif scene == 1:
-            self.stop()
-            self.currSeq=Sequence(SequenceMgr.SEQ_SCENE1)  #means the last one specified will be played
             currSampleDir = sampMgr.index("PearlKitMapped")
             self.beatsPerMinute = 120
             self.swingTime = True
-            self.updateDisplay()
-            self.start()
         elif scene == 2:
-            self.stop()
-            self.currSeq=Sequence(SequenceMgr.SEQ_SCENE2)  #means the last one specified will be played
             currSampleDir = sampMgr.index("PearlKitMapped")
             self.beatsPerMinute = 130
             self.swingTime = False
-            self.updateDisplay()
-            self.start()
+        self.updateDisplay()
 
     #for "live" notes (vs those recorded in sequence)
     def handleNoteIn(self,note):
@@ -468,37 +616,229 @@ class SequenceMgr():
         if self.recording:
             noteTick = self.seqTime.roundedTick
             self.currSeq.addNote(noteTick, note)
+            self.journalEdit('add', noteTick, note, numSeqChan)
 
-    def playMidiNote(self,note):
-        """ Based on midi input msg, play a sound """
-        try:
-            sampIndx = (note-MIDI_FIRST_NOTE) % 16  #mod 16 is because notes in alt scenes on nanoPad2 progressively higher up
-        except ValueError: #
+    def handleNoteOff(self, note):
+        """ midi note released - ends its voice in gate mode """
+        if not self.gate:
             return
+        if self.audio is not None:
+            self.audio.noteOff(note, time.time())
+        else:
+            self.voices.noteOff(note)
+
+    def playMidiNote(self,note, tickTime=None):
+        """ Based on midi input msg, play a sound.  tickTime is the scheduled time of a sequenced note (None if live) """
         sampleSet = sampMgr.sampleSets[sampMgr.currSampleDir]
-        if len(sampleSet.sampleSounds) < sampIndx+1:
-            logging.debug('Sample %s does not exist in SampleSet %s', sampIndx, sampleSet.sampleDir)
+        (sampIndx, semitones, sound, group) = sampMgr.resolveRef(sampleSet, note)
+        if sound is None:
+            return  #(logged when the note was first resolved)
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('playing midi:%s sample#:%s %s %+g', note, sampIndx, sampleSet.sampleNames[sampIndx], semitones)
+        seqLog.flight.record('note', note, sampIndx)
+        liveNote = note if tickTime is None else None   #only live notes get a note off
+        if self.audio is not None:  #audio process plays it (at the original pitch) - sequenced notes frame accurately, LOOKAHEAD later
+            self.audio.trigger(sampMgr.currSampleDir, sampIndx, tickTime + audioProc.LOOKAHEAD if tickTime is not None else time.time(),
+                               group=group, note=liveNote if liveNote is not None else -1)
             return
-        logging.debug('playing midi:%s sample#:%s %s', note, sampIndx, sampleSet.sampleNames[sampIndx])
-        sound = sampleSet.sampleSounds[sampIndx]
-        chan = pygame.mixer.find_channel(True) #force it to find a channel (will kick off oldest note)
-        #chan.play(sound)
-        sound.play()    #this appears to be the only way to get a channel that isn't reserved (find_channel will find any unavailable chan)
+        if semitones:
+            sound = sampMgr.tuneCache.get(sampleSet, sampIndx, semitones)    #original pitch until its copy is ready
+        self.voices.play(sound, sampMgr.currSampleDir, group, liveNote)    #sound.play() - this appears to be the only way to get a channel that isn't reserved (find_channel will find any unavailable chan)
         """ use to check channel allocation (first N chans are reserved)
         for chan in range(NUM_MIXER_CHANNELS):
             print("chan: %s -- busy: %s", chan, pygame.mixer.Channel(chan).get_busy())
         """
+    def selectSample(self, sampIndx):
+        sampMgr.currSampleDir = sampIndx
+        sampMgr.prefetchTuned()
+        self.journalEdit('sample', sampMgr.sampleDirs[sampIndx])  #by name - indexes move if kits are added
+        self.updateDisplay()
+
     def storeSeq(self, slot):  #store a seq to mem
         logging.info("Store to seqbank: %s", slot)
         self.seqList[slot] = copy.deepcopy(self.currSeq)
+        self.journalEdit('store', slot)
 
     def loadSeq(self, slot): #restore seq from mem
         logging.info("Loading seq from seqbank: %s", slot)
         self.currSeq = copy.deepcopy(self.seqList[slot])
         self.currSeqNum = slot 
+        self.journalEdit('seqNum', slot)
         self.updateDisplay()
 
+    def loadSeqFile(self, fileName, slot):
+        """ load a sequence file into the current seq & a seqbank """
+        logging.info("Loading sequence file: " + fileName)
+        self.currSeq=Sequence(fileName)
+        self.storeSeq(slot)
+        self.seqFiles.setdefault(os.path.normpath(fileName), set()).add(slot)
+
+    def reloadSeqFiles(self, changedPaths):
+        """ hotReload callback (watcher thread) - parse changed sequence files, then update their banks between ticks """
+        for fileName in changedPaths & self.seqFiles.keys():
+            startTime = time.time()
+            try:
+                seq = Sequence(fileName)
+            except (OSError, ValueError, KeyError, TypeError) as ex:    #removed, or caught half written
+                logging.warning("Reload of sequence file %s failed: %s", fileName, ex)
+                continue
+            slots = sorted(self.seqFiles[fileName])
+            def store(seq=seq, slots=slots):
+                for slot in slots:
+                    self.seqList[slot] = copy.deepcopy(seq)
+                    if self.journal is not None:
+                        self.journalEdit('bank', slot, copy.deepcopy(seq.sequence))
+            def done(results, fileName=fileName, slots=slots, startTime=startTime):
+                logging.info("Reloaded sequence file %s into seqbank %s in %.0fms", fileName, slots, (time.time() - startTime) * 1000)
+            self.queueBatch([store], done)
+
+    def journalState(self):
+        """ session state in seqJournal form """
+        state = seqJournal.emptyState()
+        state.update({'bpm': self.beatsPerMinute, 'swing': self.swingTime, 'seqNum': self.currSeqNum,
+                      'sample': sampMgr.currSampleName(),
+                      'seq': copy.deepcopy(self.currSeq.sequence), 'added': list(self.currSeq._addedNotes),
+                      'banks': [copy.deepcopy(seq.sequence) if seq is not None else None for seq in self.seqList]})
+        return state
+
+    def restoreSession(self, state):
+        """ put back a session rebuilt by seqJournal.loadSession """
+        self.seqList = [Sequence(seq) if seq is not None else None for seq in state['banks']]
+        if state['seq'] is not None:
+            self.currSeq = Sequence(state['seq'])
+            self.currSeq._addedNotes = state['added']  #so bkspc still undoes the restored notes
+        self.currSeqNum = state['seqNum']
+        if state['bpm'] is not None:
+            self.beatsPerMinute = state['bpm']
+        if state['swing'] is not None:
+            self.swingTime = state['swing']
+        sampIndx = sampMgr.index(state['sample']) if state['sample'] is not None else None
+        if sampIndx is not None:
+            sampMgr.currSampleDir = sampIndx
+            sampMgr.prefetchTuned()
+        self.updateDisplay()
+
+    def prepareCmd(self, cmd):
+        """
+        Validate a control cmd (dict - see ctlServer) & do any heavy lifting up front, off the clock thread.
+        Returns a function that applies it (and returns the cmd's result).  Raises ValueError for a bad cmd
+        """
+        with self.ctlLock:  #(reads the banks & kits the keypad may be changing)
+            return self._prepareCmd(cmd)
+
+    def _prepareCmd(self, cmd):
+        try:
+            name = cmd['cmd']
+            if name == 'storeSeq':
+                slot = self.checkSlot(cmd['slot'])
+                seq = Sequence(cmd['seq'])
+                seq.checkNotes()
+                seqCopy = copy.deepcopy(seq.sequence) if self.journal is not None else None    #(the copy made here, not on the clock)
+                def apply():
+                    self.seqList[slot] = seq
+                    if seqCopy is not None:
+                        self.journalEdit('bank', slot, seqCopy)
+            elif name == 'loadSeq':
+                slot = self.checkSlot(cmd['slot'])
+                def apply():
+                    if self.seqList[slot] is None:
+                        logging.warning("No sequence stored at seqbank: %s", slot)
+                        return False
+                    self.loadSeq(slot)
+                    return True
+            elif name == 'bpm':
+                bpm = int(cmd['value'])
+                def apply():
+                    self.beatsPerMinute = bpm
+                    self.updateDisplay()
+            elif name == 'swing':
+                swing = bool(cmd['value'])
+                def apply():
+                    self.swingTime = swing
+            elif name == 'sample':
+                value = cmd['value']
+                sampIndx = sampMgr.index(value) if isinstance(value, str) else int(value)
+                if sampIndx is None or not 0 <= sampIndx < len(sampMgr.sampleSets):
+                    raise ValueError("No sample set: {0}".format(value))
+                def apply():
+                    self.selectSample(sampIndx)
+            elif name == 'scene':
+                scene = int(cmd['value'])
+                seq = self.loadScene(scene)
+                if seq is None:
+                    raise ValueError("No scene: {0}".format(scene))
+                def apply():
+                    if self.sync is None or not self.sync.quantizeScene(self, scene, seq):
+                        self.applyScene(scene, seq)
+            elif name == 'state':
+                def apply():
+                    return self.state()
+            else:
+                raise ValueError("Unknown cmd: {0}".format(name))
+        except (KeyError, TypeError, IndexError, OSError) as ex:
+            raise ValueError("Bad cmd {0}: {1!r}".format(cmd, ex))
+        return apply
+
+    def checkSlot(self, slot):
+        slot = int(slot)
+        if not 0 <= slot < len(self.seqList):
+            raise ValueError("No seqbank: {0}".format(slot))
+        return slot
+
+    def queueBatch(self, batch, done):
+        """
+        Queue a list of prepared cmds to be applied together between two ticks.
+        done(results) is called from the clock thread once applied (results is an exception if one failed)
+        """
+        self.pendingBatches.append((batch, done, time.time()))
+        if not self.is_running:
+            self.runPendingBatches()    #no ticks to wait for
+
+    def runPendingBatches(self, deadline=None):
+        """
+        apply the queued batches - those left once it's past deadline wait for the next tick, unless they've already
+        waited BATCH_MAX_WAIT bars (so a busy clock can't hold them back for ever).  On the clock (deadline given) a
+        keypad/midi change in progress means trying again next tick, rather than the clock waiting on it
+        """
+        if not self.ctlLock.acquire(blocking=deadline is None):
+            return
+        try:
+            maxWait = BATCH_MAX_WAIT * self.seqTime.numBeats * 60 / self.beatsPerMinute
+            while self.pendingBatches:
+                now = time.time()
+                (batch, done, queuedAt) = self.pendingBatches[0]
+                if deadline is not None and now > deadline and now - queuedAt < maxWait:
+                    break
+                self.pendingBatches.popleft()
+                try:
+                    results = [apply() for apply in batch]
+                except Exception as ex:
+                    logging.warning("Control batch failed: %s", ex)
+                    results = ex
+                done(results)
+        finally:
+            self.ctlLock.release()
+
+    def state(self):
+        return {'running': self.is_running, 'bpm': self.beatsPerMinute, 'swing': self.swingTime,
+                'metro': self.metroOn, 'recording': self.recording, 'seqNum': self.currSeqNum,
+                'sample': sampMgr.currSampleName(), 'seq': copy.deepcopy(self.currSeq.sequence),
+                'banks': [seq is not None for seq in self.seqList],
+                'streamUnderruns': sampleStream.streamer.underruns, 'tuneCache': sampMgr.tuneCache.stats(),
+                'peakVoices': self.peakVoices(),
+                'tickLateness': self.tickStats.percentiles() if self.tickStats is not None else None}
+
+    def peakVoices(self):
+        """ (peak concurrent voices, peak had none been choked/gated) """
+        if self.audio is not None:
+            return self.audio.peakVoices()
+        return (self.voices.counter.peak, self.voices.counter.peakNatural)
+
     def handleCtl(self, ctlEvent):  #control events from number pad
+        with self.ctlLock:  #not in the middle of a control server batch
+            self.applyCtl(ctlEvent)
+
+    def applyCtl(self, ctlEvent):
         #The modStar and modSlash mechanisms only work if the mod is pressed first.
         #Would be nicer to allow any order
         logging.debug("got control event:%s", ctlEvent)
@@ -542,9 +882,11 @@ class SequenceMgr():
             if not modStar: #Delete last note entered 
                 logging.info("Delete last note")
                 self.currSeq.delNote()
+                self.journalEdit('del')
             else:
                 logging.info("clear current sequence")
                 self.currSeq.clearSequence()
+                self.journalEdit('clear')
 
         #recording on/off - NumLk
         if keyType == KeyTypes.numlock_on:
@@ -564,8 +906,7 @@ class SequenceMgr():
                     logging.warning("Attempted to load sample: %s but does not exist", keyVal)
                 else:
                     logging.info("Loading sample: %s", sampMgr.sampleDirs[keyVal])
-                    sampMgr.currSampleDir = keyVal
-                    self.updateDisplay()
+                    self.selectSample(keyVal)
             elif modStar:   #store currSeq to mem
                 self.storeSeq(keyVal)
             else:   #load currSeq from mem
@@ -577,24 +918,60 @@ class SequenceMgr():
 topSampleDir = 'samples/'
 metroDir = topSampleDir + 'ZZ_Metronome/'
 sampleExtension = '/*.wav'
+DEFAULT_STREAM_SIZE = 4*1024*1024    #samples bigger than this (bytes) are streamed rather than loaded
 class SampleSet():
-    """ holds info for set of samples """
-    def __init__(self, sampleDir):
+    """
+    holds info for set of samples
+    Samples bigger than streamSize are memory-mapped & streamed (sampleStream.StreamedSample) instead of fully decoded
+    When reloading, pass the previous set as oldSet - only files whose mtime changed get decoded again
+    An optional tuning map (sampleTune.tuningFile) in the directory pitches pads or maps notes to pitched samples
+    and optional choke groups (seqVoices.chokeFile) cut each other's voices short
+    With decode False (--audioProc) nothing is decoded here - the sounds are audioProc.SampleRefs, as the audio process
+    has its own copy of the samples
+    """
+    def __init__(self, sampleDir, streamSize=DEFAULT_STREAM_SIZE, oldSet=None, decode=True):
         self.sampleDir = sampleDir
         self.samplePaths= glob.glob(topSampleDir + self.sampleDir + sampleExtension)
         self.samplePaths.sort()
         self.sampleNames = list()  #kludgy - names & sounds should be a tuple
         self.sampleSounds = list()
+        self.sampleMtimes = list()
+        self.numDecoded = 0
+        oldSounds = dict()
+        if oldSet is not None:
+            oldSounds = {path: (mtime, snd) for path, mtime, snd in zip(oldSet.samplePaths, oldSet.sampleMtimes, oldSet.sampleSounds)}
         for samp in self.samplePaths:
-            snd = pygame.mixer.Sound(samp)
-            self.sampleSounds.append(snd)
-            m = re.search("([\w-]+)\.wav$", samp)  #find the short name
-            if m is not None:
-                name = m.group(1)
+            mtime = os.path.getmtime(samp)
+            if samp in oldSounds and oldSounds[samp][0] == mtime:
+                snd = oldSounds[samp][1]    #unchanged - reuse
             else:
-                name = "???"
-            self.sampleNames.append(name)
+                snd = self.loadSample(samp, streamSize, decode)
+                self.numDecoded += 1
+            self.sampleSounds.append(snd)
+            self.sampleMtimes.append(mtime)
+            self.sampleNames.append(self.sampleName(samp))
+        (self.padTune, self.noteMap) = sampleTune.loadTuning(topSampleDir + self.sampleDir, self.sampleNames)
+        self.chokes = seqVoices.loadChokes(topSampleDir + self.sampleDir, self.sampleNames)
+        self.resolved = dict()  #midi note -> SampleMgr.resolveRef() (filled as notes are played)
         self.printMe()
+    @staticmethod
+    def sampleName(path):
+        m = re.search("([\w-]+)\.wav$", path)  #find the short name
+        if m is not None:
+            return m.group(1)
+        return "???"
+
+    @staticmethod
+    def loadSample(path, streamSize, decode=True):
+        if not decode:
+            return audioProc.SampleRef(path)
+        if os.path.getsize(path) > streamSize:
+            try:
+                return sampleStream.StreamedSample(path)
+            except sampleStream.WavFormatError as ex:
+                logging.warning("Can't stream (%s), loading it whole", ex)
+        return pygame.mixer.Sound(path)
+
     def printMe(self):  #there is probably an official print serialization term...
         #logging.info('sampleDir: %s', self.sampleDir)
         logging.info('sampleDir: %s\nSample Names%s', self.sampleDir, self.sampleNames)
@@ -604,9 +981,13 @@ class SampleMgr():
     """
     Load and manage lists of samples
     """
-    def __init__(self):
+    def __init__(self, streamSize=DEFAULT_STREAM_SIZE, sceneTune=None, tuneCacheSize=sampleTune.DEFAULT_CACHE_SIZE, decode=True):
         self.currSampleDir = 2
         self.sampleSets = list()
+        self.streamSize = streamSize
+        self.decode = decode    #False when the audio process plays the kits (see SampleSet)
+        self.sceneTune = sceneTune or []    #semitones per nanoPad scene
+        self.tuneCache = sampleTune.TuneCache(tuneCacheSize)
 
     def findSamples(self):
         """ search topSampleDir for all sample directories """
@@ -622,8 +1003,112 @@ class SampleMgr():
 
         for sampDir in self.sampleDirs:
             #fill out a sampleSet for this directory
-            sampSet = SampleSet(sampDir)
+            sampSet = SampleSet(sampDir, self.streamSize, decode=self.decode)
             self.sampleSets.append(sampSet)
+        self.logMemory()
+        self.prefetchTuned()
+
+    def logMemory(self):
+        """ how much sample data is resident vs memory-mapped """
+        sounds = [snd for sampSet in self.sampleSets for snd in sampSet.sampleSounds]
+        if not self.decode:
+            logging.info("Samples: %s, decoded by the audio process; process resident: %.1fMB",
+                         len(sounds), sampleStream.residentBytes() / 1e6)
+            return
+        streamed = [snd for snd in sounds if isinstance(snd, sampleStream.StreamedSample)]
+        (mixRate, mixSize, mixChans) = pygame.mixer.get_init()
+        loadedBytes = sum(snd.get_length() * mixRate * mixChans * abs(mixSize) // 8 for snd in sounds
+                          if not isinstance(snd, sampleStream.StreamedSample))
+        logging.info("Samples: %s loaded (%.1fMB), %s streamed (%.1fMB mapped); process resident: %.1fMB",
+                     len(sounds) - len(streamed), loadedBytes / 1e6, len(streamed),
+                     sum(snd.mappedBytes for snd in streamed) / 1e6, sampleStream.residentBytes() / 1e6)
+
+    def reloadKits(self, changedPaths):
+        """
+        hotReload callback (watcher thread) - re-decode the changed files of each changed kit, then swap the new
+        SampleSet in between ticks.  New kits are added at the end so the numbers of the kits in use don't move -
+        except with the audio process, whose kits are fixed once started & whose kit after the last is the metronome
+        """
+        for sampDir in sorted({os.path.basename(os.path.dirname(path)) for path in changedPaths}):
+            startTime = time.time()
+            sampIndx = self.index(sampDir)
+            if sampIndx is None and not self.decode:
+                logging.warning("New sample dir %s not added: the audio process needs a restart to load it", sampDir)
+                continue
+            oldSet = self.sampleSets[sampIndx] if sampIndx is not None else None
+            try:
+                newSet = SampleSet(sampDir, self.streamSize, oldSet, self.decode)
+            except (pygame.error, OSError) as ex:    #eg: file still being written - we'll see its mtime change again
+                logging.warning("Reload of sample dir %s failed: %s", sampDir, ex)
+                continue
+            decodeTime = time.time() - startTime
+            newMtime = max([mtime for path, mtime in zip(newSet.samplePaths, newSet.sampleMtimes)
+                            if os.path.normpath(path) in changedPaths], default=startTime)
+
+            def swap(sampDir=sampDir, newSet=newSet):
+                sampIndx = self.index(sampDir)
+                if sampIndx is None:
+                    self.sampleDirs.append(sampDir)
+                    self.sampleSets.append(newSet)
+                else:
+                    self.sampleSets[sampIndx] = newSet
+                if metroDir.rstrip('/').endswith('/' + sampDir):
+                    self.metro = self.findSound(newSet, 'metronome', self.metro)
+                    self.chime = self.findSound(newSet, 'triangle10', self.chime)
+                self.prefetchTuned()
+            def done(results, sampDir=sampDir, newSet=newSet, decodeTime=decodeTime, newMtime=newMtime):
+                logging.info("Reloaded sample dir %s: %s of %s files decoded in %.0fms; %.0fms from file change to swap",
+                             sampDir, newSet.numDecoded, len(newSet.samplePaths), decodeTime * 1000,
+                             (time.time() - newMtime) * 1000)
+            seqMgr.queueBatch([swap], done)
+
+    def resolve(self, sampleSet, note):
+        """ midi note -> (sample index, semitones) """
+        return sampleTune.resolveNote(note, MIDI_FIRST_NOTE, sampleSet.padTune, sampleSet.noteMap, self.sceneTune)
+
+    def resolveRef(self, sampleSet, note):
+        """
+        midi note -> (sample index, semitones, Sound, choke group), Sound None if the kit has no such sample
+        Kept per sample set, so each note is only worked out once - a reloaded kit is a new set, so starts afresh
+        """
+        ref = sampleSet.resolved.get(note)
+        if ref is None:
+            (sampIndx, semitones) = self.resolve(sampleSet, note)
+            if sampIndx < len(sampleSet.sampleSounds):
+                ref = (sampIndx, semitones, sampleSet.sampleSounds[sampIndx], sampleSet.chokes.get(sampIndx, 0))
+            else:
+                logging.debug('Sample %s does not exist in SampleSet %s', sampIndx, sampleSet.sampleDir)
+                ref = (sampIndx, semitones, None, 0)
+            sampleSet.resolved[note] = ref
+        return ref
+
+    def prefetchTuned(self):
+        """ have the current kit's pitched copies made in the background """
+        if not self.decode or not 0 <= self.currSampleDir < len(self.sampleSets):
+            return  #(the audio process plays at the original pitch; or fewer kits than the default kit number)
+        sampleSet = self.sampleSets[self.currSampleDir]
+        numPads = min(16, len(sampleSet.sampleSounds))
+        pitches = {self.resolve(sampleSet, MIDI_FIRST_NOTE + scene*16 + pad)
+                   for scene in range(max(1, len(self.sceneTune))) for pad in range(numPads)}
+        pitches.update(sampleSet.noteMap.values())
+        self.tuneCache.prefetch(sampleSet, [(sampIndx, semitones) for (sampIndx, semitones) in pitches
+                                            if sampIndx < len(sampleSet.sampleSounds)])
+
+    @staticmethod
+    def findSound(sampSet, name, default):
+        if name in sampSet.sampleNames:
+            return sampSet.sampleSounds[sampSet.sampleNames.index(name)]
+        return default
+
+    def audioKits(self):
+        """ wav paths per kit (by sampleSets index) for audioProc, with the metronome as an extra kit on the end """
+        return [sampSet.samplePaths for sampSet in self.sampleSets] + [[metroDir + 'metronome.wav', metroDir + 'triangle10.wav']]
+
+    def currSampleName(self):
+        """ the current kit's name - None if the kit number is out of range (eg: the default, with fewer kits) """
+        if 0 <= self.currSampleDir < len(self.sampleDirs):
+            return self.sampleDirs[self.currSampleDir]
+        return None
 
     def index(self, name):  #given a name (string) return the sample list index 
         for sampSet in self.sampleSets:
@@ -643,54 +1128,61 @@ class KeyTypes(Enum):
     numlock_off = auto()
 
 backspace_key = 8
-numlock_key = 300
+numlock_key = pygame.K_NUMLOCK  #(300 in pygame 1, but not in pygame 2)
+keypad_digits = [pygame.K_KP0, pygame.K_KP1, pygame.K_KP2, pygame.K_KP3, pygame.K_KP4,
+                 pygame.K_KP5, pygame.K_KP6, pygame.K_KP7, pygame.K_KP8, pygame.K_KP9]   #(not in order in pygame 2)
 class KeyEventHandler():
     """ 
     Parses numeric keypad events to be consumed by SeqManager
 
     Maintains state of modifier keys '*' and '/'
     Returns the key (if an active key) and modifier key states
+    Keys come from any keyInput source as pygame key codes (key down/up)
     """
     def __init__(self):
         self.modStar = False
         self.modSlash = False
     def parseKey(self, event):
+        """ pygame event -> key event (or None) """
+        if event.type in (pygame.KEYDOWN, pygame.KEYUP):
+            return self.keyEvent(event.key, event.type == pygame.KEYDOWN)
+    def keyEvent(self, key, down):
         #full list of pygame.K_KP_* to be found here:  http://pygame.org/docs/ref/key.html
         keyType = None
         keyVal = None
-        if (event.type == pygame.KEYDOWN):
+        if down:
             try: #see if key is [0-9], pygame K_KPx is agnostic to NumLock state
-                numRange = range(pygame.K_KP0, pygame.K_KP9+1).index(event.key)
+                numRange = keypad_digits.index(key)
             except ValueError: #nope
                 numRange = None
 
-            if (event.key == pygame.K_KP_MULTIPLY):
+            if (key == pygame.K_KP_MULTIPLY):
                 self.modStar = True
-            elif (event.key == pygame.K_KP_DIVIDE):
+            elif (key == pygame.K_KP_DIVIDE):
                 self.modSlash = True
             elif (numRange != None): #this works regardless of numlock state
                 #key = str(numRange)
                 keyType = KeyTypes.num
                 keyVal = numRange
-            elif (event.key == pygame.K_KP_PERIOD):
+            elif (key == pygame.K_KP_PERIOD):
                 keyType = KeyTypes.dot
-            elif (event.key == pygame.K_KP_PLUS):
+            elif (key == pygame.K_KP_PLUS):
                 keyType = KeyTypes.plus
-            elif (event.key == pygame.K_KP_MINUS):
+            elif (key == pygame.K_KP_MINUS):
                 keyType = KeyTypes.minus
-            elif (event.key == pygame.K_KP_ENTER):
+            elif (key == pygame.K_KP_ENTER):
                 keyType = KeyTypes.enter
-            elif (event.key == backspace_key): #can't find a mapping for backspace on the keypad
+            elif (key == backspace_key): #can't find a mapping for backspace on the keypad
                 keyType = KeyTypes.backspace
-            elif (event.key == numlock_key): 
+            elif (key == numlock_key): 
                 keyType = KeyTypes.numlock_on
 
-        elif (event.type == pygame.KEYUP): #if a modifier key, clear it
-            if (event.key == pygame.K_KP_MULTIPLY):
+        else: #if a modifier key, clear it
+            if (key == pygame.K_KP_MULTIPLY):
                 self.modStar = False
-            elif (event.key == pygame.K_KP_DIVIDE):
+            elif (key == pygame.K_KP_DIVIDE):
                 self.modSlash = False
-            elif (event.key == numlock_key): 
+            elif (key == numlock_key): 
                 keyType = KeyTypes.numlock_off
 
         if keyType != None: #got an actionable event (vs a modifier key)
@@ -707,6 +1199,8 @@ from serial import SerialException
 class Display():
     def initDisplay(self):
         self.enabled = False
+        self._shownMeas = self._shownBeat = None    #position on the lcd
+        self._numStrs = [str(x) for x in range(100)]
         self._lcd = lcdDisplay.lcdDisplay()
         try:
             self._lcd.init() #will fail if not plugged in
@@ -725,10 +1219,20 @@ class Display():
         self._lcd.write("Samp:",2,8) 
 
     def updateTime(self, meas, beat):
-        self._lcd.write(str(meas),1,1)
-        self._lcd.write(str(beat),1,3) 
+        #called every half tick, but the position only changes on the beat - skip the serial writes in between
+        if not self.enabled or (meas == self._shownMeas and beat == self._shownBeat):
+            return
+        self._shownMeas = meas
+        self._shownBeat = beat
+        self._lcd.write(self.numStr(meas),1,1)
+        self._lcd.write(self.numStr(beat),1,3) 
+
+    def numStr(self, num):
+        return self._numStrs[num] if 0 <= num < len(self._numStrs) else str(num)
 
     def updateSettings(self, bpm, sampSet, seqNum, rcd):
+        if not self.enabled:
+            return
         bpmStr = "{0:<3d}".format(bpm)
         self._lcd.write(bpmStr, 1,10)
         if rcd: rcding=rcdChar
@@ -743,15 +1247,20 @@ def main(argDict):
     if argDict['logLevel'] is not None:
         if argDict['logLevel'] == 'debug':
             logLevel = logging.DEBUG
-    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s', datefmt='%I:%M:%S %p', level=logLevel)
+    seqLog.setupLogging(logLevel, fmt='%(asctime)s:%(levelname)s:%(message)s', datefmt='%I:%M:%S %p')  #logging is written by a background thread
 
     #handle system signals (seems to be an issue when autostarting via systemd)
     def handler(signum, frame):
         logging.warning("Got a {} signal.  Ignoring".format(signum))
     signal.signal(signal.SIGHUP, handler)   # signal 1
+    signal.signal(signal.SIGUSR1, seqLog.requestDump)   #kill -USR1 <pid> dumps the flight recorder
     #signal.signal(signal.SIGTERM, handler) # signal 15
     #signal.signal(signal.SIGCONT, handler) # signal 18
 
+    if argDict['profile'] is not None:
+        profiler = seqProfile.Profiler(argDict['profile'])
+        signal.signal(signal.SIGUSR2, profiler.write)   #kill -USR2 <pid> writes the profile so far
+
     #create the main objects
     global seqMgr, sampMgr, display #need to explicitly called out as global here because we are assigning them
     try:
@@ -779,23 +1288,55 @@ def main(argDict):
     #init everything
     ################
     midi = ThreadedMidi()   #this kicks off the midi event handler
+    audioDriver = os.environ.get("SDL_AUDIODRIVER")
+    if argDict['audioProc']:
+        os.environ["SDL_AUDIODRIVER"] = "dummy"     #the audio process gets the real output device
+    realtime = None
+    if argDict['realtime'] is not None:
+        realtime = seqRealtime.Realtime(argDict['realtime'], argDict['rtPriority'] or seqRealtime.DEFAULT_PRIORITY,
+                                        {int(cpu) for cpu in argDict['rtCpus'].split(',')} if argDict['rtCpus'] else None)
+        sampleStream.streamer.realtime = realtime
     logging.info("About to start Pygame")
-    pySetup.initPygame()
+    if realtime is not None and not argDict['audioProc']:
+        with realtime.startingAudio('mixer'):   #SDL's audio thread is started by mixer.init - it inherits the priority
+            pySetup.initPygame()
+    else:
+        pySetup.initPygame()
     logging.info("After init of Pygame")
-    sampMgr = SampleMgr()
+    if argDict['fx'] is not None and not argDict['audioProc']:
+        logging.warning("--fx needs --audioProc (the pygame mixer has no block output to process) - ignoring it")
+    sceneTune = [float(semis) for semis in argDict['sceneTune'].split(',')] if argDict['sceneTune'] else None
+    sampMgr = SampleMgr(argDict['streamSize'] * 1024 * 1024 if argDict['streamSize'] is not None else DEFAULT_STREAM_SIZE,
+                        sceneTune, int(argDict['tuneCacheSize'] * 1024 * 1024) if argDict['tuneCacheSize'] is not None else sampleTune.DEFAULT_CACHE_SIZE,
+                        not argDict['audioProc'])
     sampMgr.findSamples()
     display.initDisplay()
+    if argDict['audioProc']:
+        fxConfig = fxBus.loadConfig(argDict['fx']) if argDict['fx'] is not None else None
+        audio = audioProc.AudioProcess(sampMgr.audioKits(), audioDriver, fxConfig, sampMgr.sampleDirs + [None],
+                                       realtime.settings() if realtime is not None else None, sampMgr.streamSize)
+        atexit.register(audio.close)    #free the shared memory
     seqMgr = SequenceMgr(timeSigArgs, argDict['swingTime'])  #creates SeqTime, etc... Only pass relevant args 
+    seqMgr.sync = seqSync.createSync(argDict, seqMgr.loadScene)   #None unless --syncLeader/--syncFollow
+    if argDict['audioProc']:
+        seqMgr.audio = audio
+    seqMgr.gate = argDict['gate']
+    seqMgr.realtime = realtime
+    if realtime is not None or argDict['tickStats']:
+        seqMgr.tickStats = seqRealtime.TickStats(realtime)
+    atexit.register(lambda: logging.info("Peak voices: %s (%s without choke groups & gate)", *seqMgr.peakVoices()))
     seqMgr.updateDisplay()
     seqMgr.start()
+    if argDict['ctlPort'] is not None or argDict['ctlSocket'] is not None:
+        ctlServer.CtlServer(seqMgr, port=argDict['ctlPort'], path=argDict['ctlSocket'])
     keyHandler = KeyEventHandler()
+    keySource = keyInput.openSource(argDict['keyInput'], argDict['keypad'])
+    keyLatency = keyInput.KeyLatency()
+    atexit.register(lambda: keyLatency.latencies and logging.info("Key to action latency (ms): %s", keyLatency.percentiles()))
 
     #load sequence file(s)
     if useDefault:  #no relevant args specified, so run default mode (play a scene)
-        fileName = seqMgr.SEQ_SCENE0
-        logging.info("Loading sequence file: " + fileName)
-        seqMgr.currSeq=Sequence(fileName)  
-        seqMgr.storeSeq(0)  #store into mem slot 0 
+        seqMgr.loadSeqFile(seqMgr.SEQ_SCENE0, 0)  #store into mem slot 0 
     elif argDict['loadSeq'] is not None:
         fileArgs = argDict['loadSeq']
         for fileArg in fileArgs: #loadSeq arg is a list (append option) because we want to allow multiple instances of it
@@ -805,21 +1346,44 @@ def main(argDict):
             else:   #specified a file and slot number to store it in
                 (fileName, slotNum) = fileArg.split(',')
             #fileName = savedSequenceDir + fileName  #NO - don't prepend a dir, let user specify
-            logging.info("Loading sequence file: " + fileName)
-            seqMgr.currSeq=Sequence(fileName)  #means if slots not individually specified, the last one specified will be played
-            seqMgr.storeSeq(int(slotNum))  #store into mem slot  
-
-
-    #Start pygame event loop (keyboard input) - pygame docs say it is important this is in main thread
-    while True:
-        for event in pygame.event.get():
-            #logging.debug("raw event:%s", event)
-            if event.type == pygame.QUIT:
-                logging.debug("Quit cmd")
-                pygame.quit(); #sys.exit() if sys is imported
-            keyEv = keyHandler.parseKey(event)
-            if (keyEv != None):
-                seqMgr.handleCtl(keyEv)
+            seqMgr.loadSeqFile(fileName, int(slotNum))  #means if slots not individually specified, the last one specified will be played
+
+
+    #restore the last session from the journal (eg: after a power pull), then journal from here on
+    #(by default unless sequences were asked for - once a restore was offered, or declined with --newSession, the journal
+    # moves the last session aside to previousDir)
+    restoreFrom = None
+    if argDict['restoreSession'] is not None:
+        restoreFrom = seqJournal.previousDir if argDict['restoreSession'] == 'previous' else seqJournal.journalDir
+    elif argDict['loadSeq'] is None and not argDict['newSession'] and not argDict['noJournal']:
+        restoreFrom = seqJournal.journalDir
+    if restoreFrom is not None:
+        state = seqJournal.loadSession(restoreFrom)
+        if state is not None:
+            seqMgr.restoreSession(state)
+        elif argDict['restoreSession'] is not None:
+            logging.warning("No session to restore in %s", restoreFrom)
+    if argDict['noJournal']:
+        pass
+    elif restoreFrom is None and not argDict['newSession'] and seqJournal.hasSession():
+        logging.warning("Not journaling: the last session (in %s) wasn't offered for restore, as sequences were given - "
+                        "use --restoreSession or --newSession to journal", seqJournal.journalDir)
+    else:
+        seqMgr.journal = seqJournal.Journal(seqMgr.journalState())
+
+    if argDict['hotReload']:    #pick up kit & sequence file edits without a restart
+        watcher = hotReload.MtimeWatcher()
+        watcher.watch(topSampleDir + '*' + sampleExtension, sampMgr.reloadKits)
+        watcher.watch(topSampleDir + '*/' + sampleTune.tuningFile, sampMgr.reloadKits)
+        watcher.watch(topSampleDir + '*/' + seqVoices.chokeFile, sampMgr.reloadKits)
+        watcher.watch(savedSequenceDir + '*.json', seqMgr.reloadSeqFiles)
+        watcher.start()
+
+    if realtime is not None:
+        realtime.afterStartup()     #all loaded - freeze it out of the gc's way
+
+    #Start the keypad loop - in the main thread, as pygame docs say is important if pygame is the key source
+    keyInput.keyLoop(keySource, keyHandler, seqMgr.handleCtl, keyLatency)
 
 
 #autostart if called from cmd line "python3 _myname.py_"
@@ -836,6 +1400,27 @@ if __name__ == "__main__":
     parser.add_argument("--swingTime", action='store_true', help="Use swing time")
     parser.add_argument("--loadSeq", action='append', help="load a json encoded sequence file from storedSequences. If only filename specified, will load into slot 0, can also specify slot vis --loadSeq=<fileName>,<slotNum>.  Also supports multiple files loaded to multiple slots (tested??)") 
     parser.add_argument("--logLevel", help="Set the logging level")
+    parser.add_argument("--audioProc", action='store_true', help="Mix audio in a separate process (sequenced notes & the metronome are delayed by {0}ms but frame accurate; live notes are not delayed)".format(int(audioProc.LOOKAHEAD*1000)))
+    parser.add_argument("--realtime", nargs='?', const='fifo', choices=['fifo', 'rr'], help="Real-time priority (SCHED_FIFO, or SCHED_RR) & cpu pinning for the clock & audio threads, gc frozen after startup & deferred while playing.  Needs root")
+    parser.add_argument("--rtPriority", type=int, help="Real-time priority of the clock (audio gets +{0}).  Default {1}".format(seqRealtime.AUDIO_PRIORITY_BOOST, seqRealtime.DEFAULT_PRIORITY))
+    parser.add_argument("--rtCpus", metavar="CPU,...", help="Cpus to pin the clock & audio threads to.  Default: all but cpu 0")
+    parser.add_argument("--tickStats", action='store_true', help="Log tick lateness percentiles & gc pauses every {0}s (always on with --realtime)".format(seqRealtime.REPORT_SECS))
+    parser.add_argument("--keyInput", choices=['auto', 'evdev', 'pygame'], default='auto', help="Keypad input: straight from /dev/input (evdev), via pygame's keyboard events, or evdev if a keypad can be opened else pygame (auto, the default)")
+    parser.add_argument("--keypad", action='append', metavar="DEVICE", help="Keypad input device(s) for evdev, eg: /dev/input/by-id/usb-...-event-kbd (default: every device with keypad keys)")
+    parser.add_argument("--gate", action='store_true', help="Live notes stop (with a short fade) when their pad is released")
+    parser.add_argument("--fx", metavar="FILE", help="Effects bus config (json, see fxBus.py) - with --audioProc")
+    parser.add_argument("--hotReload", action='store_true', help="Watch {0} & {1} and reload changed kits/sequence files while playing".format(topSampleDir, savedSequenceDir))
+    parser.add_argument("--profile", type=float, metavar="SECS", help="Sample all threads & write a profile to {0} after SECS (0: only on SIGUSR2)".format(seqProfile.profileDir))
+    parser.add_argument("--sceneTune", metavar="SEMIS,...", help="Pitch each nanoPad scene's pads by these semitones, eg: 0,12,-12,7 (default: all scenes play the kit as is)")
+    parser.add_argument("--tuneCacheSize", type=float, metavar="MB", help="Memory for pitched copies of samples.  Default {0}MB".format(sampleTune.DEFAULT_CACHE_SIZE // (1024*1024)))
+    parser.add_argument("--streamSize", type=float, metavar="MB", help="Stream (rather than load) samples bigger than this.  Default {0}MB".format(DEFAULT_STREAM_SIZE // (1024*1024)))
+    parser.add_argument("--restoreSession", nargs='?', const='last', choices=['last', 'previous'], help="Restore the last session (sequences, banks, bpm, sample) from the edit journal - done anyway unless sequences are given on the cmd line (then nothing is journaled until a session is restored or --newSession) or --newSession.  'previous' restores the one before (the last is moved to {0} when a new session starts)".format(seqJournal.previousDir))
+    parser.add_argument("--newSession", action='store_true', help="Don't restore the last session (it is kept in {0})".format(seqJournal.previousDir))
+    parser.add_argument("--noJournal", action='store_true', help="Don't journal edits to " + seqJournal.journalDir)
+    parser.add_argument("--syncLeader", type=int, metavar="PORT", help="Lead tempo/phase of other instances, listening on this UDP port")
+    parser.add_argument("--ctlPort", type=int, metavar="PORT", help="Listen for control cmds (JSON lines) on localhost TCP port")
+    parser.add_argument("--ctlSocket", metavar="PATH", help="Listen for control cmds (JSON lines) on a Unix socket")
+    parser.add_argument("--syncFollow", metavar="HOST:PORT", help="Follow tempo/phase of the leader at this address")
     args = parser.parse_args()
     argDict = vars(args)
     print ("args: ", argDict)
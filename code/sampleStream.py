@@ -0,0 +1,243 @@
+import os
+import math
+import time
+import struct
+import threading
+import logging
+import numpy
+import pygame
+
+"""
+Streamed playback for big samples (long loops, stems...) - memory-mapped PCM fed to a mixer channel in chunks
+
+A StreamedSample looks like a pygame.mixer.Sound as far as the sequencer is concerned (play/stop/fadeout/get_length),
+but only its first chunk is decoded up front.  The rest stays in the (memory-mapped) wav file and a single streamer
+thread converts & queues the next chunk on each playing channel just before it is needed.
+A channel that runs dry before the sample has finished is counted as an underrun.
+
+MappedPcm is the same idea for the audio process (--audioProc): a memory-mapped wav whose frames are converted as
+they're mixed.
+"""
+
+CHUNK_SECS = 0.25       #length of each queued chunk
+POLL_SECS = 0.02        #how often the streamer checks on the playing channels
+EARLY_END_SECS = 0.05   #a channel that went quiet this much before its chunks ran out was stopped or stolen, not starved
+
+class WavFormatError(Exception):
+    pass
+
+def readWavHeader(path):
+    """ returns (sample rate, num channels, numpy dtype, data offset, num frames) of a PCM wav file """
+    with open(path, 'rb') as wavFile:
+        riff, size, wave = struct.unpack('<4sI4s', wavFile.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise WavFormatError("not a wav file: " + path)
+        fmt = None
+        while True:
+            header = wavFile.read(8)
+            if len(header) < 8:
+                raise WavFormatError("no data chunk: " + path)
+            chunkId, chunkSize = struct.unpack('<4sI', header)
+            if chunkId == b'fmt ':
+                fmt = struct.unpack('<HHIIHH', wavFile.read(16))
+                wavFile.seek(chunkSize - 16 + (chunkSize & 1), os.SEEK_CUR)
+            elif chunkId == b'data':
+                offset = wavFile.tell()
+                break
+            else:
+                wavFile.seek(chunkSize + (chunkSize & 1), os.SEEK_CUR)
+    if fmt is None:
+        raise WavFormatError("no fmt chunk: " + path)
+    (formatTag, numChans, rate, byteRate, blockAlign, bits) = fmt
+    if formatTag != 1 or bits not in (8, 16, 32):   #plain integer PCM only
+        raise WavFormatError("unsupported wav format {0}/{1}bit: {2}".format(formatTag, bits, path))
+    dtype = {8: numpy.uint8, 16: numpy.int16, 32: numpy.int32}[bits]
+    numFrames = min(chunkSize, os.path.getsize(path) - offset) // blockAlign
+    return rate, numChans, dtype, offset, numFrames
+
+def convertFrames(pcm, srcPos, mixChans):
+    """ int16 frames (len(srcPos) x mixChans) interpolated from pcm at the (fractional, increasing) frame positions srcPos """
+    first = int(srcPos[0])
+    src = numpy.asarray(pcm[first:int(srcPos[-1]) + 2], dtype=numpy.float32)  #only these pages get read
+    if pcm.dtype == numpy.uint8:
+        src = (src - 128) * 256
+    elif pcm.dtype == numpy.int32:
+        src /= 65536
+    idx = srcPos - first
+    lo = idx.astype(numpy.int64)
+    frac = (idx - lo)[:, numpy.newaxis]
+    out = src[lo] * (1 - frac) + src[lo + 1] * frac     #linear interpolation to the mixer rate
+
+    if out.shape[1] != mixChans:   #fit to the mixer's channel count
+        out = out.mean(axis=1, keepdims=True)
+        out = numpy.repeat(out, mixChans, axis=1)
+    return numpy.clip(out, -32768, 32767).astype(numpy.int16)
+
+def loadPcm(path, mixRate, mixChans):
+    """ decode a whole wav to int16 frames at the mixer rate & channel count - no pygame needed """
+    rate, numChans, dtype, offset, numFrames = readWavHeader(path)
+    pcm = numpy.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(numFrames, numChans))
+    srcPos = numpy.arange(0, numFrames - 1, rate / mixRate)
+    if len(srcPos) == 0:
+        return numpy.zeros((0, mixChans), dtype=numpy.int16)
+    return convertFrames(pcm, srcPos, mixChans)
+
+class MappedPcm():
+    """
+    a memory-mapped wav that reads like loadPcm's frames (len, slices) - each slice is converted as it is read, so only
+    the pages played are touched.  The audio process (audioProc) streams big samples with it
+    """
+    def __init__(self, path, mixRate, mixChans):
+        self.path = path
+        rate, numChans, dtype, offset, numFrames = readWavHeader(path)
+        self.pcm = numpy.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(numFrames, numChans))
+        self.mixChans = mixChans
+        self.step = rate / mixRate   #source frames per output frame
+        self.numFrames = math.ceil((numFrames - 1) / self.step) if numFrames > 1 else 0   #len(loadPcm(...))
+
+    def __len__(self):
+        return self.numFrames
+
+    def __getitem__(self, frames):
+        start, stop, stride = frames.indices(self.numFrames)
+        if stop <= start:
+            return numpy.zeros((0, self.mixChans), dtype=numpy.int16)
+        return convertFrames(self.pcm, numpy.arange(start, stop) * self.step, self.mixChans)
+
+class StreamedSample():
+    """ Sound-like wrapper around a memory-mapped wav """
+    def __init__(self, path):
+        self.path = path
+        rate, numChans, dtype, offset, numFrames = readWavHeader(path)
+        self.rate = rate
+        self.pcm = numpy.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(numFrames, numChans))
+        (self.mixRate, mixSize, self.mixChans) = pygame.mixer.get_init()
+        self.step = rate / self.mixRate   #source frames per output frame
+        self.firstChunk, self.firstEnd = self.makeChunk(0.0)  #pre-rolled, so play() has nothing to convert
+
+    @property
+    def mappedBytes(self):
+        return self.pcm.nbytes
+
+    def get_length(self):
+        return len(self.pcm) / self.rate
+
+    def makeChunk(self, pos):
+        """ convert the chunk starting at source frame pos to a Sound.  Returns (Sound or None, next pos) """
+        numOut = int(CHUNK_SECS * self.mixRate)
+        srcPos = pos + numpy.arange(numOut) * self.step
+        srcPos = srcPos[srcPos < len(self.pcm) - 1]
+        if len(srcPos) == 0:
+            return None, pos
+        out = convertFrames(self.pcm, srcPos, self.mixChans)
+        return pygame.mixer.Sound(buffer=out.tobytes()), pos + len(srcPos) * self.step
+
+    def play(self):
+        channel = pygame.mixer.find_channel(True)
+        channel.play(self.firstChunk)
+        streamer.add(StreamVoice(self, channel))
+        return channel
+
+    def stop(self):
+        streamer.stopSample(self, 0)
+
+    def fadeout(self, ms):
+        streamer.stopSample(self, ms)
+
+class StreamVoice():
+    """ one playing instance of a StreamedSample """
+    def __init__(self, sample, channel):
+        self.sample = sample
+        self.channel = channel
+        self.playing = sample.firstChunk
+        self.queued = None
+        self.pos = sample.firstEnd
+        self.done = self.pos >= len(sample.pcm) - 1
+        self.runsOut = time.time() + sample.firstChunk.get_length()    #when the chunks given to the channel end
+
+class Streamer(threading.Thread):
+    """ keeps every playing stream's channel queued up one chunk ahead """
+    def __init__(self):
+        threading.Thread.__init__(self, name="sampleStream", daemon=True)
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.voices = list()
+        self.underruns = 0
+        self.peakVoices = 0
+        self.started = False
+        self.realtime = None    #seqRealtime.Realtime - set in real-time mode
+
+    def add(self, voice):
+        with self.lock:
+            self.voices.append(voice)
+            self.peakVoices = max(self.peakVoices, len(self.voices))
+            if not self.started:
+                self.started = True
+                self.start()
+        self.wake.set()
+
+    def stopSample(self, sample, ms):
+        with self.lock:
+            for voice in self.voices:
+                if voice.sample is sample:
+                    voice.done = True
+                    if ms:
+                        voice.channel.fadeout(ms)
+                    else:
+                        voice.channel.stop()
+
+    def run(self):
+        if self.realtime is not None:
+            self.realtime.promoteAudio('stream')    #feeds the audio, so ranks with it
+        while True:
+            self.wake.wait(POLL_SECS)
+            self.wake.clear()
+            with self.lock:
+                voices = list(self.voices)
+            for voice in voices:
+                if not self.service(voice):
+                    with self.lock:
+                        self.voices.remove(voice)
+            if not voices:
+                self.wake.wait()    #idle until something plays
+
+    def service(self, voice):
+        """ top up one voice.  Returns False once it is finished with """
+        current = voice.channel.get_sound()
+        if current is None:
+            if voice.done:
+                return False
+            if time.time() < voice.runsOut - EARLY_END_SECS:
+                return False    #stopped, or taken over by a sound that has since finished - not ours any more
+            self.underruns += 1     #ran dry mid-sample (both chunks played out before we got back to it)
+            logging.warning("Stream underrun: %s (total %s)", voice.sample.path, self.underruns)
+            voice.playing = voice.queued = None     #carry on from where the chunks ran out
+        elif current is not voice.playing and current is not voice.queued:
+            return False    #channel was taken over by another sound
+        elif current is voice.queued:
+            voice.playing, voice.queued = voice.queued, None
+        if voice.done:
+            return voice.channel.get_busy()
+        if voice.queued is None:
+            chunk, voice.pos = voice.sample.makeChunk(voice.pos)
+            if chunk is None:
+                voice.done = True
+            elif current is None:
+                voice.channel.play(chunk)
+                voice.playing = chunk
+                voice.runsOut = time.time() + chunk.get_length()
+            else:
+                voice.channel.queue(chunk)
+                voice.queued = chunk
+                voice.runsOut = max(voice.runsOut, time.time()) + chunk.get_length()
+        return True
+
+streamer = Streamer()
+
+def residentBytes():
+    """ resident memory of this process (linux) - 0 if unknown """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
@@ -0,0 +1,179 @@
+import os
+import json
+import math
+import queue
+import threading
+import collections
+import logging
+import numpy
+import pygame
+import sampleStream
+
+"""
+Pitched playback of kit samples - tuned toms, a melodic 808...
+
+A note resolves to (sample, semitones) from:
+  - the kit's tuning map, samples/<kit>/tuning.json (optional):
+        {"pads": {"<sample name>": semitones, ...},             per-pad tuning
+         "notes": {"<midi note>": ["<sample name>", semitones]}} whole notes mapped to a pitched sample
+  - --sceneTune: semitones added per nanoPad scene (each scene's pads are 16 notes higher than the last)
+
+Pitched copies are resampled (vectorized numpy, sampleStream.convertFrames) into a bounded LRU cache keyed by
+(sample path, mtime, semitones), so a hot reloaded sample never plays a stale copy.  Misses are filled by a
+background thread - a trigger never waits on resampling; until its copy is ready a note plays at the original pitch.
+The current kit's pitched copies are prefetched whenever the kit is selected, so that should be rare.
+"""
+
+tuningFile = 'tuning.json'
+DEFAULT_CACHE_SIZE = 32*1024*1024   #bytes of pitched copies kept
+PADS_PER_SCENE = 16
+
+def tuningSection(tuning, section, sampleDir):
+    """ the map's "pads" or "notes" object - empty if it's missing or isn't one """
+    entries = tuning.get(section, dict())
+    if not isinstance(entries, dict):
+        logging.warning("Tuning map in %s: ignoring %s - not a JSON object", sampleDir, section)
+        return dict()
+    return entries
+
+def toSemitones(semis):
+    """ a finite number of semitones, else ValueError/TypeError """
+    if isinstance(semis, (str, bool)):     #float() would take "12" & True
+        raise TypeError("semitones must be a number, not {0!r}".format(semis))
+    semis = float(semis)
+    if not math.isfinite(semis):
+        raise ValueError("semitones must be finite, not {0}".format(semis))
+    return semis
+
+def loadTuning(sampleDir, sampleNames):
+    """ returns ({pad index: semitones}, {midi note: (pad index, semitones)}) from the kit's tuning map """
+    try:
+        with open(os.path.join(sampleDir, tuningFile)) as tuneFile:
+            tuning = json.load(tuneFile)
+    except FileNotFoundError:
+        return dict(), dict()
+    except (OSError, ValueError) as ex:
+        logging.warning("Ignoring tuning map in %s: %s", sampleDir, ex)
+        return dict(), dict()
+    if not isinstance(tuning, dict):
+        logging.warning("Ignoring tuning map in %s: not a JSON object", sampleDir)
+        return dict(), dict()
+    padTune = dict()
+    noteMap = dict()
+    for name, semis in tuningSection(tuning, 'pads', sampleDir).items():
+        try:
+            semis = toSemitones(semis)
+        except (TypeError, ValueError) as ex:
+            logging.warning("Tuning map in %s: ignoring pad %s: %s", sampleDir, name, ex)
+            continue
+        if name in sampleNames:
+            padTune[sampleNames.index(name)] = semis
+        else:
+            logging.warning("Tuning map in %s: no sample %s", sampleDir, name)
+    for note, entry in tuningSection(tuning, 'notes', sampleDir).items():
+        try:
+            (name, semis) = entry
+            note, semis = int(note), toSemitones(semis)
+        except (TypeError, ValueError) as ex:
+            logging.warning("Tuning map in %s: ignoring note %s: %s", sampleDir, note, ex)
+            continue
+        if name in sampleNames:
+            noteMap[note] = (sampleNames.index(name), semis)
+        else:
+            logging.warning("Tuning map in %s: no sample %s", sampleDir, name)
+    return padTune, noteMap
+
+def resolveNote(note, firstNote, padTune, noteMap, sceneTune):
+    """ midi note -> (sample index, semitones) """
+    if note in noteMap:
+        return noteMap[note]
+    sampIndx = (note-firstNote) % PADS_PER_SCENE   #mod 16 is because notes in alt scenes on nanoPad2 progressively higher up
+    scene = (note-firstNote) // PADS_PER_SCENE
+    semitones = padTune.get(sampIndx, 0.0)
+    if 0 <= scene < len(sceneTune):
+        semitones += sceneTune[scene]
+    return sampIndx, semitones
+
+def resample(pcm, semitones, mixChans):
+    """ pcm (frames x chans int16) pitched by semitones - played faster/slower, so shorter/longer too """
+    step = 2 ** (semitones / 12)
+    srcPos = numpy.arange(0, len(pcm) - 1, step)
+    if len(srcPos) == 0:
+        return numpy.zeros((0, mixChans), dtype=numpy.int16)
+    return sampleStream.convertFrames(pcm, srcPos, mixChans)
+
+class TuneCache(threading.Thread):
+    """ LRU cache of pitched Sounds, filled in the background """
+    def __init__(self, maxBytes=DEFAULT_CACHE_SIZE):
+        threading.Thread.__init__(self, name="sampleTune", daemon=True)
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.sounds = collections.OrderedDict()     #(path, mtime, semitones) -> (Sound, bytes), oldest first
+        self.numBytes = 0
+        self.pending = set()
+        self.requests = queue.SimpleQueue()
+        self.hits = self.misses = self.evictions = 0
+        self.started = False
+
+    def get(self, sampleSet, sampIndx, semitones):
+        """ the pitched Sound if it is ready, else the original (& have it made) - never blocks on resampling """
+        sound = sampleSet.sampleSounds[sampIndx]
+        if isinstance(sound, sampleStream.StreamedSample):
+            return sound    #far too big to copy - streams always play at the original pitch
+        key = (sampleSet.samplePaths[sampIndx], sampleSet.sampleMtimes[sampIndx], semitones)
+        with self.lock:
+            entry = self.sounds.get(key)
+            if entry is not None:
+                self.sounds.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            self._request(key, sound)
+        logging.debug("Tune cache miss: %s", key)
+        return sound
+
+    def prefetch(self, sampleSet, pitches):
+        """ have the pitched copies for [(sample index, semitones)] made ahead of use """
+        with self.lock:
+            for sampIndx, semitones in pitches:
+                sound = sampleSet.sampleSounds[sampIndx]
+                key = (sampleSet.samplePaths[sampIndx], sampleSet.sampleMtimes[sampIndx], semitones)
+                if semitones and key not in self.sounds and not isinstance(sound, sampleStream.StreamedSample):
+                    self._request(key, sound)
+
+    def _request(self, key, sound):
+        if key not in self.pending:     #(lock held)
+            self.pending.add(key)
+            self.requests.put((key, sound))
+            if not self.started:    #only needs a thread once something is pitched
+                self.started = True
+                self.start()
+
+    def run(self):
+        (mixRate, mixSize, mixChans) = pygame.mixer.get_init()
+        while True:
+            key, sound = self.requests.get()
+            try:
+                pcm = pygame.sndarray.array(sound)
+                if pcm.ndim == 1:
+                    pcm = pcm[:, numpy.newaxis]
+                tuned = resample(pcm, key[2], mixChans)
+                entry = (pygame.mixer.Sound(buffer=tuned.tobytes()), tuned.nbytes)
+            except (pygame.error, ValueError) as ex:
+                logging.warning("Can't pitch %s: %s", key[0], ex)
+                with self.lock:
+                    self.pending.discard(key)
+                continue
+            with self.lock:
+                self.pending.discard(key)
+                self.sounds[key] = entry
+                self.numBytes += entry[1]
+                while self.numBytes > self.maxBytes and len(self.sounds) > 1:
+                    oldKey, (oldSound, oldBytes) = self.sounds.popitem(last=False)
+                    self.numBytes -= oldBytes
+                    self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.sounds), 'bytes': self.numBytes, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
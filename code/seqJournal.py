@@ -0,0 +1,159 @@
+import time
+import os
+import glob
+import json
+import queue
+import threading
+import logging
+import copy
+
+"""
+Append-only edit journal - so a power pull doesn't lose the session
+
+Every edit (notes, deletes, clears, bank stores, sequence changes, bpm, swing & sample changes) is handed to
+Journal.append(), which only puts it on a queue.  A background writer thread writes whatever has queued up in one go
+and fsyncs once for the lot (group commit), so no fsync ever runs on the clock, midi or keypad threads.
+
+The writer replays the entries into its own copy of the session state, so it can periodically write that state out as
+a snapshot and start a fresh journal (compaction) without touching the live objects.  Files live in journalDir:
+    snapshot.json       full session state, tagged with a generation number
+    journal.<gen>.jsonl edits made since the snapshot of that generation
+On startup the last session's snapshot is loaded and its journal replayed (unless --newSession, or sequences were given
+on the cmd line).  Once a restore was offered (or declined with --newSession), before the new session writes anything
+the last one's files are moved to previousDir - --restoreSession previous brings that one back.  A run given sequences
+instead doesn't journal at all while there's a last session, so a session is never lost before a restore was offered.
+"""
+
+journalDir = 'journal/'
+previousDir = journalDir + 'previous/'
+SNAPSHOT_EVERY = 1000   #compact after this many entries
+SNAPSHOT_SECS = 300     #... or this long since the last snapshot (if anything changed)
+NUM_BANKS = 10
+
+def emptyState():
+    return {'gen': 0, 'bpm': None, 'swing': None, 'sample': None, 'seqNum': 0,
+            'seq': None, 'added': [], 'banks': [None] * NUM_BANKS}
+
+def applyEntry(state, entry):
+    """ replay one journal entry into a session state dict """
+    kind = entry[0]
+    if kind == 'add':   #('add', tick, note)
+        tickNotes = state['seq']['noteList'][entry[1]]
+        if len(tickNotes) >= entry[3]:
+            del tickNotes[0]
+        tickNotes.append(entry[2])
+        state['added'].append(entry[1])
+    elif kind == 'del':
+        if state['added']:
+            state['seq']['noteList'][state['added'].pop()].pop()
+    elif kind == 'clear':
+        state['seq']['noteList'] = [list() for x in state['seq']['noteList']]
+        state['added'] = []
+    elif kind == 'seq':     #('seq', sequence dict) - current sequence replaced
+        state['seq'] = entry[1]
+        state['added'] = []
+    elif kind == 'store':   #('store', slot)
+        state['banks'][entry[1]] = copy.deepcopy(state['seq'])
+    elif kind == 'bank':    #('bank', slot, sequence dict) - bank replaced from outside (eg: file reload)
+        state['banks'][entry[1]] = entry[2]
+    elif kind in ('bpm', 'swing', 'sample', 'seqNum'):
+        state[kind] = entry[1]
+    else:
+        logging.warning("Unknown journal entry: %s", entry)
+
+def loadSession(fromDir=journalDir):
+    """ rebuild the last session state (in fromDir) from snapshot + journal.  Returns None if there isn't one """
+    try:
+        with open(fromDir + 'snapshot.json') as snapFile:
+            state = json.load(snapFile)
+    except (OSError, ValueError):
+        return None
+    numEntries = 0
+    try:
+        with open(fromDir + 'journal.{0}.jsonl'.format(state['gen'])) as journalFile:
+            for line in journalFile:
+                try:
+                    entry = json.loads(line)
+                except ValueError:  #torn last write
+                    break
+                applyEntry(state, entry)
+                numEntries += 1
+    except OSError:
+        pass
+    logging.info("Restored session from %s: snapshot gen %s + %s journal entries", fromDir, state['gen'], numEntries)
+    return state
+
+def lastSessionFiles():
+    return glob.glob(journalDir + 'snapshot.json') + glob.glob(journalDir + 'journal.*.jsonl')
+
+def hasSession():
+    """ is there a last session in journalDir """
+    return bool(lastSessionFiles())
+
+def rotateSession():
+    """ move the last session's files to previousDir (replacing the one before) - only once it was offered for restore """
+    lastFiles = lastSessionFiles()
+    if not lastFiles:
+        return
+    os.makedirs(previousDir, exist_ok=True)
+    for oldFile in glob.glob(previousDir + '*'):
+        os.unlink(oldFile)
+    for lastFile in lastFiles:
+        os.replace(lastFile, previousDir + os.path.basename(lastFile))
+
+class Journal(threading.Thread):
+    """ background journal writer - append() is all the other threads ever call """
+    def __init__(self, state):
+        threading.Thread.__init__(self, name="journal", daemon=True)
+        self.state = state  #writer's own copy of the session, kept up to date by replaying entries
+        self.queue = queue.SimpleQueue()
+        self._file = None
+        os.makedirs(journalDir, exist_ok=True)
+        rotateSession()     #(before the writer's first snapshot replaces it)
+        self.start()
+
+    def append(self, entry):
+        """ entry is a tuple of plain (json-able) values that nobody will mutate afterwards """
+        self.queue.put(entry)
+
+    def run(self):
+        self._snapshot()
+        sinceSnapshot = 0
+        lastSnapshot = time.time()
+        while True:
+            batch = [self.queue.get()]
+            while True:     #group everything that has queued up behind it
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = list()
+            for entry in batch:
+                applyEntry(self.state, entry)
+                lines.append(json.dumps(entry, separators=(',', ':')))
+            self._file.write('\n'.join(lines) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            sinceSnapshot += len(batch)
+
+            if sinceSnapshot >= SNAPSHOT_EVERY or time.time() - lastSnapshot > SNAPSHOT_SECS:
+                self._snapshot()
+                sinceSnapshot = 0
+                lastSnapshot = time.time()
+
+    def _snapshot(self):
+        """ write the state as a new generation & start its (empty) journal """
+        startTime = time.time()
+        self.state['gen'] += 1
+        tmpName = journalDir + 'snapshot.json.tmp'
+        with open(tmpName, mode='w') as snapFile:
+            json.dump(self.state, snapFile, separators=(',', ':'))
+            snapFile.flush()
+            os.fsync(snapFile.fileno())
+        os.replace(tmpName, journalDir + 'snapshot.json')  #atomic - a crash leaves the old or new snapshot
+        if self._file is not None:
+            self._file.close()
+        for oldJournal in glob.glob(journalDir + 'journal.*.jsonl'):    #older generations of this session
+            os.unlink(oldJournal)
+        self._file = open(journalDir + 'journal.{0}.jsonl'.format(self.state['gen']), mode='a')
+        logging.debug("Journal snapshot gen %s took %.1fms", self.state['gen'], (time.time() - startTime) * 1000)
@@ -0,0 +1,128 @@
+import time
+import sys
+import queue
+import logging
+import logging.handlers
+import atexit
+import numpy
+
+"""
+Logging that keeps disk (and formatting) stalls off the clock, midi & keypad threads
+
+Loggers only put records on a queue; a background QueueListener thread formats & writes them.
+Also holds the flight recorder - a ring buffer of the last N tick & note events, dumped (from the listener thread)
+whenever a warning is logged, or on SIGUSR1.
+"""
+
+FLIGHT_SIZE = 2048      #number of events kept by the flight recorder
+DUMP_MIN_INTERVAL = 10  #secs - don't dump again on a burst of warnings
+DUMP_KINDS = ('tick', 'note')   #nothing worth dumping until one of these has been recorded (eg: startup warnings)
+
+class FlightRecorder():
+    """
+    ring buffer of (time, kind, a, b) events - cheap enough to call from the tick.  a & b are numbers (or None)
+    The ring is preallocated arrays plus a write count, so recording an event leaves nothing allocated behind.  There's
+    no lock: threads recording at the same moment can overwrite each other's event - it's only diagnostics
+    """
+    def __init__(self, size=FLIGHT_SIZE):
+        self.size = size
+        self.times = numpy.zeros(size)
+        self.kinds = numpy.zeros(size, dtype=numpy.int16)
+        self.a = numpy.full(size, numpy.nan)    #nan for None
+        self.b = numpy.full(size, numpy.nan)
+        self.kindNames = list()     #kind number -> name
+        self.kindNums = dict()
+        self.count = 0  #events ever recorded - the next goes in slot count % size
+
+    def record(self, kind, a=None, b=None):
+        kindNum = self.kindNums.get(kind)
+        if kindNum is None:     #(first of its kind)
+            kindNum = self.kindNums.setdefault(kind, len(self.kindNames))
+            self.kindNames.append(kind)
+        slot = self.count % self.size
+        self.count += 1
+        self.times[slot] = time.time()
+        self.kinds[slot] = kindNum
+        self.a[slot] = numpy.nan if a is None else a
+        self.b[slot] = numpy.nan if b is None else b
+
+    def events(self):
+        """ [(time, kind, a, b)], oldest first """
+        count = self.count
+        return [(float(self.times[slot]), self.kindNames[self.kinds[slot]], self.value(self.a[slot]), self.value(self.b[slot]))
+                for slot in (event % self.size for event in range(max(0, count - self.size), count))]
+
+    @staticmethod
+    def value(value):
+        if numpy.isnan(value):
+            return None
+        return int(value) if value.is_integer() else float(value)
+
+    def dump(self, stream):
+        events = self.events()
+        stream.write("==== flight recorder: last {0} events ====\n".format(len(events)))
+        for (t, kind, a, b) in events:
+            stamp = time.strftime('%I:%M:%S', time.localtime(t)) + '.{0:06d}'.format(int(t % 1 * 1e6))
+            stream.write("{0} {1:<6} {2} {3}\n".format(stamp, kind, a, b))
+        stream.write("==== end flight recorder ====\n")
+        stream.flush()
+
+    def recorded(self, kinds):
+        """ has an event of any of these kinds been recorded? """
+        return any(kind in self.kindNums for kind in kinds)
+
+flight = FlightRecorder()   #global for easy access from the hot paths
+
+class FlightDumpHandler(logging.Handler):
+    """
+    dumps the flight recorder on warnings - once something has played (eg: not for "Display LCD not found" at
+    startup).  Runs on the listener thread, not the thread that logged
+    """
+    def __init__(self, stream, level=logging.WARNING):
+        super().__init__(level)
+        self.stream = stream
+        self._lastDump = 0
+
+    def emit(self, record):
+        now = time.time()
+        if not getattr(record, 'forceDump', False):
+            if now - self._lastDump < DUMP_MIN_INTERVAL or not flight.recorded(DUMP_KINDS):
+                return
+        self._lastDump = now
+        flight.dump(self.stream)
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Only merges msg & args in the calling thread (args may change after the call); the Formatter work
+    (timestamps etc...) is left for the listener thread
+    """
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:     #rare - render the traceback now, the frames won't survive the queue
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        self.queue.put_nowait(record)
+
+def setupLogging(logLevel, fmt, datefmt, stream=sys.stderr):
+    """ route all logging through a queue drained by a background thread """
+    logQueue = queue.SimpleQueue()
+    streamHandler = logging.StreamHandler(stream)
+    streamHandler.setFormatter(logging.Formatter(fmt, datefmt))
+    listener = logging.handlers.QueueListener(logQueue, streamHandler, FlightDumpHandler(stream),
+                                              respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  #flush what is queued on the way out
+
+    queueHandler = LazyQueueHandler(logQueue)
+    root = logging.getLogger()
+    root.handlers = [queueHandler]
+    root.setLevel(logLevel)
+    return listener
+
+def requestDump(signum=None, frame=None):
+    """ signal handler - dump the flight recorder (on the listener thread) """
+    logging.warning("Flight recorder dump requested", extra={'forceDump': True})
@@ -0,0 +1,222 @@
+import sys
+import os
+import gc
+import time
+import datetime
+import dis
+import threading
+import logging
+import collections
+import builtins
+import inspect
+import types
+
+"""
+Low overhead sampling profiler (--profile=<secs>) - which subsystem/thread is eating the time?
+
+A background thread grabs the python stack of every other thread (sys._current_frames) every SAMPLE_SECS
+and counts each (thread name, subsystem, stack).  The subsystem is decided by the innermost frame that matches
+SUBSYSTEM_FUNCS / SUBSYSTEM_FILES, eg: a serial write made by Display.updateTime from the clock thread counts as
+'display' on thread 'clock'.
+Samples of a thread blocked in a known blocking call (BLOCKING_CALLS, by module & qualified name) count as idle.
+Blocking calls are mostly C (time.sleep, socket.recvfrom, SimpleQueue.get...), which have no frame of their own - so
+it's the call the innermost frame is in the middle of (the CALL instruction at f_lasti) that is checked, looked up on
+the frame's objects so eg: a SimpleQueue.get isn't mistaken for a dict.get, as well as the innermost frame's own
+function (for the python ones, eg: threading.Condition.wait).
+Overhead, measured on the real clock (25 half ticks/sec, rock sequence, 8 other blocked threads, 30s runs): process
+CPU 1.0-1.1% of one core without --profile, 3.9-4.6% with; tick lateness p50 0.26ms without, 0.20-0.23ms with (the
+sampling keeps the CPU awake), p99 0.40-0.52ms vs 0.39-0.90ms - the max (3-15ms) is noise either way.
+Garbage collections are timed separately via gc.callbacks.
+
+After <secs> (or on SIGUSR2) it writes to profileDir:
+    <date>.collapsed    collapsed stacks - feed to flamegraph.pl or speedscope
+    <date>.txt          summary - busy % per thread & subsystem, gc time
+"""
+
+profileDir = 'profile/'
+SAMPLE_SECS = 0.01  #100Hz
+
+#innermost match wins
+SUBSYSTEM_FUNCS = {
+    '_run': 'tick', 'advanceSequence': 'tick', 'advanceTime': 'tick', 'runPendingBatches': 'tick',
+    'playMidiNote': 'audio',
+    'updateTime': 'display', 'updateSettings': 'display', 'updateDisplay': 'display',
+    'handleNoteIn': 'midi', 'handleSceneChange': 'midi',
+    'handleCtl': 'keypad', 'parseKey': 'keypad', 'keyEvent': 'keypad', 'main': 'keypad',
+}
+SUBSYSTEM_FILES = {
+    'lcdDisplay.py': 'display', 'serialposix.py': 'display',
+    'mido': 'midi', 'rtmidi': 'midi',
+    'seqSync.py': 'sync', 'ctlServer.py': 'ctlServer', 'seqJournal.py': 'journal',
+    'seqLog.py': 'logging', 'sampleStream.py': 'stream', 'seqProfile.py': 'profiler', 'keyInput.py': 'keypad',
+}
+BLOCKING_CALLS = {
+    #C - called from the innermost frame
+    'time.sleep', 'select.select', 'select.poll.poll', 'select.epoll.poll', '_queue.SimpleQueue.get',
+    '_socket.socket.recv', '_socket.socket.recvfrom', '_socket.socket.recv_into', '_socket.socket.recvfrom_into',
+    '_socket.socket._accept', 'pygame.event.wait',
+    #python - the innermost frame (waiting on a lock's acquire)
+    'threading.Condition.wait', 'threading.Thread._wait_for_tstate_lock',
+}
+ROOT_OPS = {'LOAD_GLOBAL', 'LOAD_NAME', 'LOAD_FAST', 'LOAD_DEREF'}
+ATTR_OPS = {'LOAD_ATTR', 'LOAD_METHOD'}
+SETUP_OPS = {'PRECALL', 'PUSH_NULL', 'KW_NAMES', 'NOP'}    #(between the callee's loads & its CALL - skipped)
+
+_calls = dict()     #(code, f_lasti) -> ((op, name), ...) loading the function being called there (None if not a call)
+
+def callChain(frame):
+    """ the loads the call the frame is making right now starts with, eg: time & sleep of time.sleep(...), or None """
+    key = (frame.f_code, frame.f_lasti)
+    if key not in _calls:
+        _calls[key] = None
+        code = frame.f_code
+        if hasattr(code, 'co_positions'):   #(python 3.11+)
+            instructions = list(dis.get_instructions(code))
+            call = next((instr for instr in instructions if instr.offset == frame.f_lasti), None)
+            if call is not None and call.opname.startswith('CALL') and call.positions.col_offset is not None:
+                #the callee is the run of loads starting where the call's expression starts (args start later)
+                start = (call.positions.lineno, call.positions.col_offset)
+                chain = None
+                for instr in instructions:
+                    if instr.offset >= call.offset:
+                        break
+                    if (instr.positions.lineno, instr.positions.col_offset) != start or instr.opname in SETUP_OPS:
+                        continue
+                    if instr.opname in ROOT_OPS:
+                        chain = [(instr.opname, instr.argval)]
+                    elif instr.opname in ATTR_OPS and chain is not None:
+                        chain.append((instr.opname, instr.argval))
+                    else:
+                        chain = None    #eg: f(x).get() - not just loads
+                _calls[key] = tuple(chain) if chain else None
+    return _calls[key]
+
+def funcName(func):
+    """ module.qualname of a function, method or C method descriptor - eg: '_queue.SimpleQueue.get' """
+    owner = getattr(func, '__objclass__', None)     #(C methods looked up on their type)
+    module = owner.__module__ if owner is not None else getattr(func, '__module__', None)
+    qualName = getattr(func, '__qualname__', None)
+    if module is None or qualName is None:
+        return None
+    return module + '.' + qualName
+
+def pendingCall(frame):
+    """ module.qualname of the function the frame is calling right now (eg: 'time.sleep'), or None """
+    chain = callChain(frame)
+    if chain is None:
+        return None
+    (op, name) = chain[0]
+    try:
+        if op in ('LOAD_FAST', 'LOAD_DEREF'):
+            obj = frame.f_locals[name]
+        elif name in frame.f_globals:
+            obj = frame.f_globals[name]
+        else:
+            obj = getattr(builtins, name)
+        for op, name in chain[1:]:
+            attr = inspect.getattr_static(obj, name)   #(no properties run from the profiler thread)
+            if isinstance(attr, (types.MemberDescriptorType, types.GetSetDescriptorType)) and not isinstance(obj, type):
+                attr = attr.__get__(obj)    #__slots__
+            obj = attr
+    except (KeyError, AttributeError):
+        return None
+    return funcName(obj)
+
+def frameName(frame):
+    """ module.qualname of the function a frame is running """
+    code = frame.f_code
+    return "{0}.{1}".format(frame.f_globals.get('__name__'), getattr(code, 'co_qualname', code.co_name))
+
+class Profiler(threading.Thread):
+    def __init__(self, duration):
+        threading.Thread.__init__(self, name="profiler", daemon=True)
+        self.duration = duration    #secs - 0 means only write on signal
+        self.stacks = collections.Counter()     #(thread, subsystem, stack) -> samples
+        self.numSamples = 0
+        self.gcTime = 0.0
+        self.gcCounts = [0, 0, 0]
+        self._gcStart = None
+        self._startTime = None
+        self.writeLock = threading.Lock()
+        gc.callbacks.append(self._gcCallback)
+        self.start()
+
+    def _gcCallback(self, phase, info):
+        if phase == 'start':
+            self._gcStart = time.perf_counter()
+        elif self._gcStart is not None:
+            self.gcTime += time.perf_counter() - self._gcStart
+            self.gcCounts[info['generation']] += 1
+            self._gcStart = None
+
+    def run(self):
+        self._startTime = time.time()
+        nextSample = time.perf_counter()
+        myId = threading.get_ident()
+        while True:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for threadId, frame in sys._current_frames().items():
+                if threadId != myId:
+                    self.stacks[self.classify(names.get(threadId, str(threadId)), frame)] += 1
+            self.numSamples += 1
+            if self.duration and time.time() - self._startTime >= self.duration:
+                self.write()
+                gc.callbacks.remove(self._gcCallback)
+                return
+            nextSample += SAMPLE_SECS
+            time.sleep(max(0, nextSample - time.perf_counter()))
+
+    @staticmethod
+    def classify(threadName, frame):
+        stack = list()
+        subsystem = None
+        innermost = frame
+        while frame is not None:
+            code = frame.f_code
+            fileName = os.path.basename(code.co_filename)
+            stack.append("{0}:{1}".format(fileName, code.co_name))
+            if subsystem is None:
+                subsystem = SUBSYSTEM_FUNCS.get(code.co_name) or SUBSYSTEM_FILES.get(fileName)
+                if subsystem is None:
+                    for key, name in SUBSYSTEM_FILES.items():   #packages - match on the directory
+                        if key in code.co_filename:
+                            subsystem = name
+                            break
+            frame = frame.f_back
+        if stack and (frameName(innermost) in BLOCKING_CALLS or pendingCall(innermost) in BLOCKING_CALLS):
+            subsystem = 'idle'
+        stack.reverse()
+        return (threadName, subsystem or 'other', ';'.join(stack))
+
+    def write(self, signum=None, frame=None):
+        """ write collapsed stacks & summary (also the SIGUSR2 handler) """
+        with self.writeLock:
+            os.makedirs(profileDir, exist_ok=True)
+            baseName = profileDir + datetime.datetime.now().strftime("%Y_%m_%d__%H_%M_%S")
+            stacks = self.stacks.copy()
+            with open(baseName + '.collapsed', mode='w') as outFile:
+                for (threadName, subsystem, stack), count in stacks.most_common():
+                    outFile.write("{0};[{1}];{2} {3}\n".format(threadName, subsystem, stack, count))
+            summary = self.summary(stacks)
+            with open(baseName + '.txt', mode='w') as outFile:
+                outFile.write(summary)
+            logging.info("Profile written to %s.{collapsed,txt}\n%s", baseName, summary)
+
+    def summary(self, stacks):
+        elapsed = time.time() - self._startTime
+        byThread = collections.Counter()
+        bySubsystem = collections.Counter()
+        for (threadName, subsystem, stack), count in stacks.items():
+            if subsystem != 'idle':
+                byThread[threadName] += count
+                bySubsystem[subsystem] += count
+        lines = ["{0} samples over {1:.1f}s - busy % of wall time:".format(self.numSamples, elapsed)]
+        lines.append("  by thread:")
+        lines += ["    {0:<16} {1:5.1f}%".format(name, count * 100 / self.numSamples)
+                  for name, count in byThread.most_common()]
+        lines.append("  by subsystem:")
+        lines += ["    {0:<16} {1:5.1f}%".format(name, count * 100 / self.numSamples)
+                  for name, count in bySubsystem.most_common()]
+        lines.append("  gc: {0:.1f}ms total ({1:.2f}%), collections per generation: {2}".format(
+            self.gcTime * 1000, self.gcTime * 100 / elapsed, self.gcCounts))
+        return '\n'.join(lines) + '\n'
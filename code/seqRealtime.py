@@ -0,0 +1,182 @@
+import os
+import gc
+import time
+import contextlib
+import threading
+import logging
+import collections
+import numpy
+
+"""
+Opt-in real-time mode (--realtime) for the clock & audio threads, and tick lateness diagnostics
+
+Realtime:
+  - the clock thread(s), the audio process (--audioProc) or SDL's audio thread (pygame mixer) & the sample streamer get
+    SCHED_FIFO (or SCHED_RR) priority via os.sched_setscheduler - needs root (the service runs under sudo) or
+    CAP_SYS_NICE; without it we just warn
+  - they are pinned to --rtCpus (default: every core but core 0, which is left to the OS & interrupts)
+  - after startup everything loaded so far is gc.freeze()'d - sample sets, sequences, modules - so collections never
+    scan it again
+  - while playing, automatic collection is off; the clock collects itself right after a tick, and only when there is
+    time to spare before the next one - the young generations when gc would have, and a full collection when gc would
+    have (given more slack, FULL_GC_SLACK).  Playing starts at boot and never stops, so full collections can't wait
+    for a stop
+Every tick timer is a new thread - new threads inherit the creating thread's policy & affinity, so only the first of a
+run (started from the keypad/midi thread) needs promoting.  SDL's audio thread is created inside pygame.mixer.init(),
+so the main thread is promoted around that (startingAudio) for it to inherit, then put back.
+
+TickStats logs tick lateness percentiles & garbage collections every REPORT_SECS, with or without --realtime
+(--tickStats), so runs can be compared.
+"""
+
+REPORT_SECS = 30
+WINDOW = 5000           #lateness percentiles are over the last this many ticks
+DEFAULT_PRIORITY = 50
+AUDIO_PRIORITY_BOOST = 5    #audio outranks the clock - a late tick is a late note, an audio underrun is a glitch
+MIN_GC_SLACK = 0.005    #secs before the next tick needed to collect
+FULL_GC_SLACK = 0.02    #secs before the next tick needed for a full collection
+GC_YOUNG_BUDGET = 700   #allocations (net) before collecting generation 0 (gc's own default threshold)
+
+class Realtime():
+    def __init__(self, policy='fifo', priority=DEFAULT_PRIORITY, cpus=None):
+        self.policyName = policy
+        self.priority = priority
+        self.cpus = cpus
+        self.available = hasattr(os, 'sched_setscheduler')
+        if self.available:
+            self.policy = {'fifo': os.SCHED_FIFO, 'rr': os.SCHED_RR}[policy]
+            if self.cpus is None:
+                allCpus = os.sched_getaffinity(0)
+                self.cpus = allCpus - {0} if len(allCpus) > 1 else allCpus
+        else:
+            logging.warning("Real-time scheduling is not available on this platform")
+        self.failed = set()     #roles we've already warned about
+        self.frozen = 0
+        self.collections = 0
+
+    def settings(self):
+        """ picklable args for another process's Realtime """
+        return {'policy': self.policyName, 'priority': self.priority, 'cpus': self.cpus}
+
+    def promote(self, role, boost=0):
+        """ give the calling thread real-time priority & pin it """
+        if not self.available:
+            return
+        try:
+            os.sched_setscheduler(0, self.policy, os.sched_param(self.priority + boost))
+            os.sched_setaffinity(0, self.cpus)
+        except (PermissionError, OSError) as ex:
+            if role not in self.failed:
+                self.failed.add(role)
+                logging.warning("Can't make the %s thread real-time (needs root/CAP_SYS_NICE): %s", role, ex)
+            return
+        logging.debug("%s thread: %s priority %s on cpus %s", role, self.policyName, self.priority + boost, sorted(self.cpus))
+
+    def promoteAudio(self, role):
+        self.promote(role, AUDIO_PRIORITY_BOOST)
+
+    @contextlib.contextmanager
+    def startingAudio(self, role):
+        """ threads started in the block (eg: SDL's audio thread) get audio priority - the caller is put back after """
+        if not self.available:
+            yield
+            return
+        policy, param, cpus = os.sched_getscheduler(0), os.sched_getparam(0), os.sched_getaffinity(0)
+        self.promoteAudio(role)
+        try:
+            yield
+        finally:
+            try:
+                os.sched_setscheduler(0, policy, param)
+                os.sched_setaffinity(0, cpus)
+            except OSError as ex:
+                logging.warning("Can't put the main thread's scheduling back: %s", ex)
+
+    def checkClock(self):
+        """ (clock thread, every tick) promote if this run's timer chain isn't real-time yet """
+        if self.available and 'clock' not in self.failed and os.sched_getscheduler(0) != self.policy:
+            self.promote('clock')
+
+    def afterStartup(self):
+        """ everything loaded so far is long lived - move it out of the collector's way """
+        gc.collect()
+        gc.freeze()
+        self.frozen = gc.get_freeze_count()
+        logging.info("Real-time: %s priority %s on cpus %s; gc froze %s startup objects",
+                     self.policyName, self.priority, sorted(self.cpus) if self.cpus else None, self.frozen)
+
+    def playing(self, isPlaying):
+        """ automatic collection off while playing (the clock collects in its spare time), back on when stopped """
+        if isPlaying:
+            gc.disable()
+        else:
+            gc.enable()
+
+    def idle(self, nextCall):
+        """
+        (clock thread, after a tick) collect if there's garbage & time to spare - the generation gc would have: each
+        generation is due once the one below has been collected its threshold's number of times
+        """
+        if gc.isenabled():
+            return
+        counts = gc.get_count()
+        if counts[0] < GC_YOUNG_BUDGET:
+            return
+        slack = nextCall - time.time()
+        thresholds = gc.get_threshold()
+        if counts[2] >= thresholds[2] and counts[1] >= thresholds[1] and slack > FULL_GC_SLACK:
+            gc.collect(2)
+        elif slack > MIN_GC_SLACK:
+            gc.collect(1 if counts[1] >= thresholds[1] else 0)
+        else:
+            return
+        self.collections += 1
+
+class TickStats(threading.Thread):
+    """ tick lateness percentiles & gc pauses, logged every REPORT_SECS """
+    def __init__(self, realtime=None, window=WINDOW):
+        threading.Thread.__init__(self, name="tickStats", daemon=True)
+        self.realtime = realtime
+        self.lateness = collections.deque(maxlen=window)
+        self.numTicks = 0
+        self.gcCounts = [0, 0, 0]
+        self.gcSecs = 0.0
+        self.gcMax = 0.0
+        self._gcStart = None
+        gc.callbacks.append(self._gcCallback)
+        self.start()
+
+    def _gcCallback(self, phase, info):
+        if phase == 'start':
+            self._gcStart = time.perf_counter()
+        elif self._gcStart is not None:
+            took = time.perf_counter() - self._gcStart
+            self.gcSecs += took
+            self.gcMax = max(self.gcMax, took)
+            self.gcCounts[info['generation']] += 1
+            self._gcStart = None
+
+    def add(self, lateness):
+        self.lateness.append(lateness)
+        self.numTicks += 1
+
+    def percentiles(self):
+        """ tick lateness in ms: {p50, p90, p99, p99.9, max} """
+        if not self.lateness:
+            return dict()
+        values = numpy.array(self.lateness) * 1000
+        result = {'p' + format(pct, 'g'): round(float(numpy.percentile(values, pct)), 3) for pct in (50, 90, 99, 99.9)}
+        result['max'] = round(float(values.max()), 3)
+        return result
+
+    def run(self):
+        while True:
+            time.sleep(REPORT_SECS)
+            if not self.lateness:
+                continue
+            pcts = self.percentiles()
+            logging.info("Tick lateness (ms, last %s ticks) %s;  gc: %s collections by generation, %.1fms total, "
+                         "longest %.2fms%s", len(self.lateness), '/'.join("{0} {1}".format(k, v) for k, v in pcts.items()),
+                         self.gcCounts, self.gcSecs * 1000, self.gcMax * 1000,
+                         ";  realtime on ({0} collections between ticks)".format(self.realtime.collections)
+                         if self.realtime is not None else ";  realtime off")
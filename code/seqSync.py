@@ -0,0 +1,267 @@
+import time
+import threading
+import socket
+import json
+import logging
+from collections import deque
+
+"""
+Tempo & phase sync between several sequencer instances over UDP
+
+One instance leads (--syncLeader=<port>), the others follow (--syncFollow=<host>:<port>).
+
+Followers ping the leader once a second, NTP style:
+    t1 = follower send time, t2 = leader receive time, t3 = leader reply time, t4 = follower receive time
+    offset = ((t2-t1) + (t3-t4)) / 2     (leader clock - follower clock)
+    delay  = (t4-t1) - (t3-t2)
+A least squares line through the low-delay samples gives the offset and the drift (slope) of the two clocks.
+
+The leader learns about followers from their pings, and one tick before each of its bar boundaries sends them a
+"bar" beacon holding the (leader clock) time of the coming downbeat, the bar length, bpm and swing.
+The follower converts that into its own clock and, at each of its own bar ends, nudges the timer of its next
+downbeat towards the leader's.  The remaining phase error is reported continuously (seqSync.phaseError).
+
+Scene changes are quantized to the bar: the leader announces the scene with the downbeat it will apply on,
+and followers switch on their downbeat closest to it.  The scene's sequence is loaded (loadScene) when the change
+comes in, so the clock only has to swap it in.
+
+Several instances can be tried on one machine, eg:
+    SDL_AUDIODRIVER=dummy python3 sampleSeq.py --syncLeader=9000
+    SDL_AUDIODRIVER=dummy python3 sampleSeq.py --syncFollow=127.0.0.1:9000
+(tstSync.py does that & checks the follower's phase)
+"""
+
+PING_INTERVAL = 1.0     #secs between follower pings
+OFFSET_WINDOW = 32      #number of ping samples used for offset/drift estimation
+FOLLOWER_TIMEOUT = 5.0  #leader forgets a follower that hasn't pinged for this long
+PHASE_GAIN = 0.5        #fraction of the phase error corrected per bar
+PHASE_JUMP = 0.25       #errors bigger than this fraction of a bar are corrected in one go
+REPORT_BARS = 16        #log a phase error summary every this many bars
+MAX_MSG = 1024
+MSG_KEYS = {'ping': ('t1',), 'pong': ('t1', 't2', 't3'), 'bar': ('at', 'barLen', 'bpm', 'swing'), 'scene': ('scene', 'at')}
+#(number fields of each message type - anything else on the port is dropped before it reaches the clock model)
+
+def wellFormed(msg):
+    return isinstance(msg, dict) and all(isinstance(msg.get(key), (int, float)) for key in MSG_KEYS.get(msg.get('type'), ()))
+
+class SyncNode():
+    """
+    Common parts of leader & follower - the UDP socket, its listener thread and scene quantizing
+    """
+    def __init__(self, bindAddr, loadScene=None):
+        self.lock = threading.Lock()
+        self.loadScene = loadScene or (lambda scene: None)  #scene -> its sequence, loaded off the clock
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(bindAddr)
+        self.pendingScene = None
+        self._listener = threading.Thread(target=self._listen, name="seqSync", daemon=True)
+        self._listener.start()
+
+    def send(self, msg, addr):
+        try:
+            self.sock.sendto(json.dumps(msg, separators=(',', ':')).encode(), addr)
+        except OSError as ex:
+            logging.debug("sync send to %s failed: %s", addr, ex)
+
+    def _listen(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(MAX_MSG)
+                recvTime = time.time()
+                msg = json.loads(data)
+            except (OSError, ValueError) as ex:
+                logging.debug("sync receive failed: %s", ex)
+                continue
+            if not wellFormed(msg):
+                logging.warning("Ignoring malformed sync message from %s: %.100s", addr, data)
+                continue
+            try:
+                self.handleMsg(msg, addr, recvTime)
+            except (KeyError, TypeError, ValueError, AttributeError) as ex:    #(eg: wrong value types) - keep listening
+                logging.warning("Ignoring bad sync message from %s: %.100s (%r)", addr, data, ex)
+
+    def quantizeScene(self, seqMgr, scene, seq=None):
+        """
+        hold a scene change (& its loaded sequence) until the next bar boundary.  Returns False if it should be
+        applied right away
+        """
+        if not seqMgr.is_running:
+            return False
+        with self.lock:
+            self.pendingScene = (scene, seq)
+        return True
+
+    def takeScene(self):
+        with self.lock:
+            scene = self.pendingScene
+            self.pendingScene = None
+        return scene
+
+    @staticmethod
+    def barLength(seqMgr):
+        return seqMgr.seqTime.timeSig['numBeats'] * 60 / seqMgr.beatsPerMinute
+
+class SyncLeader(SyncNode):
+    """ sends bar beacons to, and answers pings from, any number of followers """
+    def __init__(self, port, loadScene=None):
+        self.followers = dict()  #addr -> time of last ping
+        self.barNum = 0
+        super().__init__(('', port), loadScene)
+        logging.info("Sync leader listening on port %s", port)
+
+    def handleMsg(self, msg, addr, recvTime):
+        if msg.get('type') == 'ping':
+            with self.lock:
+                if addr not in self.followers:
+                    logging.info("Sync follower joined: %s", addr)
+                self.followers[addr] = recvTime
+            self.send({'type': 'pong', 't1': msg['t1'], 't2': recvTime, 't3': time.time()}, addr)
+
+    def quantizeScene(self, seqMgr, scene, seq=None):
+        if not super().quantizeScene(seqMgr, scene, seq):
+            return False
+        #let the followers know in advance, so they switch on the same downbeat (the one onBarEnd will apply it on)
+        downbeat = seqMgr.nextDownbeatTime()
+        self._broadcast({'type': 'scene', 'scene': scene, 'at': downbeat})
+        return True
+
+    def onBarEnd(self, seqMgr):
+        """ called from the clock one tick before each downbeat """
+        pending = self.takeScene()
+        if pending is not None:
+            seqMgr.applyScene(*pending)
+        self.barNum += 1
+        self._broadcast({'type': 'bar', 'at': seqMgr.nextBarTime(), 'bar': self.barNum,
+                         'barLen': self.barLength(seqMgr), 'bpm': seqMgr.beatsPerMinute, 'swing': seqMgr.swingTime})
+
+    def _broadcast(self, msg):
+        now = time.time()
+        with self.lock:
+            for addr, lastSeen in list(self.followers.items()):
+                if now - lastSeen > FOLLOWER_TIMEOUT:
+                    logging.info("Sync follower lost: %s", addr)
+                    del self.followers[addr]
+            addrs = list(self.followers)
+        for addr in addrs:
+            self.send(msg, addr)
+
+class ClockModel():
+    """
+    Estimate of (leader clock - local clock) from NTP style samples; offset(t) = offset + drift*(t - tRef)
+    """
+    def __init__(self):
+        self.samples = deque(maxlen=OFFSET_WINDOW)   #(local time, offset, delay)
+        self.offset = None
+        self.drift = 0.0
+        self.tRef = 0.0
+        self.delay = None
+
+    def addSample(self, t1, t2, t3, t4):
+        offset = ((t2 - t1) + (t3 - t4)) / 2
+        delay = (t4 - t1) - (t3 - t2)
+        self.samples.append(((t1 + t4) / 2, offset, delay))
+        #only trust samples close to the best round trip - the others were queued somewhere
+        minDelay = min(s[2] for s in self.samples)
+        good = [s for s in self.samples if s[2] <= minDelay * 1.5 + 0.001]
+        self.tRef = sum(s[0] for s in good) / len(good)
+        meanOffset = sum(s[1] for s in good) / len(good)
+        varT = sum((s[0] - self.tRef) ** 2 for s in good)
+        if len(good) >= 4 and varT > 0:
+            self.drift = sum((s[0] - self.tRef) * (s[1] - meanOffset) for s in good) / varT
+        self.offset = meanOffset
+        self.delay = minDelay
+
+    def toLocal(self, leaderTime):
+        return leaderTime - (self.offset + self.drift * (leaderTime - self.tRef))
+
+class SyncFollower(SyncNode):
+    """ follows the tempo, downbeats & scene changes of a leader """
+    def __init__(self, leaderAddr, loadScene=None):
+        self.leaderAddr = leaderAddr
+        self.clock = ClockModel()
+        self.leaderBar = None    #(local time of a leader downbeat, bar length, bpm, swing)
+        self.phaseError = None   #secs our downbeat is late (+) or early (-) vs the leader's
+        self._errors = list()
+        super().__init__(('', 0), loadScene)
+        self._pinger = threading.Thread(target=self._ping, name="seqSyncPing", daemon=True)
+        self._pinger.start()
+        logging.info("Sync following leader at %s:%s", *leaderAddr)
+
+    def _ping(self):
+        while True:
+            self.send({'type': 'ping', 't1': time.time()}, self.leaderAddr)
+            time.sleep(PING_INTERVAL)
+
+    def handleMsg(self, msg, addr, recvTime):
+        msgType = msg.get('type')
+        if msgType == 'pong':
+            with self.lock:
+                self.clock.addSample(msg['t1'], msg['t2'], msg['t3'], recvTime)
+            logging.debug("sync offset: %.6f drift: %.2fppm delay: %.6f",
+                          self.clock.offset, self.clock.drift * 1e6, self.clock.delay)
+        elif self.clock.offset is None:
+            return  #can't place leader times on our clock yet
+        elif msgType == 'bar':
+            with self.lock:
+                self.leaderBar = (self.clock.toLocal(msg['at']), msg['barLen'], msg['bpm'], msg['swing'])
+        elif msgType == 'scene':
+            try:
+                seq = self.loadScene(msg['scene'])
+            except (OSError, ValueError) as ex:
+                logging.warning("Can't load sync scene %s: %s", msg['scene'], ex)
+                return
+            with self.lock:
+                self.pendingScene = (msg['scene'], self.clock.toLocal(msg['at']), seq)
+
+    def quantizeScene(self, seqMgr, scene, seq=None):
+        if not seqMgr.is_running:
+            return False
+        with self.lock:
+            self.pendingScene = (scene, None, seq)   #local press - apply on our next downbeat
+        return True
+
+    def onBarEnd(self, seqMgr):
+        """ called from the clock one tick before each downbeat """
+        with self.lock:
+            leaderBar = self.leaderBar
+            pending = self.pendingScene
+        if leaderBar is None:
+            return
+        barTime, barLen, bpm, swing = leaderBar
+        seqMgr.beatsPerMinute = bpm
+        seqMgr.swingTime = swing
+
+        #apply a scene change on the downbeat closest to the one the leader announced
+        if pending is not None:
+            scene, at, seq = pending
+            if at is None or seqMgr.nextBarTime() >= at - barLen / 2:
+                self.takeScene()
+                seqMgr.applyScene(scene, seq)
+
+        #compare our coming downbeat with the closest leader downbeat
+        downbeat = seqMgr.nextBarTime()
+        nBars = round((downbeat - barTime) / barLen)
+        error = downbeat - (barTime + nBars * barLen)
+        self.phaseError = error
+        if abs(error) > barLen * PHASE_JUMP:
+            seqMgr.next_call -= error
+        else:
+            seqMgr.next_call -= error * PHASE_GAIN
+        logging.debug("sync phase error: %.2fms", error * 1000)
+
+        self._errors.append(abs(error))
+        if len(self._errors) >= REPORT_BARS:
+            logging.info("sync phase error over %s bars - mean: %.2fms max: %.2fms; drift: %.2fppm",
+                         len(self._errors), sum(self._errors) / len(self._errors) * 1000,
+                         max(self._errors) * 1000, self.clock.drift * 1e6)
+            self._errors.clear()
+
+def createSync(argDict, loadScene=None):
+    """ build the sync role (if any) requested on the cmd line.  loadScene: scene -> its sequence """
+    if argDict.get('syncLeader') is not None:
+        return SyncLeader(int(argDict['syncLeader']), loadScene)
+    if argDict.get('syncFollow') is not None:
+        host, port = argDict['syncFollow'].rsplit(':', 1)
+        return SyncFollower((host, int(port)), loadScene)
+    return None
@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import heapq
+import threading
+import logging
+import sampleStream
+
+"""
+Choke groups, gate mode & voice counting - so voices end when they should instead of holding a mixer channel
+
+Choke groups are per kit, in samples/<kit>/chokes.json:
+    {"groups": [["<sample name>", "<sample name>", ...], ...]}     eg: closed & open hihat in one group
+A pad in a group fades out (CHOKE_FADE_MS) every voice still sounding from any pad in the same group - incl. itself.
+With --gate, a live note's voice fades out on its midi note_off (pad released).  Sequenced notes have no note off.
+
+Peak concurrent voices are counted twice: as they really are, and as they would have been had every voice run to
+its natural end - the difference is what the chokes & gate saved.
+"""
+
+chokeFile = 'chokes.json'
+CHOKE_FADE_MS = 30
+
+def loadChokes(sampleDir, sampleNames):
+    """ returns {pad index: choke group number (1..)} from the kit's chokes.json """
+    try:
+        with open(os.path.join(sampleDir, chokeFile)) as chokesFile:
+            groups = json.load(chokesFile).get('groups', [])
+    except FileNotFoundError:
+        return dict()
+    except (OSError, ValueError, AttributeError) as ex:
+        logging.warning("Ignoring choke groups in %s: %s", sampleDir, ex)
+        return dict()
+    chokes = dict()
+    for group, names in enumerate(groups, start=1):
+        for name in names:
+            if name in sampleNames:
+                chokes[sampleNames.index(name)] = group
+            else:
+                logging.warning("Choke groups in %s: no sample %s", sampleDir, name)
+    return chokes
+
+class VoiceCounter():
+    """ peak concurrent voices, actual & if nothing had been cut short.  Times are in any one unit (secs, frames) """
+    def __init__(self):
+        self.naturalEnds = list()   #heap of end times
+        self.actualEnds = list()    #heap of (end, voice id) - incl. stale entries for voices cut short since
+        self.actual = dict()        #voice id -> end, of the voices still going
+        self.peak = 0
+        self.peakNatural = 0
+
+    def started(self, voiceId, now, end):
+        while self.naturalEnds and self.naturalEnds[0] <= now:
+            heapq.heappop(self.naturalEnds)
+        heapq.heappush(self.naturalEnds, end)
+        while self.actualEnds and self.actualEnds[0][0] <= now:
+            (oldEnd, oldId) = heapq.heappop(self.actualEnds)
+            if self.actual.get(oldId) == oldEnd:
+                del self.actual[oldId]
+        heapq.heappush(self.actualEnds, (end, voiceId))
+        self.actual[voiceId] = end
+        self.peak = max(self.peak, len(self.actual))
+        self.peakNatural = max(self.peakNatural, len(self.naturalEnds))
+
+    def cut(self, voiceId, end):
+        if voiceId in self.actual and end < self.actual[voiceId]:
+            self.actual[voiceId] = end
+            heapq.heappush(self.actualEnds, (end, voiceId))
+
+class Voice():
+    def __init__(self, voiceId, channel, sound, kit, group, note):
+        self.set(voiceId, channel, sound, kit, group, note)
+
+    def set(self, voiceId, channel, sound, kit, group, note):
+        self.voiceId = voiceId
+        self.channel = channel
+        self.sound = sound
+        self.kit = kit
+        self.group = group
+        self.note = note
+
+    @property
+    def sounding(self):
+        if self.channel is None or not self.channel.get_busy():
+            return False
+        #a streamed sample's channel plays its chunks; otherwise the channel may since have been stolen
+        return isinstance(self.sound, sampleStream.StreamedSample) or self.channel.get_sound() is self.sound
+
+    def fadeout(self):
+        if isinstance(self.sound, sampleStream.StreamedSample):
+            self.sound.fadeout(CHOKE_FADE_MS)
+        else:
+            self.channel.fadeout(CHOKE_FADE_MS)
+
+class VoiceMgr():
+    """
+    voices playing on the pygame mixer (the clock & midi threads both start them)
+    Ended voices are pruned in place & their Voice objects reused, so playing a note on the clock leaves nothing behind
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.voices = list()
+        self.spare = list()     #ended Voices, for reuse
+        self.counter = VoiceCounter()
+        self.numVoices = 0
+
+    def play(self, sound, kit, group=0, note=None):
+        """ play sound (choking its group first); note is the live midi note, for gate mode """
+        now = time.time()
+        with self.lock:
+            voices = self.voices
+            numSounding = 0
+            for voice in voices:
+                if voice.sounding:
+                    voices[numSounding] = voice
+                    numSounding += 1
+                else:
+                    voice.sound = voice.channel = None  #don't keep the sample alive (eg: a reloaded kit's)
+                    self.spare.append(voice)
+            del voices[numSounding:]
+            if group:
+                for voice in self.voices:
+                    if voice.kit == kit and voice.group == group:
+                        self.end(voice, now)
+            channel = sound.play()
+            self.numVoices += 1
+            if self.spare:
+                voice = self.spare.pop()
+                voice.set(self.numVoices, channel, sound, kit, group, note)
+            else:
+                voice = Voice(self.numVoices, channel, sound, kit, group, note)
+            voices.append(voice)
+            self.counter.started(self.numVoices, now, now + sound.get_length())
+        return channel
+
+    def noteOff(self, note):
+        now = time.time()
+        with self.lock:
+            for voice in self.voices:
+                if voice.note == note and voice.sounding:
+                    self.end(voice, now)
+
+    def end(self, voice, now):
+        voice.fadeout()
+        voice.note = None   #done with - don't fade it again
+        voice.group = 0
+        self.counter.cut(voice.voiceId, now + CHOKE_FADE_MS / 1000)
@@ -0,0 +1,26 @@
+import sys
+import logging
+import benchSeq
+
+"""
+The clock's tick must leave nothing allocated behind - the real tick path (timer chain, flight recorder, tick stats,
+real-time gc scheduling, notes & metronome) played through whole times round the sequence, with the process's net
+allocated blocks compared before & after each window: in steady state that's 0 (or less), no tolerance.
+(benchSeq.py allocs lists where the blocks come from when this fails.)
+Run from the repo root (sequence paths are relative to it):  python3 code/tstAllocs.py
+"""
+
+NUM_TICKS = 512
+WINDOWS = 3
+
+logging.basicConfig(level=logging.WARNING)
+runTicks, numTicks = benchSeq.allocTicker(NUM_TICKS)
+runTicks(numTicks)  #settle this script's own variables too
+growth = [0] * WINDOWS     #(allocated up front - not by the windows)
+for window in range(WINDOWS):
+    before = sys.getallocatedblocks()
+    runTicks(numTicks)
+    growth[window] = sys.getallocatedblocks() - before
+print("blocks left allocated by {0} windows of {1} half ticks: {2}".format(WINDOWS, numTicks, growth))
+assert all(blocks <= 0 for blocks in growth), "ticks leave allocations behind - see: python3 code/benchSeq.py allocs"
+print("ok")
@@ -0,0 +1,56 @@
+import time
+import queue
+import socket
+import threading
+import seqProfile
+
+"""
+seqProfile idle detection - threads blocked in C calls (sleep, recvfrom, SimpleQueue.get) or on an Event must count
+as idle, a spinning thread as busy - also one spinning on calls that only share a blocking call's name (dict.get).  Run from the code dir:  python3 tstProfile.py
+"""
+
+SAMPLE_SECS = 1.0
+
+def sleeper():
+    while True:
+        time.sleep(max(0, 0.5))
+
+def udpReader():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    while True:
+        sock.recvfrom(1024)
+
+def queueReader(requests=queue.SimpleQueue()):
+    while True:
+        requests.get()
+
+def eventWaiter(event=threading.Event()):
+    while True:
+        event.wait()
+
+def getSpinner(table={'key': 1}):
+    while True:
+        table.get('key')
+
+def spinner():
+    count = 0
+    while True:
+        count += 1
+
+for target in (sleeper, udpReader, queueReader, eventWaiter, getSpinner, spinner):
+    threading.Thread(target=target, name=target.__name__, daemon=True).start()
+
+profiler = seqProfile.Profiler(0)  #(0: never writes a profile unless signalled)
+time.sleep(SAMPLE_SECS)
+busy = dict()
+for (threadName, subsystem, stack), count in profiler.stacks.copy().items():
+    if subsystem != 'idle':
+        busy[threadName] = busy.get(threadName, 0) + count * 100 / profiler.numSamples
+print("busy %:", {name: round(pct, 1) for name, pct in busy.items()})
+
+for name in ('sleeper', 'udpReader', 'queueReader', 'eventWaiter'):
+    assert busy.get(name, 0) < 5, "{0} is blocked, but profiled {1:.1f}% busy".format(name, busy[name])
+for name in ('getSpinner', 'spinner'):
+    assert busy.get(name, 0) > 20, "{0} should be busy".format(name)
+print("ok")
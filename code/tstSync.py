@@ -0,0 +1,69 @@
+import os
+import time
+import logging
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+import pygame
+import sampleSeq
+import seqSync
+
+"""
+seqSync on localhost - a follower started out of phase & at another tempo must lock onto the leader's downbeats, and a
+scene change on the leader must switch both on the downbeat it announced.  No LCD needed.
+Run from the repo root (sequence & sample paths are relative to it):  python3 code/tstSync.py
+"""
+
+PORT = 9321
+LOCK_SECS = 8.0
+MAX_PHASE_ERROR = 0.01  #secs
+SCENE = 1
+
+logging.basicConfig(level=logging.WARNING)
+pygame.mixer.init()
+sampleSeq.display = sampleSeq.Display()
+sampleSeq.display.initDisplay()     #no LCD here - must not stop anything
+sampleSeq.sampMgr = sampleSeq.SampleMgr()
+sampleSeq.sampMgr.findSamples()
+sampleSeq.sampMgr.currSampleDir = 0    #(the default kit number needs more kits than the repo has)
+
+timeSig = {'bpm': 120, 'numMeasures': 2, 'numBeats': 4, 'numSubBeats': 2}
+leader = sampleSeq.SequenceMgr(timeSig)
+leader.sync = seqSync.createSync({'syncLeader': PORT}, leader.loadScene)
+follower = sampleSeq.SequenceMgr(dict(timeSig, bpm=100))
+follower.sync = seqSync.createSync({'syncFollow': '127.0.0.1:{0}'.format(PORT)}, follower.loadScene)
+
+announced = list()
+def broadcast(msg, send=leader.sync._broadcast):
+    if msg['type'] == 'scene':
+        announced.append(msg['at'])
+    send(msg)
+leader.sync._broadcast = broadcast
+
+switched = dict()   #seqMgr -> downbeat its scene change came in on
+def watchScene(seqMgr):
+    applyScene = seqMgr.applyScene
+    def apply(scene, seq=None):
+        switched[seqMgr] = seqMgr.nextBarTime()
+        applyScene(scene, seq)
+    seqMgr.applyScene = apply
+watchScene(leader)
+watchScene(follower)
+
+leader.start()
+time.sleep(0.3)
+follower.start()
+time.sleep(LOCK_SECS)
+print("phase error: {0:.2f}ms, bpm: {1}".format(follower.sync.phaseError * 1000, follower.beatsPerMinute))
+assert follower.beatsPerMinute == leader.beatsPerMinute, "follower didn't take the leader's tempo"
+assert abs(follower.sync.phaseError) < MAX_PHASE_ERROR, "follower isn't in phase"
+
+time.sleep(leader.interval * 5)     #mid bar
+leader.handleSceneChange(SCENE)
+time.sleep(2 * seqSync.SyncNode.barLength(leader) + 0.5)
+leader.stop()
+follower.stop()
+print("scene announced for: {0}, leader switched: {1}, follower switched: {2}".format(
+    announced, switched.get(leader), switched.get(follower)))
+assert len(announced) == 1 and leader in switched and follower in switched, "scene change didn't reach both"
+assert abs(switched[leader] - announced[0]) < 0.001, "leader didn't switch on the downbeat it announced"
+assert abs(switched[follower] - announced[0]) < MAX_PHASE_ERROR, "follower didn't switch on the leader's downbeat"
+print("ok")